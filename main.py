@@ -2,10 +2,18 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 from matplotlib.path import Path
+from matplotlib.artist import Artist
+from matplotlib.collections import PolyCollection, LineCollection
+from matplotlib.image import AxesImage
+from matplotlib.transforms import Bbox, IdentityTransform
+from matplotlib import animation
 import re
+import math
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog, colorchooser
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import matplotlib as mpl
 import matplotlib.font_manager as fm
 import os
@@ -13,11 +21,26 @@ import platform
 import sys
 import traceback
 import argparse
+import io
 import json
 import locale
 import logging
+import time
+import threading
+import itertools
+import warnings
+from collections import OrderedDict
 from datetime import datetime
 from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+# 疎行列（scipy.sparse）は scipy がある環境でだけ扱う
+try:
+    import scipy.sparse as sparse
+    import scipy.sparse.linalg as sparse_linalg
+    from scipy.sparse.csgraph import connected_components
+except ImportError:
+    sparse = None
 
 # 日本語フォントの設定
 def setup_japanese_fonts():
@@ -46,30 +69,3434 @@ def setup_japanese_fonts():
     print("適切な日本語フォントが見つかりませんでした。デフォルトフォントを使用します。")
     return False
 
-# 日本語フォント設定を実行
-setup_japanese_fonts()
+# 日本語フォント設定を実行
+setup_japanese_fonts()
+
+def cell_polygons(pos_x, pos_y, rows, cols):
+    """行列の各セルの四角形頂点を (rows*cols, 4, 2) の配列で返す（行優先）"""
+    jj, ii = np.meshgrid(np.arange(cols), np.arange(rows))
+    return cell_polygons_at(pos_x, pos_y, ii.ravel(), jj.ravel())
+
+def cell_polygons_at(pos_x, pos_y, rows, cols):
+    """指定したセル（行と列の配列）の四角形頂点を (N, 4, 2) の配列で返す"""
+    x0 = pos_x + np.asarray(cols)
+    y0 = -(pos_y + np.asarray(rows)) - 1
+    verts = np.empty((len(x0), 4, 2))
+    verts[:, 0, 0] = x0
+    verts[:, 0, 1] = y0
+    verts[:, 1, 0] = x0 + 1
+    verts[:, 1, 1] = y0
+    verts[:, 2, 0] = x0 + 1
+    verts[:, 2, 1] = y0 + 1
+    verts[:, 3, 0] = x0
+    verts[:, 3, 1] = y0 + 1
+    return verts
+
+def colors_to_rgba(colors, alpha=None):
+    """色名のリストを (N, 4) の RGBA 配列に変換（変換できない色は透明）"""
+    return color_registry.rgba_array(colors, alpha)[0]
+
+def contrast_text_colors(rgba):
+    """背景色の輝度から黒か白の文字色を (N, 4) の RGBA 配列で返す"""
+    brightness = rgba[:, :3] @ np.array([0.299, 0.587, 0.114])
+    # 変換できなかった色（透明）は黒文字
+    light = (brightness > 0.5) | (rgba[:, 3] == 0)
+    return np.where(light[:, None], np.array([0.0, 0.0, 0.0, 1.0]), np.array([1.0, 1.0, 1.0, 1.0]))
+
+def format_cell_value(val):
+    """セルの値を表示用の文字列に変換"""
+    # NumPy の整数型（np.int64 など）は int のサブクラスではないので別に判定する
+    if isinstance(val, (int, np.integer, np.bool_)) or (isinstance(val, (float, np.floating)) and float(val).is_integer()):
+        return str(int(val))
+    return f"{val:.2f}"
+
+def format_cell_labels(values):
+    """行列の値をまとめて表示用の文字列の配列に変換（format_cell_value と同じ書式）"""
+    values = np.asarray(values)
+    if values.dtype.kind in 'biu':
+        # 整数の配列は NumPy の文字列変換で一度に変換できる
+        return values.astype(np.int64).astype(str)
+    # 浮動小数点数は一度 Python の float のリストにしてから書式化する
+    # （np.char.mod より速く、丸めも format_cell_value と完全に一致する）
+    labels = ['%d' % val if val.is_integer() else '%.2f' % val
+              for val in values.astype(float).ravel().tolist()]
+    return np.array(labels, dtype=str).reshape(values.shape)
+
+def is_sparse(values):
+    """値が scipy.sparse の疎行列かどうか"""
+    return sparse is not None and sparse.issparse(values)
+
+def dense_values(values):
+    """疎行列・メモリマップの行列なら密な配列に変換（密な配列はそのまま返す）"""
+    return values.toarray() if is_sparse(values) else np.asarray(values)
+
+def sparse_from_entries(entries, shape):
+    """シーンファイルの疎行列（COO の row/col/data か CSR の indptr/indices/data）から CSR の疎行列を作る"""
+    if sparse is None:
+        raise RuntimeError("疎行列の読み込みには scipy が必要です")
+    data = np.asarray(entries['data'])
+    if 'indptr' in entries:
+        return sparse.csr_array((data, np.asarray(entries['indices']), np.asarray(entries['indptr'])), shape=shape)
+    return sparse.coo_array((data, (np.asarray(entries['row']), np.asarray(entries['col']))), shape=shape).tocsr()
+
+def sparse_heatmap(values, max_pixels=1024):
+    """疎行列の非ゼロ要素を最大 max_pixels 四方の画像に集約し、(画像, 1ピクセルのセル数) を返す
+
+    各ピクセルは step×step セルの非ゼロ要素の平均で、非ゼロ要素のないピクセルは NaN（透明）。
+    計算量と画像の大きさは行列の大きさではなく非ゼロ要素の数と max_pixels で決まる。
+    """
+    rows, cols = values.shape
+    step = max(1, math.ceil(max(rows, cols) / max_pixels))
+    shape = (math.ceil(rows / step), math.ceil(cols / step))
+    coo = values.tocoo()
+    bins = (coo.row // step).astype(np.int64) * shape[1] + coo.col // step
+    total = np.bincount(bins, weights=coo.data, minlength=shape[0] * shape[1])
+    count = np.bincount(bins, minlength=shape[0] * shape[1])
+    with np.errstate(invalid='ignore'):
+        image = total / count
+    return image.reshape(shape), step
+
+def permutation_sign(perm):
+    """置換の符号（巡回の数から求める）"""
+    n = len(perm)
+    graph = sparse.csr_array((np.ones(n), (np.arange(n), perm)), shape=(n, n))
+    cycles = connected_components(graph, directed=True, connection='weak')[0]
+    return -1.0 if (n - cycles) % 2 else 1.0
+
+def matrix_determinant(values):
+    """行列式（疎行列は疎な LU 分解から求め、密な配列には変換しない）"""
+    if not is_sparse(values):
+        return np.linalg.det(values)
+    try:
+        lu = sparse_linalg.splu(sparse.csc_array(values, dtype=np.float64))
+    except RuntimeError:
+        # 特異行列は分解できない
+        return 0.0
+    # L の対角は 1 なので、U の対角の積に行と列の置換の符号を掛ける
+    return float(np.prod(lu.U.diagonal())) * permutation_sign(lu.perm_r) * permutation_sign(lu.perm_c)
+
+def matrix_trace(values):
+    """トレース（疎行列は対角成分だけを取り出す）"""
+    return values.diagonal().sum() if is_sparse(values) else np.trace(values)
+
+def combine_values(left, right, operator):
+    """2つの行列の値の +, -, *（行列積）を計算（疎行列同士なら結果も疎行列）"""
+    left, right = (np.asarray(values) if isinstance(values, MappedArray) else values for values in (left, right))
+    if operator == '+':
+        return left + right
+    if operator == '-':
+        return left - right
+    if operator == '*':
+        return left @ right
+    raise ValueError(f"不明な演算子です: {operator}")
+
+def matrix_palette(is_dark_mode):
+    """行列のセル・文字・枠線の色を (セル, 文字, 枠線) で返す"""
+    if is_dark_mode:
+        return '#3a3a3a', 'white', '#555555'
+    return 'white', 'black', 'black'
+
+def rasterize_cell_tile(values, cell_pixels, dpi, is_dark_mode=False):
+    """セルのブロック（格子と値）を1セル cell_pixels ピクセルの RGBA 画像にする"""
+    rows, cols = values.shape
+    cell_color, text_color, edge_color = matrix_palette(is_dark_mode)
+    
+    # タイルごとに独立した Agg キャンバスを使う（バックグラウンドスレッドから呼ばれる）
+    fig = Figure(figsize=(cols * cell_pixels / dpi, rows * cell_pixels / dpi), dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    fig.patch.set_alpha(0)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_xlim(0, cols)
+    ax.set_ylim(-rows, 0)
+    ax.axis('off')
+    
+    ax.add_collection(PolyCollection(
+        cell_polygons(0, 0, rows, cols),
+        facecolors=cell_color,
+        edgecolors=edge_color,
+        linewidths=1
+    ), autolim=False)
+    
+    jj, ii = np.meshgrid(np.arange(cols), np.arange(rows))
+    ax.add_artist(CellTextCollection(
+        np.column_stack([jj.ravel() + 0.5, -ii.ravel() - 0.5]),
+        format_cell_labels(values).ravel(),
+        colors=text_color,
+        fontsize=12,
+        zorder=2
+    ))
+    
+    canvas.draw()
+    return np.asarray(canvas.buffer_rgba()).copy()
+
+class MappedArray:
+    """読み取り専用でメモリマップした .npy ファイルと、書き込んだセルの上書き（コピーオンライト）
+
+    ファイルは変更せず、書き込みは (行, 列) -> 値 の辞書に残す。読み出しは NumPy の添字で
+    ファイルの必要な部分だけを読み込み、その範囲に入る上書きを適用したコピーを返す。
+    NumPy の関数に渡すと __array__ で全体を読み込むので、大きな行列では添字で読むこと。
+    """
+
+    def __init__(self, path):
+        self.base = np.load(path, mmap_mode='r')
+        self.edits = {}
+
+    @property
+    def filename(self):
+        return self.base.filename
+
+    @property
+    def shape(self):
+        return self.base.shape
+
+    @property
+    def ndim(self):
+        return self.base.ndim
+
+    @property
+    def dtype(self):
+        return self.base.dtype
+
+    def __len__(self):
+        return len(self.base)
+
+    def __array__(self, dtype=None, copy=None):
+        values = self[:, :]
+        return values if dtype is None else values.astype(dtype)
+
+    def _edit_arrays(self):
+        keys = np.array(list(self.edits), dtype=np.int64).reshape(-1, 2)
+        return keys[:, 0], keys[:, 1], np.array(list(self.edits.values()), dtype=self.dtype)
+
+    @staticmethod
+    def _positions(selected, targets):
+        """selected（元の番号の配列）の中での targets の位置と、含まれているかのマスク"""
+        order = np.argsort(selected, kind='stable')
+        found = np.searchsorted(selected[order], targets)
+        found = np.minimum(found, len(selected) - 1)
+        positions = order[found] if len(selected) else found
+        return positions, len(selected) > 0 and selected[positions] == targets
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        row_key, col_key = key
+        if isinstance(row_key, (int, np.integer)) and isinstance(col_key, (int, np.integer)):
+            row, col = int(row_key) % self.shape[0], int(col_key) % self.shape[1]
+            value = self.edits.get((row, col))
+            return self.base[row, col] if value is None else self.dtype.type(value)
+        
+        values = np.array(self.base[key])
+        if not self.edits:
+            return values
+        rows, cols, data = self._edit_arrays()
+        selected_rows = np.arange(self.shape[0])[row_key]
+        selected_cols = np.arange(self.shape[1])[col_key]
+        if np.ndim(row_key) and np.ndim(col_key) and not isinstance(row_key, slice) and not isinstance(col_key, slice):
+            # 行と列の配列の組（要素ごとの添字）
+            keys = selected_rows.astype(np.int64) * self.shape[1] + selected_cols
+            positions, hit = self._positions(rows * self.shape[1] + cols, keys)
+            values[hit] = data[positions[hit]]
+            return values
+        
+        # 行と列それぞれの選択の直積（整数の添字の軸は結果から落ちる）
+        row_pos, row_hit = self._positions(np.atleast_1d(selected_rows), rows)
+        col_pos, col_hit = self._positions(np.atleast_1d(selected_cols), cols)
+        hit = row_hit & col_hit
+        if np.ndim(selected_rows) and np.ndim(selected_cols):
+            values[row_pos[hit], col_pos[hit]] = data[hit]
+        elif np.ndim(selected_rows):
+            values[row_pos[hit]] = data[hit]
+        else:
+            values[col_pos[hit]] = data[hit]
+        return values
+
+    def __setitem__(self, key, value):
+        row, col = key
+        self.edits[(int(row) % self.shape[0], int(col) % self.shape[1])] = self.dtype.type(value).item()
+
+class Matrix:
+    """行列のモデル（名前・値・位置・要素の型の方針と、値の変更のたびに進むバージョン）
+
+    値は NumPy の2次元配列か、scipy.sparse の疎行列（CSR に揃えて保持する）か、
+    .npy ファイルのメモリマップ（MappedArray）。メモリマップの行列への書き込みはファイルには
+    反映せず、書き込んだセルの上書き（edits）にだけ残す。
+    行数と列数は値の配列の形から求めるので、別に保存した値とずれることはない。
+    バージョンはすべての行列で共通のカウンタから取るので、削除して同じ名前で作り直しても
+    以前の値と同じバージョンになることはなく、キャッシュはバージョンだけを見ればよい。
+    """
+
+    __slots__ = ('name', '_values', '_position', 'dtype_policy', 'version')
+
+    # 要素の型の方針
+    #   'auto'  整数の行列に整数でない値を書き込んだら float に昇格する
+    #   'int'   整数のまま（整数でない値の書き込みは ValueError）
+    #   'float' 常に float で保持する
+    dtype_policies = ('auto', 'int', 'float')
+    _versions = itertools.count(1)
+
+    def __init__(self, name, values, position=(0, 0), dtype_policy='auto'):
+        if dtype_policy not in self.dtype_policies:
+            raise ValueError(f"不明な型の方針です: {dtype_policy}")
+        self.name = name
+        self.dtype_policy = dtype_policy
+        self._position = tuple(position)
+        self.values = values
+
+    def __repr__(self):
+        return (f"Matrix({self.name!r}, shape={self.shape}, position={self._position}, "
+                f"dtype_policy={self.dtype_policy!r}, version={self.version})")
+
+    @classmethod
+    def from_file(cls, name, path, position=(0, 0), dtype_policy='auto', edits=()):
+        """.npy ファイルを読み取り専用でメモリマップした行列を作り、edits (行, 列, 値) を書き込む"""
+        matrix = cls(name, MappedArray(path), position, dtype_policy)
+        for row, col, value in edits:
+            matrix.set_cell(row, col, value)
+        return matrix
+
+    def copy(self, name, position):
+        """値を複製した行列を作る（メモリマップの行列は同じファイルを開き直して書き込みを再現する）"""
+        if self.is_mapped:
+            return Matrix.from_file(name, self.source, position, self.dtype_policy,
+                                    [(row, col, value) for (row, col), value in self.edits.items()])
+        return Matrix(name, self._values.copy(), position, self.dtype_policy)
+
+    def _coerce(self, values):
+        if is_sparse(values):
+            return self._coerce_sparse(values)
+        if isinstance(values, MappedArray):
+            return self._coerce_mapped(values)
+        values = np.asarray(values)
+        if values.ndim != 2:
+            raise ValueError(f"行列 '{self.name}' の値は2次元の配列である必要があります")
+        if self.dtype_policy == 'float':
+            return values.astype(np.float64, copy=False)
+        if self.dtype_policy == 'int' and values.dtype.kind not in 'biu':
+            if not np.all(np.mod(values, 1) == 0):
+                raise ValueError(f"行列 '{self.name}' は整数の行列です")
+            return values.astype(np.int64)
+        return values
+
+    def _coerce_mapped(self, values):
+        # メモリマップは型を変えるとファイル全体を読み込んでしまうので、方針に合う型のまま使う
+        if values.ndim != 2:
+            raise ValueError(f"行列 '{self.name}' の値は2次元の配列である必要があります")
+        kind = values.dtype.kind
+        if (self.dtype_policy == 'float' and kind != 'f') or (self.dtype_policy == 'int' and kind not in 'biu'):
+            raise ValueError(f"行列 '{self.name}' のファイルの型 {values.dtype} は型の方針 "
+                             f"'{self.dtype_policy}' に合いません")
+        return values
+
+    def _coerce_sparse(self, values):
+        # 行の範囲の切り出しとセルの読み書きに向く CSR にし、明示的な 0 は取り除く
+        values = sparse.csr_array(values)
+        values.sum_duplicates()
+        values.eliminate_zeros()
+        if self.dtype_policy == 'float':
+            return values.astype(np.float64)
+        if self.dtype_policy == 'int' and values.dtype.kind not in 'biu':
+            if not np.all(np.mod(values.data, 1) == 0):
+                raise ValueError(f"行列 '{self.name}' は整数の行列です")
+            return values.astype(np.int64)
+        return values
+
+    def touch(self):
+        """値を直接書き換えた後に呼び、バージョンを進める"""
+        self.version = next(self._versions)
+
+    @property
+    def values(self):
+        return self._values
+
+    @values.setter
+    def values(self, values):
+        self._values = self._coerce(values)
+        self.touch()
+
+    @property
+    def position(self):
+        return self._position
+
+    @position.setter
+    def position(self, position):
+        # 位置は値ではないので、値のバージョン（ラベルや評価結果のキャッシュのキー）は進めない
+        self._position = tuple(position)
+
+    @property
+    def shape(self):
+        return self._values.shape
+
+    @property
+    def is_sparse(self):
+        return is_sparse(self._values)
+
+    @property
+    def is_mapped(self):
+        return isinstance(self._values, MappedArray)
+
+    @property
+    def source(self):
+        """メモリマップしている .npy ファイルのパス（メモリマップでなければ None）"""
+        return self._values.filename if self.is_mapped else None
+
+    @property
+    def edits(self):
+        """メモリマップの行列に書き込んだセル {(行, 列): 値}（メモリマップでなければ None）"""
+        return self._values.edits if self.is_mapped else None
+
+    @property
+    def nnz(self):
+        """非ゼロ要素の数（疎行列は保持している要素の数）"""
+        return self._values.nnz if self.is_sparse else int(np.count_nonzero(self._values))
+
+    def nonzero_cells(self):
+        """非ゼロのセルを (行の配列, 列の配列) で返す（行優先の順）"""
+        if self.is_sparse:
+            coo = self._values.tocoo()
+            return coo.row.astype(int), coo.col.astype(int)
+        return np.nonzero(self._values)
+
+    @property
+    def rows(self):
+        return self._values.shape[0]
+
+    @property
+    def cols(self):
+        return self._values.shape[1]
+
+    def set_cell(self, row, col, value):
+        """セルに値を書き込む（値の配列を作り直したら True を返す）
+
+        整数の行列に整数でない値を書き込むと切り捨てられてしまうので、
+        型の方針が 'auto' なら float に昇格し、'int' なら ValueError にする。
+        メモリマップの行列は昇格するとファイル全体を読み込むので、方針によらず ValueError にする。
+        """
+        values = self._values
+        promoted = False
+        if values.dtype.kind in 'biu' and not float(value).is_integer():
+            if self.dtype_policy == 'int' or self.is_mapped:
+                raise ValueError(f"行列 '{self.name}' は整数の行列のため {value} は書き込めません")
+            values = self._values = values.astype(np.float64)
+            promoted = True
+        if self.is_sparse:
+            # 1セルの書き込みで疎な構造が変わるのは想定どおりなので警告は出さない
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', sparse.SparseEfficiencyWarning)
+                values[row, col] = value
+            if value == 0:
+                values.eliminate_zeros()
+        else:
+            values[row, col] = value
+        self.touch()
+        return promoted
+
+class ColorRegistry:
+    """色の文字列を1回だけ解釈し、RGBA と対比の文字色をキャッシュする"""
+
+    def __init__(self):
+        # (色の文字列, alpha) -> (RGBA, 文字色の RGBA)（解釈できない色は None）
+        self._colors = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._colors)
+
+    def _entry(self, color, alpha=None):
+        key = (color if isinstance(color, str) else str(color), alpha)
+        try:
+            entry = self._colors[key]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return entry
+        
+        self.misses += 1
+        try:
+            rgba = mpl.colors.to_rgba(key[0], alpha)
+        except ValueError:
+            entry = None
+        else:
+            text = tuple(contrast_text_colors(np.array([rgba]))[0])
+            entry = (rgba, text)
+        # 同じ色名の文字列は1つのオブジェクトを共有する
+        self._colors[(self.intern(key[0]), alpha)] = entry
+        return entry
+
+    def intern(self, color):
+        """色の文字列を共有のオブジェクトにして返す（同じ色名を大量に保持するとき用）"""
+        return sys.intern(color) if isinstance(color, str) else color
+
+    def is_valid(self, color):
+        """色名またはカラーコードとして解釈できるかどうか"""
+        return self._entry(color) is not None
+
+    def rgba(self, color, alpha=None):
+        """色の RGBA を返す（解釈できなければ ValueError）"""
+        entry = self._entry(color, alpha)
+        if entry is None:
+            raise ValueError(f"'{color}' は有効な色名またはカラーコードではありません。")
+        return entry[0]
+
+    def text_color(self, color, alpha=None):
+        """色を背景にしたときに読みやすい文字色（黒か白）の RGBA を返す"""
+        entry = self._entry(color, alpha)
+        return entry[1] if entry is not None else (0.0, 0.0, 0.0, 1.0)
+
+    def to_hex(self, color):
+        """色を #rrggbb 形式のカラーコードで返す"""
+        return mpl.colors.to_hex(self.rgba(color), keep_alpha=False)
+
+    def rgba_array(self, colors, alpha=None):
+        """色のリストを (N, 4) の RGBA 配列と文字色の配列に変換（変換できない色は透明・黒文字）"""
+        n = len(colors)
+        if not n:
+            return np.zeros((0, 4)), np.zeros((0, 4))
+        # 同じ色は1回だけ引く（色の種類は少ないので、要素ごとには番号だけを付ける）
+        codes = {}
+        inverse = np.fromiter((codes.setdefault(color if isinstance(color, str) else str(color), len(codes))
+                               for color in colors), dtype=np.intp, count=n)
+        rgba = np.zeros((len(codes), 4))
+        text = np.tile([0.0, 0.0, 0.0, 1.0], (len(codes), 1))
+        for color, i in codes.items():
+            entry = self._entry(color, alpha)
+            if entry is not None:
+                rgba[i], text[i] = entry
+        return rgba[inverse], text[inverse]
+
+    def stats(self):
+        """キャッシュの統計を文字列で返す"""
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0.0
+        return f"色 {len(self._colors)} 件 (ヒット率 {hit_rate:.1f}%)"
+
+# 色の解釈結果はアプリ全体で共有する
+color_registry = ColorRegistry()
+
+class StringTable:
+    """文字列と整数 ID の対応表（構造化配列の列には文字列の代わりに ID を入れる）"""
+
+    def __init__(self):
+        self._ids = {}
+        self._strings = []
+        # ID -> 文字列のオブジェクト配列（lookup 用、登録が増えたら作り直す）
+        self._array = None
+
+    def __len__(self):
+        return len(self._strings)
+
+    def __iter__(self):
+        return iter(self._strings)
+
+    def __getitem__(self, sid):
+        return self._strings[sid]
+
+    def id(self, string):
+        """文字列の ID を返す（未登録なら登録する）"""
+        sid = self._ids.get(string)
+        if sid is None:
+            sid = self._ids[string] = len(self._strings)
+            self._strings.append(sys.intern(string))
+            self._array = None
+        return sid
+
+    def find(self, string):
+        """登録済みの文字列の ID を返す（未登録なら -1）"""
+        return self._ids.get(string, -1)
+
+    def ids(self, strings):
+        """文字列の列を ID の配列に変換（未登録の文字列は登録する）"""
+        return np.fromiter((self.id(string) for string in strings), dtype=np.int32, count=len(strings))
+
+    def lookup(self, ids):
+        """ID の配列を文字列のオブジェクト配列に変換"""
+        if self._array is None:
+            self._array = np.empty(len(self._strings), dtype=object)
+            self._array[:] = self._strings
+        return self._array[ids]
+
+    def compact(self, *columns, keep=()):
+        """columns（ID の配列）に現れない文字列を捨てて ID を詰め直し、columns を新しい ID に書き換える
+
+        keep の ID は使われていなくても残す。ID の大小の順は保つので、残した最小の ID は変わらない。
+        """
+        used = np.unique(np.concatenate([np.asarray(column, dtype=np.int64) for column in columns]
+                                        + [np.asarray(keep, dtype=np.int64)]))
+        if len(used) == len(self._strings):
+            return
+        remap = np.full(len(self._strings), -1, dtype=np.int32)
+        remap[used] = np.arange(len(used), dtype=np.int32)
+        for column in columns:
+            column[:] = remap[column]
+        self._strings = [self._strings[sid] for sid in used.tolist()]
+        self._ids = {string: sid for sid, string in enumerate(self._strings)}
+        self._array = None
+
+class RecordArray:
+    """構造化配列の可変長の表（容量を倍々に広げて追記を償却 O(1) にし、削除は詰めて順序を保つ）"""
+
+    def __init__(self, dtype, capacity=16):
+        self._data = np.zeros(capacity, dtype=dtype)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def data(self):
+        """使用中の部分のビュー（列への代入はそのまま表に反映される）"""
+        return self._data[:self._size]
+
+    def _reserve(self, size):
+        if size > len(self._data):
+            data = np.zeros(max(size, 2 * len(self._data)), dtype=self._data.dtype)
+            data[:self._size] = self._data[:self._size]
+            self._data = data
+
+    def append(self, record):
+        """1件を末尾に追加"""
+        self._reserve(self._size + 1)
+        self._data[self._size] = record
+        self._size += 1
+
+    def extend(self, records):
+        """同じ dtype の構造化配列を末尾に追加"""
+        self._reserve(self._size + len(records))
+        self._data[self._size:self._size + len(records)] = records
+        self._size += len(records)
+
+    def delete(self, where):
+        """番号（の配列）か真偽値のマスクで指定した行を削除"""
+        keep = np.ones(self._size, dtype=bool)
+        keep[where] = False
+        # 行をバイト列として詰める（構造化配列のままだとフィールドごとのコピーになり遅い）
+        rows = self.data.view(np.dtype((np.void, self._data.dtype.itemsize)))
+        kept = rows[keep]
+        rows[:len(kept)] = kept
+        self._size = len(kept)
+
+class ColoredCellIndex:
+    """色付きセルを (行列, 行, 列, 色) の構造化配列で保持する索引（追加順を保持）
+
+    行列名と色は StringTable の ID で持つので、行列単位の絞り込み・削除・名前の変更は
+    配列の演算で行える。1件ずつの辞書（'matrix', 'row', 'col', 'color'）としても読める。
+    1セルの読み書きは (行列の ID, 行, 列) -> 配列の位置 の辞書で O(1) で行う。削除した行は
+    行列の ID を -1 にした墓標として残し、墓標が生きている行より多くなったら詰める。
+    詰めるときに、使われなくなった行列名と色も StringTable から捨てる。
+    """
+
+    dtype = np.dtype([('matrix', np.int32), ('row', np.int32), ('col', np.int32), ('color', np.int32)])
+
+    def __init__(self, cells=()):
+        self.names = StringTable()
+        self.colors = StringTable()
+        self._records = RecordArray(self.dtype)
+        # (行列名の ID, 行, 列) -> 配列の位置（墓標を含めた位置）
+        self._index = {}
+        self._dead = 0
+        # 墓標を除いた配列と、行列名の ID -> その行列のセルの番号の配列（必要になったときに作る）
+        self._live = None
+        self._groups = None
+        cells = list(cells)
+        if cells:
+            self._set_records(self._records_from(
+                [cell['matrix'] for cell in cells], [cell['row'] for cell in cells],
+                [cell['col'] for cell in cells], [cell['color'] for cell in cells]))
+
+    def __len__(self):
+        return len(self._records) - self._dead
+
+    def __iter__(self):
+        for matrix, row, col, color in self.records.tolist():
+            yield {'matrix': self.names[matrix], 'row': row, 'col': col, 'color': self.colors[color]}
+
+    def __getitem__(self, index):
+        """追加順で index 番目の色付きセルを返す（リストボックスとの対応用）"""
+        matrix, row, col, color = self.records[index].tolist()
+        return {'matrix': self.names[matrix], 'row': row, 'col': col, 'color': self.colors[color]}
+
+    def __contains__(self, key):
+        return self._find(*key) >= 0
+
+    @property
+    def records(self):
+        """色付きセルの構造化配列（読み取り用、墓標は含まない）"""
+        if self._live is None:
+            data = self._records.data
+            self._live = data[data['matrix'] >= 0] if self._dead else data
+        return self._live
+
+    def _records_from(self, matrices, rows, cols, colors):
+        records = np.empty(len(rows), dtype=self.dtype)
+        records['matrix'] = self.names.ids(matrices)
+        records['row'] = rows
+        records['col'] = cols
+        records['color'] = self.colors.ids(colors)
+        return records
+
+    def _changed(self):
+        self._live = None
+        self._groups = None
+
+    def _set_records(self, records):
+        """セルの色をまとめて設定（既存の設定は取り除き、新しいものを末尾に追加）"""
+        start = len(self._records)
+        self._records.extend(records)
+        index = self._index
+        killed = []
+        # 同じセルが前にあれば（同じ呼び出しの中で前に出てきたものも）墓標にして最後のものだけを残す
+        for position, key in enumerate(zip(records['matrix'].tolist(), records['row'].tolist(),
+                                           records['col'].tolist()), start):
+            previous = index.get(key)
+            if previous is not None:
+                killed.append(previous)
+            index[key] = position
+        if killed:
+            self._records.data['matrix'][killed] = -1
+            self._dead += len(killed)
+        self._changed()
+        self._compact_if_sparse()
+
+    def _delete_positions(self, positions):
+        """配列の位置（墓標を含めた位置）で指定した行を墓標にする"""
+        data = self._records.data
+        index = self._index
+        for key in zip(data['matrix'][positions].tolist(), data['row'][positions].tolist(),
+                       data['col'][positions].tolist()):
+            del index[key]
+        data['matrix'][positions] = -1
+        self._dead += len(positions)
+        self._changed()
+        self._compact_if_sparse()
+
+    def _compact_if_sparse(self):
+        # 墓標の数だけ操作が済んでいるので償却 O(1)
+        if self._dead <= max(len(self), 64):
+            return
+        self._compact()
+
+    def _compact(self):
+        """墓標を詰め、使われなくなった行列名と色の ID を捨てる（位置と ID が変わるので辞書を作り直す）"""
+        if self._dead:
+            self._records.delete(self._records.data['matrix'] < 0)
+            self._dead = 0
+        data = self._records.data
+        self.names.compact(data['matrix'])
+        self.colors.compact(data['color'])
+        self._rebuild_index()
+
+    def _rebuild_index(self):
+        data = self._records.data
+        self._index = {key: position for position, key in enumerate(zip(
+            data['matrix'].tolist(), data['row'].tolist(), data['col'].tolist())) if key[0] >= 0}
+        self._changed()
+
+    def _raw_matrix_positions(self, matrix):
+        """行列のセルの配列の位置（墓標を含めた位置）"""
+        sid = self.names.find(matrix)
+        if sid < 0:
+            return np.zeros(0, dtype=np.intp)
+        return np.flatnonzero(self._records.data['matrix'] == sid)
+
+    def _find(self, matrix, row, col):
+        sid = self.names.find(matrix)
+        if sid < 0:
+            return -1
+        return self._index.get((sid, row, col), -1)
+
+    def _group(self, matrix):
+        """行列のセルの番号の配列（行列ごとのグループは変更がなければ作り直さない）"""
+        if self._groups is None:
+            ids = self.records['matrix']
+            order = np.argsort(ids, kind='stable')
+            group_ids, starts = np.unique(ids[order], return_index=True)
+            self._groups = dict(zip(group_ids.tolist(), np.split(order, starts[1:])))
+        return self._groups.get(self.names.find(matrix), np.zeros(0, dtype=np.intp))
+
+    def get(self, matrix, row, col):
+        """セルの色を返す（色付きでなければ None）"""
+        position = self._find(matrix, row, col)
+        return self.colors[self._records.data['color'][position]] if position >= 0 else None
+
+    def set(self, matrix, row, col, color):
+        """セルに色を設定（既存の設定は置き換えて末尾に移す）"""
+        record = (self.names.id(matrix), row, col, self.colors.id(color))
+        key = record[:3]
+        previous = self._index.get(key)
+        if previous is not None:
+            self._records.data['matrix'][previous] = -1
+            self._dead += 1
+        self._records.append(record)
+        self._index[key] = len(self._records) - 1
+        self._changed()
+        self._compact_if_sparse()
+
+    def discard(self, matrix, row, col):
+        """セルの色設定を削除（なければ何もしない）"""
+        position = self._find(matrix, row, col)
+        if position >= 0:
+            self._delete_positions([position])
+
+    def set_range(self, matrix, start_row, start_col, end_row, end_col, color):
+        """矩形範囲のセルに色を設定"""
+        rows, cols = np.mgrid[start_row:end_row + 1, start_col:end_col + 1]
+        records = np.empty(rows.size, dtype=self.dtype)
+        records['matrix'] = self.names.id(matrix)
+        records['row'] = rows.ravel()
+        records['col'] = cols.ravel()
+        records['color'] = self.colors.id(color)
+        self._set_records(records)
+
+    def clear_range(self, matrix, start_row, start_col, end_row, end_col):
+        """矩形範囲のセルの色設定を削除"""
+        positions = self._raw_matrix_positions(matrix)
+        data = self._records.data[positions]
+        inside = ((data['row'] >= start_row) & (data['row'] <= end_row)
+                  & (data['col'] >= start_col) & (data['col'] <= end_col))
+        if inside.any():
+            self._delete_positions(positions[inside])
+
+    def pop_index(self, index):
+        """追加順で index 番目の色付きセルを削除して返す"""
+        cell = self[index]
+        self._delete_positions([self._find(cell['matrix'], cell['row'], cell['col'])])
+        return cell
+
+    def count_in_matrix(self, matrix):
+        """行列の色付きセルの数を返す"""
+        return len(self._group(matrix))
+
+    def matrix_arrays(self, matrix):
+        """行列の色付きセルを (行の配列, 列の配列, 色の文字列の配列) で返す"""
+        records = self.records[self._group(matrix)]
+        return records['row'].astype(int), records['col'].astype(int), self.colors.lookup(records['color'])
+
+    def remove_matrix(self, matrix):
+        """行列の色付きセルをすべて削除"""
+        positions = self._raw_matrix_positions(matrix)
+        if len(positions):
+            self._delete_positions(positions)
+
+    def rename_matrix(self, old_name, new_name):
+        """行列名の変更に合わせて行列の ID を付け替える（順序は保持）"""
+        positions = self._raw_matrix_positions(old_name)
+        if len(positions):
+            self._records.data['matrix'][positions] = self.names.id(new_name)
+            self._compact()
+
+    def to_json(self):
+        """保存用に辞書のリストへ変換"""
+        records = self.records
+        return [{'matrix': matrix, 'row': row, 'col': col, 'color': color}
+                for matrix, row, col, color in zip(self.names.lookup(records['matrix']).tolist(),
+                                                   records['row'].tolist(), records['col'].tolist(),
+                                                   self.colors.lookup(records['color']).tolist())]
+
+class ArrowTable:
+    """矢印を構造化配列で保持する表（行列名・色・スタイル・ラベルは StringTable の ID）
+
+    1本ずつの辞書（'source', 'target', 'color', 'style', 'width', 'label'）としても読み書きでき、
+    行列単位の絞り込み・削除・名前の変更は配列の演算で行う。
+    削除や名前の変更で文字列の表が矢印から参照できる数より大きくなったら、使われていない文字列を捨てる。
+    """
+
+    dtype = np.dtype([('source', np.int32), ('source_row', np.int32), ('source_col', np.int32),
+                      ('target', np.int32), ('target_row', np.int32), ('target_col', np.int32),
+                      ('color', np.int32), ('style', np.int32), ('width', np.float64), ('label', np.int32)])
+
+    def __init__(self, arrows=()):
+        self.names = StringTable()
+        self.colors = StringTable()
+        # スタイルとラベルの文字列（ID 0 は空のラベル）
+        self.texts = StringTable()
+        self.texts.id('')
+        self._records = RecordArray(self.dtype)
+        self.extend(arrows)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        for record in self._records.data.tolist():
+            yield self._to_dict(record)
+
+    def __getitem__(self, index):
+        return self._to_dict(self._records.data[index].tolist())
+
+    def __delitem__(self, index):
+        self._records.delete(index)
+        self._compact_if_sparse()
+
+    @property
+    def records(self):
+        """矢印の構造化配列（列への代入はそのまま表に反映される）"""
+        return self._records.data
+
+    def _to_dict(self, record):
+        source, source_row, source_col, target, target_row, target_col, color, style, width, label = record
+        return {
+            'source': (self.names[source], source_row, source_col),
+            'target': (self.names[target], target_row, target_col),
+            'color': self.colors[color],
+            'style': self.texts[style],
+            'width': width,
+            'label': self.texts[label]
+        }
+
+    def _to_record(self, arrow):
+        source_name, source_row, source_col = arrow['source']
+        target_name, target_row, target_col = arrow['target']
+        return (self.names.id(source_name), source_row, source_col,
+                self.names.id(target_name), target_row, target_col,
+                self.colors.id(arrow['color']), self.texts.id(arrow.get('style', '-|>')),
+                arrow.get('width', 2.0), self.texts.id(arrow.get('label') or ''))
+
+    def append(self, arrow):
+        """矢印を1本追加"""
+        self._records.append(self._to_record(arrow))
+
+    def extend(self, arrows):
+        """矢印の辞書のリストをまとめて追加"""
+        records = np.array([self._to_record(arrow) for arrow in arrows], dtype=self.dtype)
+        if len(records):
+            self._records.extend(records)
+
+    def labeled(self):
+        """ラベル付きの矢印のマスク"""
+        return self.records['label'] != 0
+
+    def touching(self, name):
+        """行列に始点か終点がある矢印のマスク"""
+        sid = self.names.find(name)
+        records = self.records
+        if sid < 0:
+            return np.zeros(len(records), dtype=bool)
+        return (records['source'] == sid) | (records['target'] == sid)
+
+    def remove_matrix(self, name):
+        """行列に接続している矢印をすべて削除"""
+        mask = self.touching(name)
+        if mask.any():
+            self._records.delete(mask)
+            self._compact_if_sparse()
+
+    def rename_matrix(self, old_name, new_name):
+        """行列名の変更に合わせて始点と終点の行列の ID を付け替える"""
+        old_id = self.names.find(old_name)
+        if old_id < 0:
+            return
+        new_id = self.names.id(new_name)
+        records = self.records
+        for field in ('source', 'target'):
+            column = records[field]
+            column[column == old_id] = new_id
+        self._compact_if_sparse()
+
+    def _compact_if_sparse(self):
+        # 矢印1本が参照する文字列は高々5つ（行列名2つ・色・スタイル・ラベル）なので、それより64以上多ければ
+        # 使われていない文字列がある（表の大きさに比例した回数の操作ごとにしか起きないので償却 O(1)）
+        if len(self.names) + len(self.colors) + len(self.texts) <= 5 * len(self._records) + 64:
+            return
+        records = self.records
+        self.names.compact(records['source'], records['target'])
+        self.colors.compact(records['color'])
+        # ID 0 の空のラベルは「ラベルなし」の印なので残す
+        self.texts.compact(records['style'], records['label'], keep=[0])
+
+    def to_json(self):
+        """保存用に辞書のリストへ変換"""
+        records = self.records
+        names, texts = self.names.lookup, self.texts.lookup
+        return [{'source': [source, source_row, source_col], 'target': [target, target_row, target_col],
+                 'color': color, 'style': style, 'width': width, 'label': label}
+                for source, source_row, source_col, target, target_row, target_col, color, style, width, label
+                in zip(names(records['source']).tolist(), records['source_row'].tolist(),
+                       records['source_col'].tolist(), names(records['target']).tolist(),
+                       records['target_row'].tolist(), records['target_col'].tolist(),
+                       self.colors.lookup(records['color']).tolist(), texts(records['style']).tolist(),
+                       records['width'].tolist(), texts(records['label']).tolist())]
+
+class ExprNode:
+    """式の構文木のノード（不変で、構造が同じノードは等しく同じハッシュになる）"""
+
+    __slots__ = ('_hash',)
+
+    # 括弧を付けるかどうかの判定に使う結合の強さ
+    precedence = 5
+
+    def __init__(self, *key):
+        self._hash = hash((type(self).__name__,) + key)
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        return type(self) is type(other) and self._hash == other._hash and self.key() == other.key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return f"{type(self).__name__}({str(self)!r})"
+
+    def key(self):
+        """構造の比較に使う値のタプル"""
+        raise NotImplementedError
+
+    def children(self):
+        """子ノードのタプル"""
+        return ()
+
+    def walk(self):
+        """自分と子孫のノードを深さ優先（行きがけ順）で列挙する（再帰しない）"""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children()))
+
+    def names(self):
+        """式に現れる行列名を出現順に重複なしで返す"""
+        return list(dict.fromkeys(node.name for node in self.walk() if isinstance(node, NameNode)))
+
+    def _wrap(self, child, precedence):
+        text = str(child)
+        return f"({text})" if child.precedence < precedence else text
+
+class NameNode(ExprNode):
+    """行列名"""
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+        super().__init__(name)
+
+    def key(self):
+        return (self.name,)
+
+    def __str__(self):
+        return self.name
+
+class NumberNode(ExprNode):
+    """数値リテラル（text は入力どおりの表記）"""
+
+    __slots__ = ('text', 'value')
+
+    def __init__(self, text):
+        self.text = text
+        value = float(text)
+        self.value = int(value) if value.is_integer() and '.' not in text else value
+        super().__init__(text)
+
+    def key(self):
+        return (self.text,)
+
+    def __str__(self):
+        return self.text
+
+class CallNode(ExprNode):
+    """Det(...) / Tr(...) の呼び出し"""
+
+    __slots__ = ('func', 'arg')
+
+    def __init__(self, func, arg):
+        self.func = func
+        self.arg = arg
+        super().__init__(func, arg)
+
+    def key(self):
+        return (self.func, self.arg)
+
+    def children(self):
+        return (self.arg,)
+
+    def __str__(self):
+        return f"{self.func}({self.arg})"
+
+class NegateNode(ExprNode):
+    """単項マイナス"""
+
+    __slots__ = ('operand',)
+    precedence = 3
+
+    def __init__(self, operand):
+        self.operand = operand
+        super().__init__(operand)
+
+    def key(self):
+        return (self.operand,)
+
+    def children(self):
+        return (self.operand,)
+
+    def __str__(self):
+        return '-' + self._wrap(self.operand, self.precedence)
+
+class PowerNode(ExprNode):
+    """べき乗（右結合）"""
+
+    __slots__ = ('base', 'exponent')
+    precedence = 4
+
+    def __init__(self, base, exponent):
+        self.base = base
+        self.exponent = exponent
+        super().__init__(base, exponent)
+
+    def key(self):
+        return (self.base, self.exponent)
+
+    def children(self):
+        return (self.base, self.exponent)
+
+    def __str__(self):
+        return f"{self._wrap(self.base, self.precedence + 1)}^{self._wrap(self.exponent, self.precedence)}"
+
+class SumNode(ExprNode):
+    """加減算の列（terms は (符号 '+' / '-', ノード) のタプル、先頭の符号は常に '+'）"""
+
+    __slots__ = ('terms',)
+    precedence = 1
+
+    def __init__(self, terms):
+        self.terms = tuple(terms)
+        super().__init__(self.terms)
+
+    def key(self):
+        return (self.terms,)
+
+    def children(self):
+        return tuple(node for _, node in self.terms)
+
+    def __str__(self):
+        parts = [self._wrap(self.terms[0][1], self.precedence)]
+        for sign, node in self.terms[1:]:
+            parts.append(f" {sign} {self._wrap(node, self.precedence + 1)}")
+        return ''.join(parts)
+
+class ProductNode(ExprNode):
+    """行列積の列（結合則が成り立つので、連続する * は1つのノードにまとめる）"""
+
+    __slots__ = ('factors',)
+    precedence = 2
+
+    def __init__(self, factors):
+        self.factors = tuple(factors)
+        super().__init__(self.factors)
+
+    def key(self):
+        return (self.factors,)
+
+    def children(self):
+        return self.factors
+
+    def __str__(self):
+        return ' * '.join(self._wrap(node, self.precedence + 1) for node in self.factors)
+
+class ExpressionParser:
+    """行列の式の字句解析と優先順位法による構文解析（結果の構文木は式の文字列ごとに LRU キャッシュする）
+
+    優先順位は低い順に + -（左結合）、*（左結合）、単項 -、^（右結合）。
+    = は最上位でだけ使え、式を等式の各辺に分ける。
+    ノードは作るたびに共有の表で引き当て（ハッシュコンシング）、構造が同じ部分式は
+    等式の辺や別の式をまたいで同じオブジェクトになる。構文木は部分式を共有する DAG になり、
+    評価器は同じ部分式を1回だけ計算できる。
+    """
+
+    # 数値は後ろに名前の文字が続かないときだけ（"2A" は行列名）
+    TOKEN_PATTERN = re.compile(r'\s*(?:(?P<number>(?:\d+\.?\d*|\.\d+)(?![^\s+\-*^()=]))'
+                               r'|(?P<op>[-+*^()=])|(?P<name>[^\s+\-*^()=]+))')
+    # 二項演算子 -> (結合の強さ, 右結合か)
+    BINARY_OPERATORS = {'+': (1, False), '-': (1, False), '*': (2, False), '^': (4, True)}
+    UNARY_PRECEDENCE = 3
+    FUNCTIONS = ('Det', 'Tr')
+
+    def __init__(self, max_entries=256, max_nodes=100000):
+        self.max_entries = max_entries
+        self.max_nodes = max_nodes
+        self._trees = OrderedDict()
+        # ノード -> 共有するノード（多すぎたら空にする、以後の式と共有しなくなるだけ）
+        self._nodes = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._trees)
+
+    def parse(self, expr):
+        """式を解析して等式の各辺の構文木のタプルを返す（文法の誤りは位置つきの ValueError）"""
+        trees = self._trees.get(expr)
+        if trees is not None:
+            self._trees.move_to_end(expr)
+            self.hits += 1
+            return trees
+        self.misses += 1
+        if len(self._nodes) > self.max_nodes:
+            self._nodes.clear()
+        trees = self._parse_equation(self.tokenize(expr))
+        self._trees[expr] = trees
+        if len(self._trees) > self.max_entries:
+            self._trees.popitem(last=False)
+        return trees
+
+    def clear(self):
+        """キャッシュを空にする"""
+        self._trees.clear()
+        self._nodes.clear()
+
+    def stats(self):
+        """キャッシュの統計を文字列で返す"""
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0.0
+        return f"構文木 {len(self._trees)} 式分、部分式 {len(self._nodes)} 個 (ヒット率 {hit_rate:.1f}%)"
+
+    @classmethod
+    def tokenize(cls, expr):
+        """式を (種類, 文字列, 位置) のトークンのリストに分ける（種類は 'number' / 'op' / 'name'）"""
+        tokens = []
+        pos = 0
+        end = len(expr.rstrip())
+        match = cls.TOKEN_PATTERN.match
+        while pos < end:
+            m = match(expr, pos)
+            kind = m.lastgroup
+            tokens.append((kind, m.group(kind), m.start(kind)))
+            pos = m.end()
+        return tokens
+
+    def _parse_equation(self, tokens):
+        # 最上位の = で辺に分ける（括弧の中の = は各辺の解析で誤りになる）
+        bounds = []
+        depth = 0
+        for i, (kind, text, _) in enumerate(tokens):
+            if kind != 'op':
+                continue
+            if text == '(':
+                depth += 1
+            elif text == ')':
+                depth -= 1
+            elif text == '=' and depth <= 0:
+                bounds.append(i)
+        bounds.append(len(tokens))
+        parts = []
+        start = 0
+        for end in bounds:
+            # 空の辺（"A + B =" など）は読み飛ばす
+            if end > start:
+                parts.append(self._parse_part(tokens[start:end]))
+            start = end + 1
+        if not parts:
+            raise ValueError("式が空です")
+        return tuple(parts)
+
+    def _parse_part(self, tokens):
+        self._tokens = tokens
+        self._index = 0
+        try:
+            node = self._parse_binary(1)
+            if self._index < len(tokens):
+                self._error("余分な字句があります")
+        except RecursionError:
+            raise ValueError("式の括弧の入れ子が深すぎます") from None
+        finally:
+            self._tokens = None
+        return node
+
+    def _intern(self, node):
+        """構造が同じノードがすでにあればそれを返す（子は先に共有済みなので比較は子の数に比例する）"""
+        return self._nodes.setdefault(node, node)
+
+    def _peek(self):
+        if self._index < len(self._tokens):
+            return self._tokens[self._index]
+        return None
+
+    def _error(self, message, token=None):
+        token = token or self._peek()
+        if token is None:
+            raise ValueError(f"式の末尾: {message}")
+        raise ValueError(f"{token[2] + 1} 文字目 '{token[1]}': {message}")
+
+    def _expect(self, text):
+        token = self._peek()
+        if token is None or token[0] != 'op' or token[1] != text:
+            self._error(f"'{text}' が必要です")
+        self._index += 1
+
+    def _parse_binary(self, min_precedence):
+        left = self._parse_unary()
+        # 同じ強さの左結合の演算子の列はリストに集めて最後に1つのノードにする（長い式でも線形時間）
+        chain_op = None
+        chain = None
+        while True:
+            token = self._peek()
+            if token is None or token[0] != 'op' or token[1] not in self.BINARY_OPERATORS:
+                break
+            op = token[1]
+            precedence, right_assoc = self.BINARY_OPERATORS[op]
+            if precedence < min_precedence:
+                break
+            self._index += 1
+            right = self._parse_binary(precedence if right_assoc else precedence + 1)
+            kind = '*' if op == '*' else '+' if op in '+-' else op
+            if kind != chain_op:
+                left = self._finish_chain(chain_op, chain, left)
+                chain_op, chain = kind, None
+            if kind == '^':
+                left = self._intern(PowerNode(left, right))
+                chain_op = None
+            elif kind == '*':
+                chain = chain or [left]
+                chain.append(right)
+            else:
+                chain = chain or [('+', left)]
+                chain.append((op, right))
+        return self._finish_chain(chain_op, chain, left)
+
+    def _finish_chain(self, chain_op, chain, left):
+        if not chain:
+            return left
+        return self._intern(ProductNode(chain) if chain_op == '*' else SumNode(chain))
+
+    def _parse_unary(self):
+        token = self._peek()
+        if token is not None and token[0] == 'op' and token[1] == '-':
+            self._index += 1
+            return self._intern(NegateNode(self._parse_binary(self.UNARY_PRECEDENCE)))
+        if token is not None and token[0] == 'op' and token[1] == '+':
+            self._index += 1
+            return self._parse_binary(self.UNARY_PRECEDENCE)
+        return self._parse_primary()
+
+    def _parse_primary(self):
+        token = self._peek()
+        if token is None:
+            self._error("項が必要です")
+        kind, text, _ = token
+        self._index += 1
+        if kind == 'name' and text in self.FUNCTIONS:
+            self._expect('(')
+            arg = self._parse_binary(1)
+            self._expect(')')
+            return self._intern(CallNode(text, arg))
+        if kind != 'op':
+            return self._intern(NumberNode(text) if kind == 'number' else NameNode(text))
+        if text == '(':
+            node = self._parse_binary(1)
+            self._expect(')')
+            return node
+        self._error("項が必要です", token)
+
+# 解析済みの式はアプリ全体で共有する
+expression_parser = ExpressionParser()
+
+def value_shape(value):
+    """評価した値の形（スカラーは ()）"""
+    return getattr(value, 'shape', ())
+
+def value_nbytes(value):
+    """評価した値が使うおおよそのバイト数（疎行列は CSR の3つの配列の合計）"""
+    if is_sparse(value):
+        value = value.tocsr()
+        return value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+    return getattr(value, 'nbytes', 0)
+
+def matmul_bound(left, right):
+    """行列積の要素の絶対値の上限
+
+    (i, j) 要素の絶対値は 左の i 行の絶対値の和 × 右の要素の絶対値の最大 を超えず、
+    左の要素の絶対値の最大 × 右の j 列の絶対値の和 も超えないので、小さいほうを返す。
+    整数の行列積が桁あふれしないかを、積を計算する前に確かめるのに使う。
+    """
+    left, right = abs(left.astype(np.float64)), abs(right.astype(np.float64))
+    if not left.shape[0] * left.shape[1] or not right.shape[0] * right.shape[1]:
+        return 0.0
+    left_rows = np.asarray(left.sum(axis=1)).max()
+    right_cols = np.asarray(right.sum(axis=0)).max()
+    return float(min(left_rows * right.max(), left.max() * right_cols))
+
+def matrix_chain_order(dims):
+    """行列の連鎖積の最適な括弧付けを動的計画法で求める
+
+    dims は n 個の行列の形を並べた n+1 個の次元（i 番目の行列は dims[i]×dims[i+1]）。
+    (最小の乗算回数, 分割表) を返し、分割表の [i, j] は i..j 番目の積を分ける位置 k
+    （(i..k) と (k+1..j) の積に分ける）。内側の k の最小化は NumPy でまとめて行う。
+    """
+    n = len(dims) - 1
+    p = np.asarray(dims, dtype=np.float64)
+    cost = np.zeros((n, n))
+    split = np.zeros((n, n), dtype=np.int64)
+    for length in range(1, n):
+        for i in range(n - length):
+            j = i + length
+            candidates = cost[i, i:j] + cost[i + 1:j + 1, j] + p[i] * p[i + 1:j + 1] * p[j + 1]
+            # 同じ回数なら後ろで分ける（左から順に掛ける順を優先する）
+            best = len(candidates) - 1 - int(np.argmin(candidates[::-1]))
+            cost[i, j] = candidates[best]
+            split[i, j] = i + best
+    return cost[0, n - 1], split
+
+def chain_order_text(labels, split):
+    """分割表のとおりに括弧を付けた積の式の文字列（一番外側の括弧は付けない）"""
+    n = len(labels)
+    texts = {}
+    stack = [(0, n - 1)]
+    while stack:
+        i, j = stack[-1]
+        if i == j:
+            texts[i, j] = labels[i]
+            stack.pop()
+            continue
+        k = split[i, j]
+        pending = [part for part in ((i, k), (k + 1, j)) if part not in texts]
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
+        texts[i, j] = f"({texts.pop((i, k))} * {texts.pop((k + 1, j))})"
+    text = texts[0, n - 1]
+    return text[1:-1] if n > 1 else text
+
+class ExpressionEvaluator:
+    """式の構文木を NumPy で評価する（部分式の結果は、使った行列のバージョンの組ごとに LRU キャッシュする）
+
+    行列は NumPy の配列か疎行列、数値と Det / Tr の結果はスカラーになる。
+    行列のバージョンはすべての行列で共通のカウンタから取るので、式に現れない行列を
+    編集しても結果は無効にならず、同じ式の再評価はキャッシュから返る。
+    キャッシュは結果の合計バイト数の予算を超えたら古いものから捨てる。
+    evaluate_all で等式の辺をまとめて評価するときは、その間だけ部分式の値を別に覚えておき、
+    キャッシュから追い出されても同じ部分式（構文木の DAG で共有されたノード）は1回だけ計算する。
+    """
+
+    def __init__(self, budget_bytes=256 * 1024 * 1024):
+        self.budget_bytes = budget_bytes
+        # (ノード, 行列のバージョンの組) -> (値, バイト数)
+        self._results = OrderedDict()
+        self._bytes = 0
+        # ノード -> 式に現れる行列名のタプル（葉以外）と、ノードごとのキャッシュの件数
+        # （件数が0になったらノードの情報も捨てるので、キャッシュと一緒に予算内に収まる）
+        self._dependencies = {}
+        self._node_entries = {}
+        # evaluate_all の間だけ使う ノード -> 値 の表と、そこから返した部分式の数
+        self._shared = None
+        self.shared_hits = 0
+        # evaluate_all の間に桁あふれを避けて昇格した型 {(元の型, 昇格した型)}
+        self.promotions = set()
+        # 積のノード -> 最後に計算したときの積の順序 (括弧付きの式, 左から順の FLOP, 選んだ順の FLOP)
+        self.chain_plans = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._results)
+
+    @property
+    def nbytes(self):
+        """キャッシュしている結果の合計バイト数"""
+        return self._bytes
+
+    def clear(self):
+        """キャッシュを空にする"""
+        self._results.clear()
+        self._bytes = 0
+        self._dependencies.clear()
+        self._node_entries.clear()
+        self.chain_plans.clear()
+
+    def stats(self):
+        """キャッシュの統計を文字列で返す"""
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0.0
+        return (f"評価結果 {len(self._results)} 件 {self._bytes / (1024 * 1024):.1f} MB "
+                f"(ヒット率 {hit_rate:.1f}%)")
+
+    def dependencies(self, node):
+        """ノードの式に現れる行列名のタプル（子の結果を合わせて求め、葉以外のノードごとに覚えておく）"""
+        if isinstance(node, NameNode):
+            return (node.name,)
+        if isinstance(node, NumberNode):
+            return ()
+        names = self._dependencies.get(node)
+        if names is None:
+            names = tuple(dict.fromkeys(name for child in node.children() for name in self.dependencies(child)))
+            self._dependencies[node] = names
+        return names
+
+    def evaluate_all(self, trees, matrices):
+        """等式の各辺を評価し、辺ごとに値か ValueError を並べたリストを返す（共通の部分式は1回だけ計算する）"""
+        self._shared = {}
+        self.shared_hits = 0
+        self.promotions = set()
+        results = []
+        try:
+            for tree in trees:
+                try:
+                    results.append(self.evaluate(tree, matrices))
+                except ValueError as e:
+                    results.append(e)
+                except ArithmeticError as e:
+                    # スカラーの計算の桁あふれなども式の誤りとして返す
+                    results.append(ValueError(f"{tree}: 計算できません ({e})"))
+        finally:
+            self._shared = None
+        return results
+
+    def evaluate(self, node, matrices):
+        """ノードの値を返す（式の誤りは ValueError）"""
+        if isinstance(node, NameNode):
+            matrix = matrices.get(node.name)
+            if matrix is None:
+                raise ValueError(f"行列 '{node.name}' が定義されていません")
+            values = matrix.values
+            return np.asarray(values) if isinstance(values, MappedArray) else values
+        if isinstance(node, NumberNode):
+            return node.value
+        try:
+            key = (node, tuple(matrices[name].version for name in self.dependencies(node)))
+        except KeyError as e:
+            raise ValueError(f"行列 '{e.args[0]}' が定義されていません") from None
+        shared = self._shared
+        if shared is not None and key in shared:
+            self.shared_hits += 1
+            return shared[key]
+        entry = self._results.get(key)
+        if entry is not None:
+            self._results.move_to_end(key)
+            self.hits += 1
+            value = entry[0]
+        else:
+            self.misses += 1
+            value = self._compute(node, matrices)
+            self._put(key, value)
+        if shared is not None:
+            shared[key] = value
+        return value
+
+    def _put(self, key, value):
+        # キーの先頭は常にノード（べき乗の2乗の列は底のノード）
+        nbytes = value_nbytes(value)
+        self._results[key] = (value, nbytes)
+        self._bytes += nbytes
+        self._node_entries[key[0]] = self._node_entries.get(key[0], 0) + 1
+        # 予算を超えたら古いものから捨てる（直前に入れた結果は残す）
+        while self._bytes > self.budget_bytes and len(self._results) > 1:
+            evicted_key, (_, evicted) = self._results.popitem(last=False)
+            self._bytes -= evicted
+            self._release(evicted_key[0])
+
+    def _release(self, node):
+        """ノードのキャッシュが1件減り、なくなったらそのノードの依存と積の順序も捨てる"""
+        count = self._node_entries[node] - 1
+        if count:
+            self._node_entries[node] = count
+            return
+        del self._node_entries[node]
+        self._dependencies.pop(node, None)
+        self.chain_plans.pop(node, None)
+
+    def _compute(self, node, matrices):
+        if isinstance(node, NegateNode):
+            return -self.evaluate(node.operand, matrices)
+        if isinstance(node, SumNode):
+            terms = iter(node.terms)
+            value = self.evaluate(next(terms)[1], matrices)
+            for sign, term in terms:
+                value = self._add(value, self.evaluate(term, matrices), sign, node)
+            return value
+        if isinstance(node, ProductNode):
+            return self._chain_product(node, [self.evaluate(factor, matrices) for factor in node.factors])
+        if isinstance(node, PowerNode):
+            return self._power(node, matrices)
+        if isinstance(node, CallNode):
+            value = self.evaluate(node.arg, matrices)
+            shape = value_shape(value)
+            if not shape:
+                return value
+            if node.func == 'Det':
+                if shape[0] != shape[1]:
+                    raise ValueError(f"{node}: 行列式は正方行列でのみ定義されます")
+                return matrix_determinant(value)
+            return matrix_trace(value)
+        raise ValueError(f"評価できない式です: {node}")
+
+    @staticmethod
+    def _add(left, right, sign, node):
+        left_shape, right_shape = value_shape(left), value_shape(right)
+        if left_shape and right_shape:
+            try:
+                np.broadcast_shapes(left_shape, right_shape)
+            except ValueError:
+                raise ValueError(f"{node}: 行列のサイズが一致しません "
+                                 f"({left_shape[0]}×{left_shape[1]} と {right_shape[0]}×{right_shape[1]})") from None
+        elif is_sparse(left) or is_sparse(right):
+            # 疎行列とスカラーの和は密になる
+            left, right = dense_values(left), dense_values(right)
+        return combine_values(left, right, sign)
+
+    def _chain_product(self, node, values):
+        """積の列を計算する（スカラーは最後にまとめて掛け、行列は連鎖積の最適な順に掛ける）"""
+        scalars = [value for value in values if not value_shape(value)]
+        factors = [(factor, value) for factor, value in zip(node.factors, values) if value_shape(value)]
+        for (left, left_value), (right, right_value) in zip(factors, factors[1:]):
+            left_shape, right_shape = left_value.shape, right_value.shape
+            if left_shape[1] != right_shape[0]:
+                raise ValueError(f"{node}: 行列乗算の条件を満たしません ({left} が {left_shape[0]}×{left_shape[1]}、"
+                                 f"{right} が {right_shape[0]}×{right_shape[1]})")
+        
+        if len(factors) >= 3:
+            # 次元の並びから最適な括弧付けを求め、左から順に掛けたときと比べた見積もりを残す
+            # （FLOP は密な行列の積 p×q と q×r で 2pqr として見積もる）
+            dims = [value.shape[0] for _, value in factors] + [factors[-1][1].shape[1]]
+            optimal, split = matrix_chain_order(dims)
+            left_to_right = sum(dims[0] * dims[k] * dims[k + 1] for k in range(1, len(factors)))
+            order = chain_order_text([node._wrap(factor, node.precedence + 1) for factor, _ in factors], split)
+            self.chain_plans[node] = (order, 2 * float(left_to_right), 2 * float(optimal))
+            value = self._multiply_in_order([value for _, value in factors], split)
+        elif len(factors) == 2:
+            value = self._matmul(factors[0][1], factors[1][1])
+        elif factors:
+            value = factors[0][1]
+        else:
+            value = 1
+        
+        for scalar in scalars:
+            value = scalar * value
+        return value
+
+    def _multiply_in_order(self, values, split):
+        """分割表の順に行列を掛ける（途中の積は使い終わったら捨てる）"""
+        n = len(values)
+        products = {}
+        stack = [(0, n - 1)]
+        while stack:
+            i, j = stack[-1]
+            if i == j:
+                products[i, j] = values[i]
+                stack.pop()
+                continue
+            k = split[i, j]
+            pending = [part for part in ((i, k), (k + 1, j)) if part not in products]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            products[i, j] = self._matmul(products.pop((i, k)), products.pop((k + 1, j)))
+        return products[0, n - 1]
+
+    def _matmul(self, left, right):
+        """行列積（整数の行列は桁あふれしないかを先に見積もり、必要なら広い整数か float に昇格する）"""
+        dtype = np.result_type(left.dtype, right.dtype)
+        if dtype.kind not in 'iu':
+            return combine_values(left, right, '*')
+        bound = matmul_bound(left, right)
+        if bound <= np.iinfo(dtype).max:
+            return combine_values(left, right, '*')
+        # float64 の見積もりの丸め誤差を見込んで、int64 の上限より少し手前で float にする
+        wider = np.dtype(np.int64) if bound < 2.0 ** 62 else np.dtype(np.float64)
+        self.promotions.add((str(dtype), str(wider)))
+        return combine_values(left.astype(wider), right.astype(wider), '*')
+
+    def _power(self, node, matrices):
+        """べき乗を繰り返し2乗法で計算する（A^2, A^4, ... は底の行列のバージョンごとにキャッシュする）"""
+        base = self.evaluate(node.base, matrices)
+        exponent = self.evaluate(node.exponent, matrices)
+        # 指数は整数のスカラー（1x1 の行列も可）
+        if value_shape(exponent) == (1, 1):
+            exponent = dense_values(exponent)[0, 0]
+        if value_shape(exponent) or not float(exponent).is_integer():
+            raise ValueError(f"{node}: 指数は整数である必要があります")
+        exponent = int(exponent)
+        shape = value_shape(base)
+        if not shape:
+            if exponent >= 0:
+                dtype = np.result_type(base)
+                if dtype.kind in 'iu' and abs(int(base)) > 1:
+                    # 整数のべき乗も桁あふれしないかを底の桁数から先に見積もり、行列積と同じ規則で昇格する
+                    bits = exponent * math.log2(abs(int(base)))
+                    if bits >= math.log2(np.iinfo(dtype).max):
+                        wider = np.dtype(np.int64) if bits < 62 else np.dtype(np.float64)
+                        self.promotions.add((str(dtype), str(wider)))
+                        base = wider.type(base)
+                return base ** exponent
+            if base == 0:
+                raise ValueError(f"{node}: 0 の負のべき乗は定義されません")
+            return float(base) ** exponent
+        if shape[0] != shape[1]:
+            raise ValueError(f"{node}: べき乗は正方行列でのみ有効です")
+        if exponent == 0:
+            if is_sparse(base):
+                return sparse.eye_array(shape[0], dtype=base.dtype, format='csr')
+            return np.eye(shape[0], dtype=base.dtype)
+        
+        # 2乗の列のキャッシュのキー（底の式と、底に現れる行列のバージョンの組）
+        base_key = (node.base, tuple(matrices[name].version for name in self.dependencies(node.base)))
+        if exponent < 0:
+            # 負の指数は逆行列の正のべき乗
+            base = self._cached_power(base_key + ('inverse',), lambda: self._inverse(base, node))
+            base_key += ('inverse',)
+            exponent = -exponent
+        
+        # 指数の2進表現の立っているビットの 2^k 乗を掛け合わせる
+        result = None
+        square = base
+        k = 0
+        while True:
+            if exponent & 1:
+                result = square if result is None else self._matmul(result, square)
+            exponent >>= 1
+            if not exponent:
+                return result
+            k += 1
+            previous = square
+            square = self._cached_power(base_key + ('square', k), lambda: self._matmul(previous, previous))
+
+    def _cached_power(self, key, compute):
+        """べき乗の途中の結果を評価結果と同じ LRU キャッシュ（バイト数の予算つき）から返す"""
+        entry = self._results.get(key)
+        if entry is not None:
+            self._results.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        value = compute()
+        self._put(key, value)
+        return value
+
+    @staticmethod
+    def _inverse(base, node):
+        try:
+            return np.linalg.inv(dense_values(base))
+        except np.linalg.LinAlgError:
+            raise ValueError(f"{node}: 特異行列のため逆行列がありません") from None
+
+class CellLabelCache:
+    """行列ごとのセルのラベル文字列のキャッシュ（行列のバージョンが変わったら作り直す）"""
+
+    def __init__(self):
+        # 行列名 -> (バージョン, ラベルの配列)
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def labels(self, name, matrix):
+        """行列のセルのラベルを値と同じ形の文字列の配列で返す"""
+        entry = self._entries.get(name)
+        if entry is not None and entry[0] == matrix.version:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        labels = format_cell_labels(matrix.values)
+        self._entries[name] = (matrix.version, labels)
+        return labels
+
+    def update_cell(self, name, matrix, row, col, previous_version):
+        """1つのセルの値が変わったとき、変更前のバージョンのキャッシュがあればそのラベルだけを作り直す"""
+        entry = self._entries.get(name)
+        if entry is None or entry[0] != previous_version:
+            return
+        labels = entry[1]
+        text = format_cell_value(matrix.values[row, col])
+        if len(text) > labels.dtype.itemsize // 4:
+            # 固定長の文字列配列に収まらなければ幅を広げる
+            labels = labels.astype(f'<U{len(text)}')
+        labels[row, col] = text
+        self._entries[name] = (matrix.version, labels)
+
+    def discard(self, name):
+        """行列のキャッシュを捨てる"""
+        self._entries.pop(name, None)
+
+    def prune(self, names):
+        """names にない行列のキャッシュを捨てる"""
+        for name in [name for name in self._entries if name not in names]:
+            del self._entries[name]
+
+    def stats(self):
+        """キャッシュの統計を文字列で返す"""
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0.0
+        return f"ラベル {len(self._entries)} 行列分 (ヒット率 {hit_rate:.1f}%)"
+
+class SpatialGridIndex:
+    """一様グリッドによる矩形の空間インデックス（点の当たり判定用）"""
+
+    def __init__(self, cell_size=16.0, max_cells=256):
+        self.cell_size = cell_size
+        # これより多くのグリッドセルにまたがる矩形は別リストで管理する
+        self.max_cells = max_cells
+        self._bounds = {}
+        self._buckets = {}
+        self._large = set()
+
+    def __len__(self):
+        return len(self._bounds)
+
+    def keys(self):
+        """登録されているキーの一覧"""
+        return list(self._bounds)
+
+    def clear(self):
+        """すべての要素を削除"""
+        self._bounds = {}
+        self._buckets = {}
+        self._large = set()
+
+    def _grid_range(self, bounds):
+        x0, y0, x1, y1 = bounds
+        return (math.floor(x0 / self.cell_size), math.floor(y0 / self.cell_size),
+                math.floor(x1 / self.cell_size), math.floor(y1 / self.cell_size))
+
+    def insert(self, key, bounds):
+        """矩形 (x0, y0, x1, y1) を登録（既存のキーは置き換え）"""
+        self.remove(key)
+        self._bounds[key] = bounds
+        gx0, gy0, gx1, gy1 = self._grid_range(bounds)
+        if (gx1 - gx0 + 1) * (gy1 - gy0 + 1) > self.max_cells:
+            self._large.add(key)
+            return
+        for gx in range(gx0, gx1 + 1):
+            for gy in range(gy0, gy1 + 1):
+                self._buckets.setdefault((gx, gy), set()).add(key)
+
+    def remove(self, key):
+        """キーを削除（存在しなければ何もしない）"""
+        bounds = self._bounds.pop(key, None)
+        if bounds is None:
+            return
+        if key in self._large:
+            self._large.discard(key)
+            return
+        gx0, gy0, gx1, gy1 = self._grid_range(bounds)
+        for gx in range(gx0, gx1 + 1):
+            for gy in range(gy0, gy1 + 1):
+                bucket = self._buckets.get((gx, gy))
+                if bucket is not None:
+                    bucket.discard(key)
+                    if not bucket:
+                        del self._buckets[(gx, gy)]
+
+    def query_point(self, x, y):
+        """点 (x, y) を含む矩形のキーを返す"""
+        cell = (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+        hits = []
+        for key in list(self._buckets.get(cell, ())) + list(self._large):
+            x0, y0, x1, y1 = self._bounds[key]
+            if x0 <= x < x1 and y0 <= y < y1:
+                hits.append(key)
+        return hits
+
+    def query_rect(self, x_min, y_min, x_max, y_max):
+        """矩形 (x_min, y_min, x_max, y_max) と重なる矩形のキーを返す"""
+        gx0, gy0, gx1, gy1 = self._grid_range((x_min, y_min, x_max, y_max))
+        if (gx1 - gx0 + 1) * (gy1 - gy0 + 1) > len(self._buckets):
+            # 広い範囲ならグリッドを辿るより全件を調べる方が速い
+            candidates = self._bounds
+        else:
+            candidates = set(self._large)
+            for gx in range(gx0, gx1 + 1):
+                for gy in range(gy0, gy1 + 1):
+                    candidates.update(self._buckets.get((gx, gy), ()))
+        hits = []
+        for key in candidates:
+            x0, y0, x1, y1 = self._bounds[key]
+            if x0 < x_max and x_min < x1 and y0 < y_max and y_min < y1:
+                hits.append(key)
+        return hits
+
+class CellTextCollection(Artist):
+    """多数のセルラベルを1つのアーティストでまとめて描画する"""
+
+    def __init__(self, positions, texts, colors='black', fontsize=12, fontweight='normal', **kwargs):
+        # colors は単一の色名、または (N, 4) の RGBA 配列
+        super().__init__()
+        self._positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        self._texts = list(texts)
+        self._colors = colors
+        self._internal_update(kwargs)
+        self._fontprops = fm.FontProperties(size=fontsize, weight=fontweight)
+        # 文字列ごとの寸法キャッシュ（DPI が変わると無効）
+        self._extent_cache = {}
+        self._extent_dpi = None
+
+    def set_data(self, positions, texts, colors=None):
+        """ラベルの位置・文字列・色をまとめて差し替える"""
+        self._positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        self._texts = list(texts)
+        if colors is not None:
+            self._colors = colors
+        self.stale = True
+
+    def set_text(self, index, text):
+        """1つのラベルの文字列だけを差し替える"""
+        self._texts[index] = text
+        self.stale = True
+
+    def _text_extent(self, renderer, text):
+        """文字列の幅と高さ・ディセントを取得（キャッシュ付き）"""
+        if self._extent_dpi != renderer.dpi:
+            self._extent_cache = {}
+            self._extent_dpi = renderer.dpi
+        extent = self._extent_cache.get(text)
+        if extent is None:
+            extent = renderer.get_text_width_height_descent(text, self._fontprops, ismath=False)
+            self._extent_cache[text] = extent
+        return extent
+
+    def get_window_extent(self, renderer=None):
+        if not len(self._positions):
+            return Bbox.null()
+        display = self.get_transform().transform(self._positions)
+        return Bbox.from_extents(*display.min(axis=0), *display.max(axis=0))
+
+    def draw(self, renderer):
+        if not self.get_visible() or not len(self._texts):
+            return
+
+        renderer.open_group('cell_texts', self.get_gid())
+
+        # 位置はまとめて表示座標に変換
+        display = self.get_transform().transform(self._positions)
+        canvasw, canvash = renderer.get_canvas_width_height()
+
+        # 縦方向の中央揃えは "lp" の寸法で統一する（Text と同じ基準）
+        _, line_h, line_d = self._text_extent(renderer, "lp")
+        baseline_offset = line_h / 2 - line_d
+
+        gc = renderer.new_gc()
+        gc.set_alpha(self.get_alpha())
+        gc.set_url(self.get_url())
+        self._set_gc_clip(gc)
+
+        per_label_colors = not isinstance(self._colors, str)
+        if not per_label_colors:
+            gc.set_foreground(color_registry.rgba(self._colors), isRGBA=True)
+
+        for k, text in enumerate(self._texts):
+            if not text:
+                continue
+            if per_label_colors:
+                gc.set_foreground(self._colors[k], isRGBA=True)
+            width, _, _ = self._text_extent(renderer, text)
+            x = display[k, 0] - width / 2
+            y = display[k, 1] - baseline_offset
+            if renderer.flipy():
+                y = canvash - y
+            renderer.draw_text(gc, x, y, text, self._fontprops, 0, ismath=False)
+
+        gc.restore()
+        renderer.close_group('cell_texts')
+        self.stale = False
+
+class ArrowCollection(Artist):
+    """多数の矢印を線のコレクションと矢じりのコレクションでまとめて描画する"""
+
+    # 寸法はポイント単位（annotate の既定の mutation_scale=10 に合わせる）
+    head_length = 4.0
+    head_width = 2.0
+    bracket_width = 10.0
+    bracket_length = 2.0
+    shrink = 2.0
+    # 湾曲した矢印を近似する線分の数
+    n_segments = 16
+
+    def __init__(self, rad=0.1, alpha=0.8, **kwargs):
+        super().__init__()
+        self._rad = rad
+        self._arrow_alpha = alpha
+        # 描画用の配列（始点・終点はデータ座標、色は RGBA）
+        self._arrays = self._pack([], [], [], [], [])
+        self._lines = LineCollection([], capstyle='butt', joinstyle='round', transform=IdentityTransform())
+        self._heads = PolyCollection([], transform=IdentityTransform())
+        self._internal_update(kwargs)
+
+    def __len__(self):
+        return len(self._arrays['widths'])
+
+    def set_figure(self, fig):
+        super().set_figure(fig)
+        self._lines.set_figure(fig)
+        self._heads.set_figure(fig)
+
+    def _pack(self, starts, ends, styles, colors, widths):
+        """矢印の属性を NumPy 配列にまとめる"""
+        n = len(widths)
+        return {
+            'starts': np.asarray(starts, dtype=float).reshape(n, 2),
+            'ends': np.asarray(ends, dtype=float).reshape(n, 2),
+            'styles': np.asarray(styles, dtype=object).astype(str).reshape(n),
+            'colors': colors_to_rgba(colors, alpha=self._arrow_alpha).reshape(n, 4),
+            'widths': np.asarray(widths, dtype=float).reshape(n)
+        }
+
+    def set_arrows(self, starts, ends, styles, colors, widths):
+        """矢印をまとめて差し替える（始点・終点はデータ座標、配列でもリストでもよい）"""
+        self._arrays = self._pack(starts, ends, styles, colors, widths)
+        self.stale = True
+
+    def append_arrow(self, start, end, style, color, width):
+        """矢印を1本追加"""
+        arrow = self._pack([start], [end], [style], [color], [width])
+        self._arrays = {key: np.concatenate([self._arrays[key], arrow[key]]) for key in arrow}
+        self.stale = True
+
+    def _curves(self, p0, p2, pad0, pad1):
+        """arc3 の2次ベジェ曲線を表示座標で折れ線に近似し、終端の向きも返す"""
+        dx = p2[:, 0] - p0[:, 0]
+        dy = p2[:, 1] - p0[:, 1]
+        # arc3: 中点から弦に垂直な方向へ rad * 弦の長さだけずらした制御点
+        control = np.column_stack([(p0[:, 0] + p2[:, 0]) / 2 + self._rad * dy,
+                                   (p0[:, 1] + p2[:, 1]) / 2 - self._rad * dx])
+        
+        # 両端の余白は弦の長さに対する比率で近似する
+        chord = np.maximum(np.hypot(dx, dy), 1e-9)
+        t0 = np.clip(pad0 / chord, 0.0, 0.5)
+        t1 = np.clip(1.0 - pad1 / chord, 0.5, 1.0)
+        
+        s = np.linspace(0.0, 1.0, self.n_segments + 1)
+        t = t0[:, None] + (t1 - t0)[:, None] * s[None, :]
+        a = ((1 - t) ** 2)[..., None]
+        b = (2 * (1 - t) * t)[..., None]
+        c = (t ** 2)[..., None]
+        points = a * p0[:, None, :] + b * control[:, None, :] + c * p2[:, None, :]
+        
+        # 両端での接線方向（単位ベクトル、曲線の外向き）
+        def tangent(tt, sign):
+            d = 2 * (1 - tt)[:, None] * (control - p0) + 2 * tt[:, None] * (p2 - control)
+            d = d * sign
+            return d / np.maximum(np.hypot(d[:, 0], d[:, 1]), 1e-9)[:, None]
+        
+        return points, tangent(t0, -1.0), tangent(t1, 1.0)
+
+    def draw(self, renderer):
+        if not self.get_visible() or not len(self):
+            return
+        
+        arrays = self._arrays
+        starts = arrays['starts']
+        ends = arrays['ends']
+        styles = arrays['styles']
+        colors = arrays['colors']
+        widths = arrays['widths']
+        
+        # 表示範囲と交わらない矢印は形状の計算の前に除く
+        # （湾曲分は弦の長さの rad 倍、矢じりの分は1セル程度の余白を取る）
+        if self.axes is not None:
+            view = self.axes.viewLim
+            margin = abs(self._rad) * np.hypot(*(ends - starts).T) + 1.0
+            on_screen = ((np.minimum(starts[:, 0], ends[:, 0]) - margin < max(view.x0, view.x1)) &
+                         (np.maximum(starts[:, 0], ends[:, 0]) + margin > min(view.x0, view.x1)) &
+                         (np.minimum(starts[:, 1], ends[:, 1]) - margin < max(view.y0, view.y1)) &
+                         (np.maximum(starts[:, 1], ends[:, 1]) + margin > min(view.y0, view.y1)))
+            if not on_screen.all():
+                if not on_screen.any():
+                    self.stale = False
+                    return
+                starts, ends = starts[on_screen], ends[on_screen]
+                styles, colors, widths = styles[on_screen], colors[on_screen], widths[on_screen]
+        
+        transform = self.get_transform()
+        p0 = transform.transform(starts)
+        p2 = transform.transform(ends)
+        
+        px = renderer.points_to_pixels(1.0)
+        shrink = self.shrink * px
+        head_length = self.head_length * px
+        head_width = self.head_width * px
+        
+        filled_end = np.isin(styles, ('-|>', '<-|>'))
+        filled_start = styles == '<-|>'
+        open_end = np.isin(styles, ('->>', '<->'))
+        open_start = styles == '<->'
+        
+        # 塗りつぶしの矢じりがある側は線を矢じりの根元で止める
+        pad0 = shrink + np.where(filled_start, head_length, 0.0)
+        pad1 = shrink + np.where(filled_end, head_length, 0.0)
+        points, dir0, dir1 = self._curves(p0, p2, pad0, pad1)
+        tip0 = points[:, 0] + dir0 * np.where(filled_start, head_length, 0.0)[:, None]
+        tip1 = points[:, -1] + dir1 * np.where(filled_end, head_length, 0.0)[:, None]
+        
+        segments = list(points)
+        segment_colors = [colors]
+        segment_widths = [widths]
+        polygons = []
+        polygon_colors = []
+        polygon_widths = []
+        
+        # 矢じりはスタイルごとにまとめて計算する
+        for mask, tip, direction, kind in (
+                (filled_end, tip1, dir1, 'filled'), (filled_start, tip0, dir0, 'filled'),
+                (open_end, tip1, dir1, 'open'), (open_start, tip0, dir0, 'open'),
+                (styles == '-[', tip1, dir1, 'bracket'), (styles == '-|', tip1, dir1, 'bar')):
+            if not mask.any():
+                continue
+            tip = tip[mask]
+            u = direction[mask]
+            n = np.column_stack([-u[:, 1], u[:, 0]])
+            if kind == 'filled' or kind == 'open':
+                base = tip - u * head_length
+                shape = np.stack([base + n * head_width, tip, base - n * head_width], axis=1)
+            elif kind == 'bracket':
+                w = self.bracket_width * px
+                l = self.bracket_length * px
+                shape = np.stack([tip + n * w + u * l, tip + n * w, tip - n * w, tip - n * w + u * l], axis=1)
+            else:
+                w = self.bracket_width * px
+                shape = np.stack([tip + n * w, tip - n * w], axis=1)
+            
+            if kind == 'filled':
+                polygons.extend(shape)
+                polygon_colors.append(colors[mask])
+                polygon_widths.append(widths[mask])
+            else:
+                segments.extend(shape)
+                segment_colors.append(colors[mask])
+                segment_widths.append(widths[mask])
+        
+        renderer.open_group('arrows', self.get_gid())
+        for child, paths, child_colors, child_widths in (
+                (self._lines, segments, segment_colors, segment_widths),
+                (self._heads, polygons, polygon_colors, polygon_widths)):
+            if not paths:
+                continue
+            if child is self._lines:
+                child.set_segments(paths)
+                child.set_color(np.concatenate(child_colors))
+            else:
+                child.set_verts(paths)
+                child.set_facecolor(np.concatenate(child_colors))
+                child.set_edgecolor(np.concatenate(child_colors))
+            child.set_linewidth(np.concatenate(child_widths))
+            child.set_clip_on(self.get_clip_on())
+            child.set_clip_box(self.get_clip_box())
+            child.set_clip_path(self.get_clip_path())
+            child.draw(renderer)
+        renderer.close_group('arrows')
+        self.stale = False
+
+class TileCache:
+    """ラスタライズ済みタイルの LRU キャッシュ（メモリ予算付き、生成はバックグラウンドスレッド）"""
+
+    def __init__(self, budget_bytes=256 * 1024 * 1024, background=True):
+        self.budget_bytes = budget_bytes
+        self._tiles = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._completed = []
+        # レイヤー -> 有効な世代（生成中に世代が変わったり捨てられたりしたタイルは、完成しても入れない）
+        self._generations = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tiles') if background else None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._tiles)
+
+    @property
+    def nbytes(self):
+        """キャッシュしているタイルの合計バイト数"""
+        return self._bytes
+
+    def get(self, key):
+        """タイルを返す（なければ None）"""
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is None:
+                self.misses += 1
+                return None
+            self._tiles.move_to_end(key)
+            self.hits += 1
+            return tile
+
+    def _put_locked(self, key, tile):
+        old = self._tiles.pop(key, None)
+        if old is not None:
+            self._bytes -= old.nbytes
+        self._tiles[key] = tile
+        self._bytes += tile.nbytes
+        # 予算を超えたら古いものから捨てる（直前に入れたタイルは残す）
+        while self._bytes > self.budget_bytes and len(self._tiles) > 1:
+            _, evicted = self._tiles.popitem(last=False)
+            self._bytes -= evicted.nbytes
+
+    def request(self, key, func, *args, blocking=False):
+        """タイルの生成を依頼する（blocking なら生成して返す、そうでなければ None）"""
+        if self._executor is None or blocking:
+            tile = func(*args)
+            with self._lock:
+                self._put_locked(key, tile)
+            return tile
+        
+        with self._lock:
+            if key in self._pending:
+                return None
+            self._pending.add(key)
+            self._generations[key[0]] = key[1]
+        self._executor.submit(self._run, key, func, args)
+        return None
+
+    def _run(self, key, func, args):
+        try:
+            tile = func(*args)
+        except Exception:
+            logging.getLogger("MatrixViz").exception("タイルの生成に失敗しました")
+            tile = None
+        with self._lock:
+            self._pending.discard(key)
+            if tile is not None and self._generations.get(key[0]) == key[1]:
+                self._put_locked(key, tile)
+                self._completed.append(key)
+
+    def take_completed(self):
+        """前回の呼び出し以降に生成が終わったタイルのキーを返す（メインスレッドから呼ぶ）"""
+        with self._lock:
+            completed, self._completed = self._completed, []
+        return completed
+
+    def rekey(self, owner, old_generation, new_generation, keep):
+        """世代が変わったとき、まだ有効なタイルを新しい世代のキーに付け替える"""
+        with self._lock:
+            if owner in self._generations:
+                self._generations[owner] = new_generation
+            for key in [key for key in self._tiles if key[0] == owner and key[1] == old_generation]:
+                tile = self._tiles.pop(key)
+                if keep(key):
+                    self._tiles[(owner, new_generation) + key[2:]] = tile
+                else:
+                    self._bytes -= tile.nbytes
+
+    def discard_owner(self, owner):
+        """あるレイヤーのタイルをすべて捨てる"""
+        with self._lock:
+            self._generations.pop(owner, None)
+            for key in [key for key in self._tiles if key[0] == owner]:
+                self._bytes -= self._tiles.pop(key).nbytes
+
+    def clear(self):
+        """すべてのタイルを捨てる（生成中のタイルも完成したら捨てる）"""
+        with self._lock:
+            self._tiles.clear()
+            self._bytes = 0
+            self._generations.clear()
+            self._completed = []
+
+    def stats(self):
+        """キャッシュの統計を文字列で返す"""
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0.0
+        return (f"タイル {len(self._tiles)} 枚 / {self._bytes / 2**20:.1f} MB "
+                f"(予算 {self.budget_bytes / 2**20:.0f} MB, ヒット率 {hit_rate:.1f}%)")
+
+class MatrixTileLayer(Artist):
+    """大きな行列の格子と値を、表示範囲のタイルだけラスタライズして描画する"""
+
+    # タイル1枚のピクセル数（一辺）と、ラスタライズするズームレベル（1セルのピクセル数）
+    tile_pixels = 256
+    levels = (16, 24, 32, 48, 64, 96, 128)
+    _owners = itertools.count()
+
+    def __init__(self, values, position, cache, is_dark_mode=False, **kwargs):
+        super().__init__()
+        self._values = values
+        self._position = position
+        self._cache = cache
+        self._is_dark_mode = is_dark_mode
+        self._owner = next(self._owners)
+        # 値が変わるたびに進める（古い世代のタイルは使わない）
+        self._generation = 0
+        self._image = None
+        self._internal_update(kwargs)
+
+    def level_for(self, cell_pixels):
+        """表示上のセルの大きさに合うズームレベルを選ぶ（表示以上の解像度で最小のもの）"""
+        for level in self.levels:
+            if level >= cell_pixels:
+                return level
+        return self.levels[-1]
+
+    def invalidate_cell(self, row, col):
+        """セルの値が変わったとき、そのセルを含むタイルだけを作り直す対象にする"""
+        def keep(key):
+            _, _, _, level, ti, tj = key
+            span = self.tile_pixels // level
+            return not (ti == row // span and tj == col // span)
+        
+        generation = self._generation + 1
+        self._cache.rekey(self._owner, self._generation, generation, keep)
+        self._generation = generation
+        self.stale = True
+
+    def release(self):
+        """キャッシュからこのレイヤーのタイルを捨てる"""
+        self._cache.discard_owner(self._owner)
+
+    def draw(self, renderer):
+        if not self.get_visible():
+            return
+        
+        rows, cols = self._values.shape
+        pos_x, pos_y = self._position
+        
+        # 表示範囲に入っているセルの範囲
+        x_min, x_max = sorted(self.axes.get_xlim())
+        y_min, y_max = sorted(self.axes.get_ylim())
+        c0 = max(0, int(math.floor(x_min - pos_x)))
+        c1 = min(cols, int(math.ceil(x_max - pos_x)))
+        r0 = max(0, int(math.floor(-y_max - pos_y)))
+        r1 = min(rows, int(math.ceil(-y_min - pos_y)))
+        if r0 >= r1 or c0 >= c1:
+            return
+        
+        (x0, y0), (x1, y1) = self.get_transform().transform([(0, 0), (1, 1)])
+        level = self.level_for(min(abs(x1 - x0), abs(y1 - y0)))
+        span = self.tile_pixels // level
+        dpi = renderer.dpi
+        # 保存時はタイルの生成を待つ（バックグラウンドで作ると画像に入らない）
+        canvas = self.figure.canvas if self.figure is not None else None
+        blocking = canvas is not None and canvas.is_saving()
+        
+        # 見えているタイルを1枚の画像に並べる
+        ti0, ti1 = r0 // span, (r1 - 1) // span
+        tj0, tj1 = c0 // span, (c1 - 1) // span
+        row_start, row_end = ti0 * span, min(rows, (ti1 + 1) * span)
+        col_start, col_end = tj0 * span, min(cols, (tj1 + 1) * span)
+        mosaic = np.zeros(((row_end - row_start) * level, (col_end - col_start) * level, 4), dtype=np.uint8)
+        
+        for ti in range(ti0, ti1 + 1):
+            for tj in range(tj0, tj1 + 1):
+                key = (self._owner, self._generation, dpi, level, ti, tj)
+                tile = self._cache.get(key)
+                if tile is None:
+                    block = self._values[ti * span:(ti + 1) * span, tj * span:(tj + 1) * span]
+                    tile = self._cache.request(key, rasterize_cell_tile, block.copy(), level, dpi,
+                                               self._is_dark_mode, blocking=blocking)
+                if tile is None:
+                    # 生成中のタイルは透明のまま（下のヒートマップが見える）
+                    continue
+                y = (ti * span - row_start) * level
+                x = (tj * span - col_start) * level
+                slot = mosaic[y:y + tile.shape[0], x:x + tile.shape[1]]
+                slot[...] = tile[:slot.shape[0], :slot.shape[1]]
+        
+        if self._image is None:
+            self._image = AxesImage(self.axes, origin='upper', interpolation='antialiased')
+            self._image.set_figure(self.figure)
+        image = self._image
+        image.set_transform(self.get_transform())
+        image.set_data(mosaic)
+        image.set_extent((pos_x + col_start, pos_x + col_end, -(pos_y + row_end), -(pos_y + row_start)))
+        image.set_clip_on(self.get_clip_on())
+        image.set_clip_box(self.get_clip_box())
+        image.set_clip_path(self.get_clip_path())
+        image.draw(renderer)
+        self.stale = False
+
+class RenderScheduler:
+    """再描画の要求をまとめて、1フレームにつき1回だけキャンバスを描画する"""
+
+    def __init__(self, widget, draw, frame_budget_ms=16, composite=None):
+        # widget は after() を持つ Tk ウィジェット、draw は実際に描画する関数
+        # composite はオーバーレイだけを重ね直す関数（できなければ False を返す）
+        self._widget = widget
+        self._draw = draw
+        self._composite = composite
+        self.frame_budget_ms = frame_budget_ms
+        self._pending = None
+        self._full = False
+        self._last_render = None
+        # 統計（要求数・実際の描画数・重ね直しの回数・まとめられた要求数・直近の描画時間）
+        self.requests = 0
+        self.renders = 0
+        self.composites = 0
+        self.merged = 0
+        self.last_render_ms = 0.0
+
+    def request(self, overlay_only=False):
+        """再描画を要求（すでに予約済みなら次のフレームにまとめる）
+
+        overlay_only なら静的な層は描き直さず、オーバーレイだけを重ね直す。
+        """
+        self.requests += 1
+        full = not overlay_only or self._composite is None
+        if self._pending is not None:
+            # 全体の描画が1つでも要求されたら、まとめた描画は全体の描画にする
+            self._full = self._full or full
+            self.merged += 1
+            return
+        self._full = full
+        
+        # 前回の描画からフレーム予算が経過するまで待つ
+        delay = 0
+        if self._last_render is not None:
+            elapsed_ms = (time.perf_counter() - self._last_render) * 1000
+            delay = max(0, int(self.frame_budget_ms - elapsed_ms))
+        if delay > 0:
+            self._pending = self._widget.after(delay, self._render)
+        else:
+            self._pending = self._widget.after_idle(self._render)
+
+    @property
+    def pending(self):
+        """再描画が予約済みかどうか"""
+        return self._pending is not None
+
+    def flush(self):
+        """予約済みの再描画があればすぐに実行"""
+        if self._pending is not None:
+            self._widget.after_cancel(self._pending)
+            self._render()
+
+    def cancel(self):
+        """予約済みの再描画を取り消す"""
+        if self._pending is not None:
+            self._widget.after_cancel(self._pending)
+            self._pending = None
+
+    def _render(self):
+        self._pending = None
+        start = time.perf_counter()
+        if not self._full and self._composite():
+            self.composites += 1
+        else:
+            self._draw()
+            self.renders += 1
+        self._full = False
+        self._last_render = time.perf_counter()
+        self.last_render_ms = (self._last_render - start) * 1000
+
+    def stats(self):
+        """描画の統計を文字列で返す"""
+        return (f"再描画要求 {self.requests} 回 / 描画 {self.renders} 回 / 重ね直し {self.composites} 回 "
+                f"(まとめた要求 {self.merged} 回, 直近の描画 {self.last_render_ms:.1f} ms)")
+
+class LayerCompositor:
+    """静的な層（行列の格子）をビットマップとしてキャッシュし、その上にオーバーレイの層を重ねる"""
+
+    def __init__(self, canvas, overlays):
+        # overlays は重ねる順に並んだオーバーレイのアーティストを返す関数
+        # （オーバーレイは animated=True にして、キャンバス全体の描画からは除いておく）
+        self._canvas = canvas
+        self._overlays = overlays
+        self._background = None
+        self.captures = 0
+        self.composites = 0
+
+    @property
+    def valid(self):
+        """静的な層のビットマップを保存済みかどうか"""
+        return self._background is not None
+
+    def invalidate(self):
+        """保存済みのビットマップを捨てる（次は全体を描画する）"""
+        self._background = None
+
+    def capture(self):
+        """全体の描画の直後に静的な層を保存し、オーバーレイを重ねる（draw_event から呼ぶ）"""
+        self._background = self._canvas.copy_from_bbox(self._canvas.figure.bbox)
+        self.captures += 1
+        self._draw_overlays()
+
+    def composite(self):
+        """保存済みの静的な層にオーバーレイだけを描き直して転送（保存済みでなければ False）"""
+        if self._background is None:
+            return False
+        self._canvas.restore_region(self._background)
+        self._draw_overlays()
+        self._canvas.blit(self._canvas.figure.bbox)
+        self.composites += 1
+        return True
+
+    def _draw_overlays(self):
+        renderer = self._canvas.get_renderer()
+        for artist in self._overlays():
+            artist.draw(renderer)
+
+    def stats(self):
+        """合成の統計を文字列で返す"""
+        return f"静的な層の保存 {self.captures} 回 / オーバーレイの重ね直し {self.composites} 回"
+
+class BlitAnimation(animation.FuncAnimation):
+    """外から背景を取り直して描き直せる FuncAnimation（LayerCompositor と同じキャンバスで使う）"""
+
+    def refresh(self, recapture=False):
+        """フレームのアーティストだけを描き直して転送
+
+        recapture なら今のキャンバスの内容（静的な層とオーバーレイ）を新しい背景として保存し直す。
+        """
+        if not self._drawn_artists:
+            return
+        if recapture:
+            self._blit_cache.clear()
+        else:
+            self._blit_clear(self._drawn_artists)
+        self._blit_draw(self._drawn_artists)
+
+class MultiplicationAnimator:
+    """行列の乗算の結果のセル C[i][j] を1つずつたどり、左の行 i と右の列 j を強調するアニメーション
+
+    フレームごとの強調の頂点と計算式のテキストは prepare() でまとめて作っておき、
+    フレームの描画では配列を差し替えるだけにする。
+    """
+
+    def __init__(self, renderer, left_name, right_name, zorder=9):
+        self.renderer = renderer
+        self.left_name = left_name
+        self.right_name = right_name
+        self.frame = 0
+        self._key = None
+        self.prepare()
+        
+        self.zorder = zorder
+        self.artists = self._create_artists(renderer.ax)
+        self.bands, self.caption = self.artists
+        # 強調はブリッティングで描くので、図全体の描画には含めない
+        for artist in self.artists:
+            artist.set_animated(True)
+
+    def _create_artists(self, ax):
+        # 左の行と右の列の帯（半透明の塗りつぶしなので値は隠れない）と計算式のテキスト
+        bands = PolyCollection(
+            self.frame_verts[self.frame],
+            facecolors=[color_registry.rgba('red', 0.2), color_registry.rgba('blue', 0.2)],
+            edgecolors=['red', 'blue'],
+            linewidths=2.5,
+            zorder=self.zorder
+        )
+        ax.add_collection(bands, autolim=False)
+        caption = ax.text(
+            *self.caption_position, self.frame_texts[self.frame],
+            ha='center', va='center', fontsize=14, color='green', zorder=self.zorder,
+            bbox=dict(facecolor='white', alpha=0.8, edgecolor='green')
+        )
+        return [bands, caption]
+
+    def _show_frame(self, artists, frame):
+        bands, caption = artists
+        bands.set_verts(self.frame_verts[frame])
+        caption.set_text(self.frame_texts[frame])
+        return artists
+
+    @property
+    def operands(self):
+        """アニメーションで使っている行列名"""
+        return (self.left_name, self.right_name)
+
+    def prepare(self):
+        """全フレームの強調の頂点と計算式のテキストを作る（行列の値・位置が変わっていなければ何もしない）"""
+        left = self.renderer.matrices[self.left_name]
+        right = self.renderer.matrices[self.right_name]
+        # 値のバージョンは移動では進まないので、位置もキーに含める
+        key = (left.version, left.position, right.version, right.position)
+        if key == self._key:
+            return False
+        
+        left_values, right_values = left.values, right.values
+        rows, inner = left_values.shape
+        if right_values.shape[0] != inner:
+            raise ValueError(f"{self.left_name} * {self.right_name}: 行列乗算の条件を満たしません")
+        cols = right_values.shape[1]
+        left_x, left_y = left.position
+        right_x, right_y = right.position
+        
+        # 左の行 i の帯 (rows, 4, 2) と右の列 j の帯 (cols, 4, 2)
+        row_bands = cell_polygons_at(left_x, left_y, np.arange(rows), np.zeros(rows, dtype=int))
+        row_bands[:, 1:3, 0] += inner - 1
+        col_bands = cell_polygons_at(right_x, right_y, np.zeros(cols, dtype=int), np.arange(cols))
+        col_bands[:, 0:2, 1] -= inner - 1
+        # フレーム f は結果のセル (i, j) = divmod(f, cols) に対応する
+        self.frame_verts = np.stack([np.repeat(row_bands, cols, axis=0),
+                                     np.tile(col_bands, (rows, 1, 1))], axis=1)
+        
+        labels = format_cell_labels(dense_values(combine_values(left_values, right_values, '*'))).ravel().tolist()
+        product = f"({self.left_name}×{self.right_name})"
+        self.frame_texts = [
+            f"{product}[{i}][{j}] = Σₖ {self.left_name}[{i}][k]·{self.right_name}[k][{j}] = {label}"
+            for (i, j), label in zip(itertools.product(range(rows), range(cols)), labels)
+        ]
+        self.shape = (rows, cols)
+        self.caption_position = ((left_x + inner + right_x) / 2,
+                                 -(max(left_y, right_y) + max(rows, inner) + 1.5))
+        self.frame = min(self.frame, len(self.frame_texts) - 1)
+        self._key = key
+        if hasattr(self, 'caption'):
+            self.caption.set_position(self.caption_position)
+        return True
+
+    @property
+    def frame_count(self):
+        """フレーム数（結果の行列のセル数）"""
+        return len(self.frame_texts)
+
+    def draw_frame(self, frame):
+        """フレームの強調を差し替えて、変更したアーティストを返す（FuncAnimation の描画関数）"""
+        self.frame = frame
+        return self._show_frame(self.artists, frame)
+
+    def step(self, delta=1):
+        """前後のフレームに移動"""
+        return self.draw_frame((self.frame + delta) % self.frame_count)
+
+    def _playback_frames(self):
+        # コマ送りで動かした位置から再生を続けられるよう、現在のフレームから数える
+        while True:
+            yield (self.frame + 1) % self.frame_count
+
+    def animate(self, interval=150):
+        """キャンバスで再生する FuncAnimation（ブリッティングあり）を作る"""
+        return BlitAnimation(
+            self.renderer.fig,
+            self.draw_frame,
+            frames=self._playback_frames,
+            init_func=lambda: self.draw_frame(self.frame),
+            interval=interval,
+            blit=True,
+            cache_frame_data=False
+        )
+
+    def save(self, file_path, fps=5, dpi=100):
+        """全フレームを GIF または MP4 として書き出す（形式は拡張子で決める）"""
+        extension = os.path.splitext(file_path)[1].lower()
+        if extension == '.gif':
+            writer = animation.PillowWriter(fps=fps)
+        elif extension == '.mp4':
+            if not animation.FFMpegWriter.isAvailable():
+                raise RuntimeError("MP4 の書き出しには ffmpeg が必要です")
+            writer = animation.FFMpegWriter(fps=fps)
+        else:
+            raise ValueError(f"サポートされていないアニメーションの形式: {extension}")
+        
+        # 行列などの静的な部分は書き出す解像度で1回だけ描画して画像にする
+        fig, ax = self.renderer.fig, self.renderer.ax
+        buffer = io.BytesIO()
+        for artist in self.artists:
+            artist.set_visible(False)
+        try:
+            fig.savefig(buffer, format='rgba', dpi=dpi)
+        finally:
+            for artist in self.artists:
+                artist.set_visible(True)
+        width, height = (int(size) for size in fig.get_size_inches() * dpi)
+        background = np.frombuffer(buffer.getbuffer(), dtype=np.uint8).reshape(height, width, 4)
+        
+        # 書き出し用の図では背景の画像の上に強調だけを描く（毎フレーム行列全体を描き直さない）
+        movie_fig = Figure(figsize=fig.get_size_inches(), dpi=dpi)
+        FigureCanvasAgg(movie_fig)
+        movie_fig.figimage(background, origin='upper', zorder=-1)
+        movie_ax = movie_fig.add_axes(ax.get_position())
+        movie_ax.set_xlim(ax.get_xlim())
+        movie_ax.set_ylim(ax.get_ylim())
+        movie_ax.set_axis_off()
+        artists = self._create_artists(movie_ax)
+        with writer.saving(movie_fig, file_path, dpi):
+            for frame in range(self.frame_count):
+                self._show_frame(artists, frame)
+                writer.grab_frame()
+        return file_path
+
+    def remove(self):
+        """強調のアーティストを軸から取り除く"""
+        for artist in self.artists:
+            artist.remove()
+
+class MatrixRenderer:
+    """行列・矢印・色付きセルのシーンを Matplotlib の軸に描画する（Tk に依存しない部分）"""
+
+    # 行列の格子（静的な層）の上に重ねるオーバーレイの層（重ねる順）
+    overlay_layers = ('colored_cells', 'operations', 'arrows', 'selection', 'hover')
+    # オーバーレイを animated にして静的な層と別に描画するか（GUI で合成するときだけ）
+    overlays_animated = False
+    # タイルをバックグラウンドのスレッドでラスタライズするか（GUI で描画を止めないときだけ）
+    background_tiles = False
+
+    def __init__(self, fig, is_dark_mode=False):
+        self.fig = fig
+        self.ax = fig.add_subplot()
+        self.is_dark_mode = is_dark_mode
+        self.matrices = {}
+        self.arrows = ArrowTable()
+        self.colored_cells = ColoredCellIndex()
+        self.cell_labels = CellLabelCache()
+        self.lod_threshold = 14
+        # セル数がこの値を超える行列はタイル単位でラスタライズして描画する
+        self.tile_threshold = 250000
+        # 疎行列・メモリマップの行列のヒートマップの画像の最大の辺（ピクセル）
+        self.heatmap_max_pixels = 1024
+        self.tile_cache = TileCache(background=self.background_tiles)
+        self.reset_scene()
+
+    def apply_figure_theme(self):
+        """図と軸の背景色をテーマに合わせる"""
+        if self.is_dark_mode:
+            self.fig.patch.set_facecolor('#2d2d2d')
+            self.ax.set_facecolor('#2d2d2d')
+            self.ax.title.set_color('#ffffff')
+        else:
+            self.fig.patch.set_facecolor('#f0f0f0')
+            self.ax.set_facecolor('#ffffff')
+            self.ax.title.set_color('#000000')
+
+    def render_scene(self):
+        """軸をクリアして、行列・矢印・色付き要素をすべて描画"""
+        self.ax.clear()
+        self.reset_scene()
+        self.cell_labels.prune(self.matrices)
+        self.connect_view_callbacks()
+        
+        # グラフの表示範囲を先に決める（表示範囲に入るセルだけを描画するため）
+        self.adjust_plot_limits()
+        
+        # 行列を描画
+        self.draw_matrices()
+        
+        # 矢印を描画
+        self.draw_arrows()
+        
+        # 色付き要素を描画
+        self.draw_colored_cells()
+        
+        self.update_level_of_detail()
+        
+        # タイトルを設定
+        self.ax.set_title('行列演算の可視化', fontsize=16, color='black' if not self.is_dark_mode else 'white')
+
+    def reset_scene(self):
+        """描画済みアーティストの管理テーブルを初期化（ax.clear() の後に呼ぶ）"""
+        self.scene = {
+            'matrices': {},       # 行列名 -> 行列のアーティスト
+            'arrows': [],         # self.arrows と同じ順序で矢印のアーティスト（ラベル付きの矢印のみ）
+            'arrow_layer': None,  # ラベルなしの矢印をまとめて描画するアーティスト
+            'colored_cells': {},  # 行列名 -> 色付きセルのオーバーレイ
+            'hover': None,        # ホバー表示（ブリッティング用）のアーティスト
+            # オーバーレイの層 -> その層のアーティスト（追加順の dict を順序付き集合として使う）
+            'overlays': {layer: {} for layer in self.overlay_layers}
+        }
+        
+        # 当たり判定用の空間インデックス（シーンと同期して更新する）
+        self.spatial_index = SpatialGridIndex()
+
+    def remove_artists(self, artists):
+        """アーティストのリストを軸から取り除く"""
+        overlays = self.scene['overlays'].values()
+        for artist in artists:
+            artist.remove()
+            for layer in overlays:
+                layer.pop(artist, None)
+
+    def add_overlay(self, layer, artist):
+        """軸に追加済みのアーティストをオーバーレイの層に登録して返す"""
+        if self.overlays_animated:
+            artist.set_animated(True)
+        self.scene['overlays'][layer][artist] = None
+        return artist
+
+    def clear_overlay(self, layer):
+        """オーバーレイの層のアーティストをすべて取り除く"""
+        self.remove_artists(list(self.scene['overlays'][layer]))
+
+    def overlay_artists(self):
+        """オーバーレイのアーティストを重ねる順（zorder、同じなら層と追加の順）で返す"""
+        artists = [artist for layer in self.scene['overlays'].values() for artist in layer]
+        return sorted(artists, key=lambda artist: artist.get_zorder())
+
+    def draw_matrices(self):
+        """すべての行列を描画"""
+        for name in self.matrices:
+            self.draw_matrix(name)
+
+    def draw_matrix(self, name):
+        """1つの行列を描画してシーンに登録"""
+        matrix_data = self.matrices[name]
+        values = matrix_data.values
+        pos_x, pos_y = matrix_data.position
+        rows, cols = values.shape
+        
+        # 行列全体の背景（わずかに大きめに）
+        background = patches.Rectangle(
+            (pos_x - 0.1, -(pos_y + rows) - 0.1), 
+            cols + 0.2, rows + 0.2, 
+            linewidth=1.5, 
+            edgecolor='gray', 
+            facecolor='#f8f8f8' if not self.is_dark_mode else '#2a2a2a',
+            alpha=0.7,
+            zorder=0
+        )
+        self.ax.add_patch(background)
+        
+        # セルが小さく表示される場合の代替表示（値のヒートマップ）
+        # （疎行列は非ゼロ要素だけを集約した画像にし、ゼロの部分は透明にする）
+        # （メモリマップの行列は間引いた行と列だけを読み込む）
+        if matrix_data.is_sparse:
+            image, step = sparse_heatmap(values, self.heatmap_max_pixels)
+        elif matrix_data.is_mapped:
+            step = max(1, math.ceil(max(rows, cols) / self.heatmap_max_pixels))
+            image = np.array(values[::step, ::step])
+        else:
+            image, step = values, 1
+        heatmap = self.ax.imshow(
+            image,
+            extent=(pos_x, pos_x + image.shape[1] * step, -(pos_y + image.shape[0] * step), -pos_y),
+            origin='upper',
+            cmap='viridis',
+            interpolation='nearest',
+            visible=False,
+            zorder=1
+        )
+        
+        _, text_color, _ = matrix_palette(self.is_dark_mode)
+        if rows * cols > self.tile_threshold and not matrix_data.is_sparse:
+            # 大きな行列はセルごとの図形を作らず、表示範囲のタイルだけラスタライズする
+            # （生成中のタイルの下にはヒートマップを見せておく）
+            tiles = MatrixTileLayer(values, (pos_x, pos_y), self.tile_cache, self.is_dark_mode, zorder=2)
+            self.ax.add_artist(tiles)
+            detail = [tiles]
+        else:
+            # セルの格子と値は表示範囲に入った部分だけ cull_matrix で作る
+            tiles = None
+            detail = []
+        
+        # 行列名を左上に表示（影付き）
+        name_texts = []
+        # 影の効果（オフセット付きで同じテキストを描画）
+        if not self.is_dark_mode:
+            name_texts.append(self.ax.text(
+                pos_x - 0.18, -pos_y + 0.02, 
+                name, 
+                ha='right', 
+                va='center', 
+                fontsize=14, 
+                fontweight='bold',
+                color='lightgray',
+                zorder=3
+            ))
+        
+        name_texts.append(self.ax.text(
+            pos_x - 0.2, -pos_y, 
+            name, 
+            ha='right', 
+            va='center', 
+            fontsize=14, 
+            fontweight='bold',
+            color=text_color,
+            zorder=4
+        ))
+        
+        self.scene['matrices'][name] = {
+            # 描画に使った値の配列（float への昇格で作り直されたら行列ごと描き直す）
+            'values': values,
+            'background': background,
+            'grid': None,
+            'labels': None,
+            'heatmap': heatmap,
+            # ヒートマップの1ピクセルが対応するセル数（疎行列で集約したときだけ 1 より大きい）
+            'heatmap_step': step,
+            'tiles': tiles,
+            'names': name_texts,
+            'detail': detail,
+            # 格子と値を作ってあるセルの範囲 (行の開始, 行の終了, 列の開始, 列の終了)
+            'window': None
+        }
+        self.spatial_index.insert(('matrix', name), (pos_x, -(pos_y + rows), pos_x + cols, -pos_y))
+        self.cull_matrix(name)
+
+    def build_matrix_detail(self, name, window):
+        """行列のセルの格子と値を window の範囲だけ作り直す（None なら作らない）"""
+        artists = self.scene['matrices'][name]
+        artists['window'] = window
+        if artists['tiles'] is not None:
+            return
+        
+        self.remove_artists(artists['detail'])
+        artists['grid'] = artists['labels'] = None
+        artists['detail'] = []
+        if window is None:
+            return
+        
+        if self.matrices[name].is_sparse:
+            self.build_sparse_detail(name, window)
+            return
+        
+        pos_x, pos_y = self.matrices[name].position
+        r0, r1, c0, c1 = window
+        rows, cols = r1 - r0, c1 - c0
+        cell_color, text_color, edge_color = matrix_palette(self.is_dark_mode)
+        
+        # 行列のセルを描画（範囲ごとに1つのコレクションにまとめる）
+        # （色付きセルはオーバーレイの層で上に重ねるので、格子の色は変えない）
+        grid = PolyCollection(
+            cell_polygons(pos_x + c0, pos_y + r0, rows, cols),
+            facecolors=cell_color,
+            edgecolors=edge_color,
+            linewidths=1,
+            zorder=1
+        )
+        self.ax.add_collection(grid, autolim=False)
+        
+        # 値の文字列は行列ごとにキャッシュしたものを使う（メモリマップの行列は範囲のセルだけを書式化する）
+        labels = self.cell_labels_at(name, slice(r0, r1), slice(c0, c1)).ravel()
+        
+        jj, ii = np.meshgrid(np.arange(c0, c1), np.arange(r0, r1))
+        centers = np.column_stack([(pos_x + jj).ravel() + 0.5, -(pos_y + ii).ravel() - 0.5])
+        cell_texts = CellTextCollection(
+            centers, 
+            labels, 
+            colors=text_color, 
+            fontsize=12,
+            zorder=2
+        )
+        self.ax.add_artist(cell_texts)
+        
+        artists['grid'] = grid
+        artists['labels'] = cell_texts
+        artists['detail'] = [grid, cell_texts]
+
+    def build_sparse_detail(self, name, window):
+        """疎行列の window の範囲に、格子の線と非ゼロのセル・値だけを作る（非ゼロ要素の数に比例）"""
+        artists = self.scene['matrices'][name]
+        matrix = self.matrices[name]
+        pos_x, pos_y = matrix.position
+        r0, r1, c0, c1 = window
+        cell_color, text_color, edge_color = matrix_palette(self.is_dark_mode)
+        
+        # 格子は線だけにする（ゼロのセルの四角形は作らない）
+        xs = pos_x + np.arange(c0, c1 + 1)
+        ys = -(pos_y + np.arange(r0, r1 + 1))
+        lines = np.concatenate([
+            np.stack([np.column_stack([xs, np.full_like(xs, ys[-1], dtype=float)]),
+                      np.column_stack([xs, np.full_like(xs, ys[0], dtype=float)])], axis=1),
+            np.stack([np.column_stack([np.full_like(ys, xs[0], dtype=float), ys]),
+                      np.column_stack([np.full_like(ys, xs[-1], dtype=float), ys])], axis=1)])
+        outline = LineCollection(lines, colors=edge_color, linewidths=0.5, alpha=0.3, zorder=1)
+        self.ax.add_collection(outline, autolim=False)
+        
+        block = matrix.values[r0:r1, c0:c1].tocoo()
+        rows, cols = block.row.astype(int) + r0, block.col.astype(int) + c0
+        grid = PolyCollection(
+            cell_polygons_at(pos_x, pos_y, rows, cols),
+            facecolors=cell_color,
+            edgecolors=edge_color,
+            linewidths=1,
+            zorder=1
+        )
+        self.ax.add_collection(grid, autolim=False)
+        cell_texts = CellTextCollection(
+            np.column_stack([pos_x + cols + 0.5, -(pos_y + rows) - 0.5]),
+            format_cell_labels(block.data),
+            colors=text_color,
+            fontsize=12,
+            zorder=2
+        )
+        self.ax.add_artist(cell_texts)
+        
+        artists['grid'] = grid
+        artists['labels'] = cell_texts
+        artists['detail'] = [grid, cell_texts, outline]
+
+    def cell_labels_at(self, name, rows, cols):
+        """セル（行と列の配列）のラベルの配列を返す（疎行列とメモリマップの行列はそのセルだけを書式化する）"""
+        matrix = self.matrices[name]
+        if matrix.is_sparse or matrix.is_mapped:
+            # 添字が空のときなどは疎な結果が返るので密な配列に揃える
+            return format_cell_labels(dense_values(matrix.values[rows, cols]).ravel())
+        return self.matrix_labels(name)[rows, cols]
+
+    def cell_label(self, name, row, col):
+        """1つのセルのラベルを返す（疎行列とメモリマップの行列は全体のラベルを作らずそのセルだけを書式化する）"""
+        matrix = self.matrices[name]
+        if matrix.is_sparse or matrix.is_mapped:
+            return format_cell_value(matrix.values[row, col])
+        return self.matrix_labels(name)[row, col]
+
+    def matrix_cells(self, name):
+        """演算で強調するセルを (行の配列, 列の配列) で返す（疎行列は非ゼロのセルだけ）"""
+        matrix = self.matrices[name]
+        if matrix.is_sparse:
+            return matrix.nonzero_cells()
+        ii, jj = np.indices(matrix.shape)
+        return ii.ravel(), jj.ravel()
+
+    def matrix_labels(self, name):
+        """行列のセルのラベル文字列の配列を返す（キャッシュ付き）"""
+        return self.cell_labels.labels(name, self.matrices[name])
+
+    def set_cell_value(self, name, row, col, value):
+        """セルの値を書き換え、ラベルのキャッシュを更新（整数の行列が float に昇格したら True）"""
+        matrix = self.matrices[name]
+        previous_version = matrix.version
+        promoted = matrix.set_cell(row, col, value)
+        self.cell_labels.update_cell(name, matrix, row, col, previous_version)
+        return promoted
+
+    def visible_cells(self, name):
+        """表示範囲に入っているセルの範囲 (行の開始, 行の終了, 列の開始, 列の終了) を返す（なければ None）"""
+        rows, cols = self.matrices[name].values.shape
+        pos_x, pos_y = self.matrices[name].position
+        x_min, x_max = sorted(self.ax.get_xlim())
+        y_min, y_max = sorted(self.ax.get_ylim())
+        c0 = max(0, int(math.floor(x_min - pos_x)))
+        c1 = min(cols, int(math.ceil(x_max - pos_x)))
+        r0 = max(0, int(math.floor(-y_max - pos_y)))
+        r1 = min(rows, int(math.ceil(-y_min - pos_y)))
+        if r0 >= r1 or c0 >= c1:
+            return None
+        return r0, r1, c0, c1
+
+    def cull_matrix(self, name, show_detail=None):
+        """行列の格子と値を、表示範囲に合わせて必要なときだけ作り直す"""
+        artists = self.scene['matrices'][name]
+        if show_detail is None:
+            show_detail = self.cell_pixel_size() >= self.lod_threshold
+        
+        # ヒートマップ表示のときはセルごとの表示は要らない
+        needed = self.visible_cells(name) if show_detail else None
+        window = artists['window']
+        if needed is None:
+            if window is None:
+                return
+            new_window = None
+        else:
+            r0, r1, c0, c1 = needed
+            if window is not None:
+                w0, w1, v0, v1 = window
+                contains = w0 <= r0 and r1 <= w1 and v0 <= c0 and c1 <= v1
+                # 拡大して必要な範囲より大幅に広くなった場合は作り直して小さくする
+                oversized = (w1 - w0) * (v1 - v0) > 16 * (r1 - r0) * (c1 - c0)
+                if contains and not oversized:
+                    return
+            # 少しのスクロールで作り直さないように、見えている範囲の半分ずつ余白を取る
+            rows, cols = self.matrices[name].values.shape
+            margin_r = (r1 - r0) // 2 + 1
+            margin_c = (c1 - c0) // 2 + 1
+            new_window = (max(0, r0 - margin_r), min(rows, r1 + margin_r),
+                          max(0, c0 - margin_c), min(cols, c1 + margin_c))
+        
+        self.build_matrix_detail(name, new_window)
+        # 色付きセルのオーバーレイは格子の範囲に合わせて作るため描き直す
+        if name in self.scene['colored_cells'] or self.colored_cells.count_in_matrix(name):
+            self.draw_colored_overlay(name)
+
+    def cull_scene(self):
+        """表示範囲に入っている行列・矢印・色付きセルだけを描画対象にする（拡大・移動の後）"""
+        if not self.scene['matrices'] and not self.scene['arrows']:
+            return
+        
+        x_min, x_max = sorted(self.ax.get_xlim())
+        y_min, y_max = sorted(self.ax.get_ylim())
+        visible = set(self.spatial_index.query_rect(x_min, y_min, x_max, y_max))
+        show_detail = self.cell_pixel_size() >= self.lod_threshold
+        
+        for name, artists in self.scene['matrices'].items():
+            if ('matrix', name) in visible:
+                self.cull_matrix(name, show_detail)
+            elif artists['window'] is not None:
+                # 画面外に出た行列のセルの表示は捨てる
+                self.build_matrix_detail(name, None)
+                if name in self.scene['colored_cells']:
+                    self.draw_colored_overlay(name)
+        
+        # ラベル付きの矢印（個別のアーティスト）は画面外なら描画しない
+        # （ラベルなしの矢印は ArrowCollection が描画時に間引く）
+        for index, artists in enumerate(self.scene['arrows']):
+            on_screen = ('arrow', index) in visible
+            for artist in artists:
+                artist.set_visible(on_screen)
+
+    def remove_matrix_artists(self, name):
+        """行列のアーティストをシーンから取り除く"""
+        artists = self.scene['matrices'].pop(name, None)
+        self.spatial_index.remove(('matrix', name))
+        if artists:
+            self.remove_artists([artists['background'], artists['heatmap']] + artists['detail'] + artists['names'])
+            if artists['tiles'] is not None:
+                artists['tiles'].release()
+
+    def draw_arrows(self):
+        """すべての矢印を描画"""
+        # ラベル付きの矢印だけを個別に描画し、他は空のアーティストのリストで番号を揃える
+        artists = [[] for _ in range(len(self.arrows))]
+        for index in np.flatnonzero(self.arrows.labeled()).tolist():
+            artists[index] = self.draw_arrow(self.arrows[index])
+        self.scene['arrows'].extend(artists)
+        self.update_arrow_layer()
+        self.reindex_arrows()
+
+    def ensure_arrow_layer(self):
+        """ラベルなしの矢印をまとめて描画するアーティストを用意（ax.clear() 後は作り直す）"""
+        if self.scene['arrow_layer'] is None:
+            layer = ArrowCollection(rad=0.1, alpha=0.8, zorder=10)
+            self.ax.add_artist(layer)
+            self.scene['arrow_layer'] = self.add_overlay('arrows', layer)
+        return self.scene['arrow_layer']
+
+    def bulk_arrow(self, arrow):
+        """まとめて描画する矢印なら (始点, 終点, スタイル, 色, 太さ) を返す"""
+        # ラベル付きの矢印は annotate で個別に描画する
+        if arrow.get('label'):
+            return None
+        if arrow['source'][0] not in self.matrices or arrow['target'][0] not in self.matrices:
+            return None
+        start, end = self.arrow_endpoints(arrow)
+        return start, end, arrow.get('style', '-|>'), arrow['color'], arrow.get('width', 2.0)
+
+    def update_arrow_layer(self):
+        """ラベルなしの矢印をまとめて描画し直す（削除・編集・行列の移動の後）"""
+        starts, ends, valid = self.arrow_endpoint_arrays()
+        bulk = valid & ~self.arrows.labeled()
+        records = self.arrows.records[bulk]
+        self.ensure_arrow_layer().set_arrows(
+            starts[bulk], ends[bulk], self.arrows.texts.lookup(records['style']),
+            self.arrows.colors.lookup(records['color']), records['width'])
+
+    def draw_arrow(self, arrow):
+        """ラベル付きの矢印を annotate で描画し、作成したアーティストのリストを返す"""
+        source_name, source_row, source_col = arrow['source']
+        target_name, target_row, target_col = arrow['target']
+        color = arrow['color']
+        
+        # 追加のスタイル情報
+        style = arrow.get('style', '-|>')
+        width = arrow.get('width', 2.0)
+        label = arrow.get('label', '')
+        
+        artists = []
+        # ラベルなしの矢印は ArrowCollection でまとめて描画する
+        if not label:
+            return artists
+        
+        if source_name in self.matrices and target_name in self.matrices:
+            source_pos = self.matrices[source_name].position
+            target_pos = self.matrices[target_name].position
+            
+            # 矢印の始点と終点を計算
+            start_x = source_pos[0] + source_col + 0.5
+            start_y = -(source_pos[1] + source_row + 0.5)
+            end_x = target_pos[0] + target_col + 0.5
+            end_y = -(target_pos[1] + target_row + 0.5)
+            
+            # 矢印スタイルを設定
+            arrow_style = None
+            if style == '-|>':
+                arrow_style = '-|>'
+            elif style == '->>':
+                arrow_style = '->'
+            elif style == '-[':
+                arrow_style = '-['
+            elif style == '-|':
+                arrow_style = patches.ArrowStyle('|-|', widthA=0)
+            elif style == '<->':
+                arrow_style = '<->'
+            elif style == '<-|>':
+                arrow_style = '<|-|>'
+            else:
+                arrow_style = '-|>'  # デフォルト
+            
+            # 矢印を描画
+            annotation = self.ax.annotate(
+                '', 
+                xy=(end_x, end_y), 
+                xytext=(start_x, start_y),
+                arrowprops=dict(
+                    arrowstyle=arrow_style, 
+                    color=color, 
+                    lw=width,
+                    alpha=0.8,
+                    connectionstyle="arc3,rad=.1"  # 少し湾曲させる
+                ),
+                zorder=10
+            )
+            artists.append(self.add_overlay('arrows', annotation))
+            
+            # ラベルがあれば表示
+            if label:
+                # 矢印の中点を計算
+                mid_x = (start_x + end_x) / 2
+                mid_y = (start_y + end_y) / 2
+                
+                # 少しオフセットを加える
+                offset_x = (end_y - start_y) * 0.1
+                offset_y = (start_x - end_x) * 0.1
+                
+                # ラベルのテキストを描画
+                artists.append(self.add_overlay('arrows', self.ax.text(
+                    mid_x + offset_x, 
+                    mid_y + offset_y, 
+                    label,
+                    ha='center',
+                    va='center',
+                    fontsize=10,
+                    fontweight='bold',
+                    color=color,
+                    bbox=dict(facecolor='white' if not self.is_dark_mode else '#2a2a2a', alpha=0.8),
+                    zorder=11
+                )))
+        return artists
+
+    def draw_colored_cells(self):
+        """色付き要素を描画"""
+        for name in self.matrices:
+            self.draw_colored_overlay(name)
+
+    def remove_colored_overlay(self, matrix_name):
+        """行列の色付きセルのオーバーレイをシーンから取り除く"""
+        overlay = self.scene['colored_cells'].pop(matrix_name, None)
+        if overlay:
+            self.remove_artists([artist for artist in (overlay['image'], overlay['cells'], overlay['labels'])
+                                 if artist is not None])
+
+    def draw_colored_overlay(self, matrix_name):
+        """行列の色付きセルを行列単位のオーバーレイとして描画してシーンに登録"""
+        self.remove_colored_overlay(matrix_name)
+        
+        matrix_artists = self.scene['matrices'].get(matrix_name)
+        if matrix_name not in self.matrices or matrix_artists is None:
+            return
+        
+        n_rows, n_cols = self.matrices[matrix_name].values.shape
+        rows, cols, colors = self.colored_cells.matrix_arrays(matrix_name)
+        
+        # 行列の範囲外を指す色付きセルは描画しない
+        inside = (rows >= 0) & (rows < n_rows) & (cols >= 0) & (cols < n_cols)
+        if not inside.all():
+            rows, cols = rows[inside], cols[inside]
+            colors = [color for color, ok in zip(colors, inside) if ok]
+        if not len(rows):
+            return
+        
+        pos_x, pos_y = self.matrices[matrix_name].position
+        tiled = matrix_artists['tiles'] is not None
+        show_detail = bool(matrix_artists['detail']) and matrix_artists['detail'][0].get_visible()
+        
+        # 色と文字色（輝度で黒か白を選ぶ）は色ごとのキャッシュから引く
+        rgba, text_colors = color_registry.rgba_array(colors, alpha=0.8)
+        
+        # ヒートマップ表示: 行列のヒートマップと同じ解像度の RGBA 画像として重ねる
+        step = matrix_artists['heatmap_step']
+        image_data = np.zeros((-(-n_rows // step), -(-n_cols // step), 4), dtype=np.float32)
+        image_data[rows // step, cols // step] = rgba
+        image = self.add_overlay('colored_cells', self.ax.imshow(
+            image_data,
+            extent=(pos_x, pos_x + image_data.shape[1] * step, -(pos_y + image_data.shape[0] * step), -pos_y),
+            origin='upper',
+            interpolation='nearest',
+            visible=tiled or matrix_artists['heatmap'].get_visible(),
+            zorder=5
+        ))
+        
+        # 以降のセルごとの表示は、格子と値を作ってある範囲の色付きセルだけ
+        window = matrix_artists['window']
+        if window is None:
+            rows = cols = np.zeros(0, dtype=int)
+        else:
+            r0, r1, c0, c1 = window
+            in_window = (rows >= r0) & (rows < r1) & (cols >= c0) & (cols < c1)
+            rows, cols = rows[in_window], cols[in_window]
+            rgba, text_colors = rgba[in_window], text_colors[in_window]
+        
+        # 通常表示: セルの色に色付きの色を半透明で重ねた不透明な四角形を、格子の上に1つのコレクションで描く
+        # （下の格子と値は変えないので、色の変更で静的な層を描き直さずに済む）
+        # （タイル表示の行列では下の画像にそのまま重ねる）
+        cells = None
+        if not tiled and len(rows):
+            cell_color, _, edge_color = matrix_palette(self.is_dark_mode)
+            base = np.array(color_registry.rgba(cell_color))
+            alpha = rgba[:, 3:]
+            face_colors = np.empty_like(rgba)
+            face_colors[:, :3] = rgba[:, :3] * alpha + base[:3] * (1 - alpha)
+            face_colors[:, 3] = 1.0
+            cells = PolyCollection(
+                cell_polygons_at(pos_x, pos_y, rows, cols),
+                facecolors=face_colors,
+                edgecolors=edge_color,
+                linewidths=1,
+                zorder=5,
+                visible=show_detail
+            )
+            self.add_overlay('colored_cells', self.ax.add_collection(cells, autolim=False))
+        
+        # セルの値を太字で再描画（下の行列側のラベルは上の四角形で隠れる）
+        labels = CellTextCollection(
+            np.column_stack([pos_x + cols + 0.5, -(pos_y + rows) - 0.5]),
+            self.cell_labels_at(matrix_name, rows, cols),
+            colors=text_colors,
+            fontsize=12,
+            fontweight='bold',
+            zorder=6,
+            visible=show_detail
+        )
+        self.add_overlay('colored_cells', self.ax.add_artist(labels))
+        
+        self.scene['colored_cells'][matrix_name] = {
+            'image': image,
+            'cells': cells,
+            'labels': labels,
+            'tiled': tiled,
+            # (行, 列) -> オーバーレイ内の番号
+            'index': dict(zip(zip(rows.tolist(), cols.tolist()), range(len(rows))))
+        }
+
+    def highlight_cells(self, layer, matrix_name, rows, cols, facecolor, edgecolor, linewidth=1, alpha=1.0):
+        """行列のセル（行と列の配列）を強調する四角形をまとめてオーバーレイの層に描画"""
+        pos_x, pos_y = self.matrices[matrix_name].position
+        rows, cols = np.asarray(rows, dtype=int), np.asarray(cols, dtype=int)
+        
+        fill = color_registry.rgba(facecolor, alpha) if facecolor != 'none' else 'none'
+        highlight = PolyCollection(
+            cell_polygons_at(pos_x, pos_y, rows, cols),
+            facecolors=fill,
+            edgecolors=edgecolor,
+            linewidths=linewidth,
+            zorder=7
+        )
+        self.add_overlay(layer, self.ax.add_collection(highlight, autolim=False))
+        
+        # 不透明に近い塗りつぶしでは値が隠れるので上に描き直す（タイル表示の大きな行列は除く）
+        matrix_artists = self.scene['matrices'].get(matrix_name)
+        if fill == 'none' or fill[3] < 0.5 or matrix_artists is None or matrix_artists['tiles'] is not None:
+            return
+        text_color = mpl.colors.to_hex(color_registry.text_color(facecolor, alpha))
+        self.add_overlay(layer, self.ax.add_artist(CellTextCollection(
+            np.column_stack([pos_x + cols + 0.5, -(pos_y + rows) - 0.5]),
+            self.cell_labels_at(matrix_name, rows, cols),
+            colors=text_color,
+            fontsize=12,
+            zorder=8,
+            visible=self.cell_pixel_size() >= self.lod_threshold
+        )))
+
+    def arrow_endpoints(self, arrow):
+        """矢印の始点と終点（セルの中心のデータ座標）を返す"""
+        source_name, source_row, source_col = arrow['source']
+        target_name, target_row, target_col = arrow['target']
+        source_pos = self.matrices[source_name].position
+        target_pos = self.matrices[target_name].position
+        return ((source_pos[0] + source_col + 0.5, -(source_pos[1] + source_row + 0.5)),
+                (target_pos[0] + target_col + 0.5, -(target_pos[1] + target_row + 0.5)))
+
+    def arrow_endpoint_arrays(self):
+        """すべての矢印の始点・終点の配列と、両端の行列が存在するかのマスクを返す"""
+        records = self.arrows.records
+        # 矢印の表の行列名の ID ごとの位置（存在しない行列は NaN）
+        positions = np.full((len(self.arrows.names), 2), np.nan)
+        for sid, name in enumerate(self.arrows.names):
+            matrix = self.matrices.get(name)
+            if matrix is not None:
+                positions[sid] = matrix.position
+        source = positions[records['source']]
+        target = positions[records['target']]
+        starts = np.column_stack([source[:, 0] + records['source_col'] + 0.5,
+                                  -(source[:, 1] + records['source_row'] + 0.5)])
+        ends = np.column_stack([target[:, 0] + records['target_col'] + 0.5,
+                                -(target[:, 1] + records['target_row'] + 0.5)])
+        valid = ~(np.isnan(source[:, 0]) | np.isnan(target[:, 0]))
+        return starts, ends, valid
+
+    def index_arrow(self, index):
+        """1本の矢印を空間インデックスに登録"""
+        arrow = self.arrows[index]
+        if arrow['source'][0] not in self.matrices or arrow['target'][0] not in self.matrices:
+            self.spatial_index.remove(('arrow', index))
+            return
+        (x0, y0), (x1, y1) = self.arrow_endpoints(arrow)
+        # 湾曲分とクリック許容幅を含めて広げる
+        margin = 0.3 + 0.1 * math.hypot(x1 - x0, y1 - y0)
+        self.spatial_index.insert(('arrow', index), (min(x0, x1) - margin, min(y0, y1) - margin,
+                                                     max(x0, x1) + margin, max(y0, y1) + margin))
+
+    def reindex_arrows(self):
+        """矢印の空間インデックスを作り直す（矢印の削除で番号がずれるため）"""
+        for key in [key for key in self.spatial_index.keys() if key[0] == 'arrow']:
+            self.spatial_index.remove(key)
+        # 外接矩形は index_arrow と同じ式を配列でまとめて計算する
+        starts, ends, valid = self.arrow_endpoint_arrays()
+        margin = 0.3 + 0.1 * np.hypot(*(ends - starts).T)
+        bounds = np.column_stack([np.minimum(starts, ends) - margin[:, None],
+                                  np.maximum(starts, ends) + margin[:, None]])
+        for index, box in zip(np.flatnonzero(valid).tolist(), bounds[valid].tolist()):
+            self.spatial_index.insert(('arrow', index), tuple(box))
+
+    def adjust_plot_limits(self):
+        """プロットの表示範囲を調整"""
+        max_x, min_y = 0, 0
+        padding = 2
+        
+        # 行列の範囲を計算
+        for matrix_data in self.matrices.values():
+            pos_x, pos_y = matrix_data.position
+            rows, cols = matrix_data.values.shape
+            max_x = max(max_x, pos_x + cols + 0.5)
+            min_y = min(min_y, -(pos_y + rows + 0.5))
+        
+        self.ax.set_xlim(-padding, max_x + padding)
+        self.ax.set_ylim(min_y - padding, padding)
+        self.ax.set_aspect('equal')
+        self.ax.axis('off')
+
+    def connect_view_callbacks(self):
+        """表示範囲の変更を監視するコールバックを登録（ax.clear() で消えるため毎回登録）"""
+        self.ax.callbacks.connect('xlim_changed', lambda ax: self.on_view_changed())
+        self.ax.callbacks.connect('ylim_changed', lambda ax: self.on_view_changed())
+
+    def on_view_changed(self):
+        """表示範囲が変わったときに詳細度と描画対象を更新"""
+        self.update_level_of_detail()
+
+    def cell_pixel_size(self):
+        """1セルの画面上のサイズ（ピクセル）を返す"""
+        (x0, y0), (x1, y1) = self.ax.transData.transform([(0, 0), (1, 1)])
+        return min(abs(x1 - x0), abs(y1 - y0))
+
+    def update_level_of_detail(self):
+        """セルの表示サイズに応じてテキスト表示とヒートマップ表示を切り替える"""
+        if self.scene['matrices']:
+            show_detail = self.cell_pixel_size() >= self.lod_threshold
+            for artists in self.scene['matrices'].values():
+                for artist in artists['detail']:
+                    artist.set_visible(show_detail)
+                # タイル表示の行列ではヒートマップを生成中のタイルの代わりに常に表示する
+                artists['heatmap'].set_visible(not show_detail or artists['tiles'] is not None)
+            for overlay in self.scene['colored_cells'].values():
+                overlay['labels'].set_visible(show_detail)
+                if overlay['cells'] is not None:
+                    overlay['cells'].set_visible(show_detail)
+                overlay['image'].set_visible(not show_detail or overlay['tiled'])
+            # 演算の強調表示で描き直したセルの値も同じ詳細度に合わせる
+            for artist in self.scene['overlays']['operations']:
+                if isinstance(artist, CellTextCollection):
+                    artist.set_visible(show_detail)
+        
+        # 表示範囲に合わせてセルごとの表示を作り直す
+        self.cull_scene()
+
+class MatrixVisualization(MatrixRenderer):
+    # オーバーレイは保存済みの静的な層に重ねて転送する（LayerCompositor）
+    overlays_animated = True
+    background_tiles = True
+    # 再生中の乗算のアニメーション（MultiplicationAnimator と、それを動かす BlitAnimation）
+    multiplication_animator = None
+    animation = None
+    animation_paused = False
 
-class MatrixVisualization:
     def __init__(self, root):
         self.root = root
         self.root.title("行列演算可視化ツール")
         self.root.geometry("1300x800")
         self.root.minsize(1000, 700)
         
-        # アプリケーションのテーマ設定
-        self.is_dark_mode = False
-        
         # 予約語のリスト
         self.reserved_words = ['+', '-', '*', '^', 'Det', 'Tr', '=']
         
-        # 行列辞書 - キーは行列名、値は行列のデータとプロパティ
-        self.matrices = {}
-        
-        # 矢印のリスト
-        self.arrows = []
-        
-        # 色付き要素のリスト
-        self.colored_cells = []
+        # 式の評価器（部分式の結果を行列のバージョンごとにキャッシュする）と、
+        # キャンバスに配置した結果の行列 {行列名: (評価結果, 行列, 配置したときのバージョン)}
+        # 結果の行列は一時的なもので、次の評価で置き換わり、リストや保存には含めない
+        self.expression_evaluator = ExpressionEvaluator()
+        self.expression_results = {}
         
         # スタイル設定
         self.style = ttk.Style()
@@ -99,11 +3526,33 @@ class MatrixVisualization:
         self.viz_panel = ttk.Frame(self.panel_paned)
         self.panel_paned.add(self.viz_panel, weight=2)
         
-        # Matplotlib の図とキャンバス
-        self.fig, self.ax = plt.subplots(figsize=(8, 6))
+        # Matplotlib の図とキャンバス（行列・矢印・色付き要素の表やキャッシュ、表示の閾値は
+        # ヘッドレスの描画と共通の MatrixRenderer の初期化で用意する）
+        super().__init__(plt.figure(figsize=(8, 6)))
         self.canvas = FigureCanvasTkAgg(self.fig, master=self.viz_panel)
         self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
-        self.canvas.get_tk_widget().bind("<Motion>", self.on_mouse_move)
+        # 再描画はスケジューラを通して1フレームにつき1回にまとめる
+        # （拡大・移動による描画対象の選び直しも描画の直前に1回だけ行う）
+        # オーバーレイだけの変更は、保存済みの行列の格子のビットマップに重ね直すだけにする
+        self.view_dirty = False
+        self.compositor = LayerCompositor(self.canvas, self.overlay_artists)
+        self.render_scheduler = RenderScheduler(self.root, self.render_frame, composite=self.composite_frame)
+        # Matplotlib のイベントを使う（データ座標への変換と上下反転を任せる）
+        self.canvas.mpl_connect('motion_notify_event', self.on_mouse_move)
+        # 中ボタンのドラッグで表示範囲を移動
+        self.pan_start = None
+        self.canvas.mpl_connect('button_press_event', self.on_pan_press)
+        self.canvas.mpl_connect('button_release_event', self.on_pan_release)
+        
+        # 全体の描画のたびに静的な層を保存し、ホバー表示などのオーバーレイを重ねる
+        self.hover_cell = None
+        self.canvas.mpl_connect('draw_event', self.on_canvas_draw)
+        
+        # バックグラウンドで生成が終わったタイルを定期的に拾う
+        self.poll_tiles()
+        # 疎行列・メモリマップの行列の編集ダイアログはこのセル数まで
+        self.editor_max_cells = 2500
+        self.canvas.mpl_connect('resize_event', lambda event: self.on_view_changed())
         
         # ツールチップ用の変数
         self.tooltip = None
@@ -142,9 +3591,7 @@ class MatrixVisualization:
             self.style.map("TNotebook.Tab", background=[("selected", "#4d4d4d")], foreground=[("selected", "#ffffff")])
             
             # Matplotlibの設定
-            self.fig.patch.set_facecolor('#2d2d2d')
-            self.ax.set_facecolor('#2d2d2d')
-            self.ax.title.set_color('#ffffff')
+            self.apply_figure_theme()
             
             # コンソールとリストボックスの色設定
             self.console_text.config(bg="#3d3d3d", fg="#ffffff", insertbackground="#ffffff")
@@ -167,9 +3614,7 @@ class MatrixVisualization:
             self.style.map("TNotebook.Tab", background=[("selected", "#f0f0f0")], foreground=[("selected", "#000000")])
             
             # Matplotlibの設定
-            self.fig.patch.set_facecolor('#f0f0f0')
-            self.ax.set_facecolor('#ffffff')
-            self.ax.title.set_color('#000000')
+            self.apply_figure_theme()
             
             # コンソールとリストボックスの色設定
             self.console_text.config(bg="#ffffff", fg="#000000", insertbackground="#000000")
@@ -182,7 +3627,7 @@ class MatrixVisualization:
             self.status_var.set("ライトモードに切り替えました")
         
         # キャンバスを更新
-        self.canvas.draw()
+        self.request_redraw()
         
     def create_menu(self):
         """メニューバーを作成"""
@@ -237,6 +3682,10 @@ class MatrixVisualization:
         self.root.bind("<Control-plus>", lambda e: self.zoom(1.2))
         self.root.bind("<Control-minus>", lambda e: self.zoom(0.8))
         self.root.bind("<Control-0>", lambda e: self.reset_view())
+        self.root.bind("<Control-Left>", lambda e: self.pan(-0.2, 0))
+        self.root.bind("<Control-Right>", lambda e: self.pan(0.2, 0))
+        self.root.bind("<Control-Up>", lambda e: self.pan(0, 0.2))
+        self.root.bind("<Control-Down>", lambda e: self.pan(0, -0.2))
         self.root.bind("<Control-o>", lambda e: self.load_matrix_data(filedialog.askopenfilename(filetypes=[("JSON ファイル", "*.json")])))
         self.root.bind("<Control-s>", lambda e: self.save_matrix_data(filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("JSON ファイル", "*.json")])))
     
@@ -580,6 +4029,36 @@ class MatrixVisualization:
             btn.grid(row=i//2, column=i%2, padx=5, pady=5, sticky=tk.E+tk.W)
             self.create_tooltip(btn, f"式テンプレート: {template}")
         
+        # 乗算のアニメーション
+        anim_frame = ttk.LabelFrame(parent, text="乗算アニメーション")
+        anim_frame.pack(fill=tk.X, padx=5, pady=5)
+        
+        ttk.Label(anim_frame, text="左:").grid(row=0, column=0, padx=5, pady=5, sticky=tk.W)
+        self.anim_left = ttk.Entry(anim_frame, width=8)
+        self.anim_left.grid(row=0, column=1, padx=5, pady=5, sticky=tk.W)
+        self.anim_left.insert(0, "A")
+        
+        ttk.Label(anim_frame, text="右:").grid(row=0, column=2, padx=5, pady=5, sticky=tk.W)
+        self.anim_right = ttk.Entry(anim_frame, width=8)
+        self.anim_right.grid(row=0, column=3, padx=5, pady=5, sticky=tk.W)
+        self.anim_right.insert(0, "B")
+        
+        ttk.Label(anim_frame, text="間隔 (ms):").grid(row=1, column=0, columnspan=2, padx=5, pady=5, sticky=tk.W)
+        self.anim_interval = ttk.Entry(anim_frame, width=8)
+        self.anim_interval.grid(row=1, column=2, columnspan=2, padx=5, pady=5, sticky=tk.W)
+        self.anim_interval.insert(0, "150")
+        
+        anim_buttons = [
+            ("再生/一時停止", self.toggle_multiplication_animation, "結果のセルごとに左の行と右の列を強調して再生します"),
+            ("コマ送り", self.step_multiplication_animation, "一時停止して次の結果のセルに進みます"),
+            ("停止", self.stop_multiplication_animation, "アニメーションを終了して強調を消します"),
+            ("GIF/MP4 書き出し", self.export_multiplication_animation, "全フレームをアニメーションとして保存します")
+        ]
+        for i, (text, command, tooltip) in enumerate(anim_buttons):
+            btn = ttk.Button(anim_frame, text=text, command=command)
+            btn.grid(row=2 + i//2, column=(i%2)*2, columnspan=2, padx=5, pady=5, sticky=tk.E+tk.W)
+            self.create_tooltip(btn, tooltip)
+        
         # 式の説明テキスト
         ttk.Label(parent, text="式の例: A + B = C, Det(A), A^2, Tr(B)").pack(padx=5, pady=5, anchor=tk.W)
         ttk.Label(parent, text="演算子優先順位: かっこ > べき乗 > 乗算 > 加減算").pack(padx=5, pady=5, anchor=tk.W)
@@ -739,53 +4218,143 @@ class MatrixVisualization:
     
     def on_mouse_move(self, event):
         """マウス移動時のイベントハンドラ"""
-        # キャンバス上の位置を取得
-        x, y = event.x, event.y
+        # ドラッグ移動中はホバー表示の代わりに表示範囲を動かす
+        if self.pan_start is not None:
+            self.drag_pan(event)
+            return
         
-        # データ座標に変換
-        data_x, data_y = self.ax.transData.inverted().transform((x, y))
+        # 軸の外ではホバー表示を消す
+        if event.inaxes is not self.ax or event.xdata is None:
+            self.status_var.set("準備完了")
+            self.last_selected_matrix = None
+            self.last_selected_cell = None
+            self.update_hover(None)
+            return
         
-        # セルの位置を特定
-        cell_x, cell_y = int(data_x), int(-data_y - 1)
+        # カーソル下の要素を空間インデックスで検索
+        hit = self.hit_test(event.xdata, event.ydata)
         
-        # 行列内のセルかどうかを判定
-        for name, matrix_data in self.matrices.items():
-            pos_x, pos_y = matrix_data['position']
-            rows, cols = matrix_data['values'].shape
+        if hit['cell'] is not None:
+            name, i, j = hit['cell']
             
-            if (pos_x <= data_x < pos_x + cols and 
-                -pos_y - rows <= data_y < -pos_y):
-                
-                # インデックスを計算
-                i = int(-data_y - pos_y - 1)
-                j = int(data_x - pos_x)
-                
-                if 0 <= i < rows and 0 <= j < cols:
-                    # セル情報を表示
-                    value = matrix_data['values'][i, j]
-                    self.status_var.set(f"行列: {name}, 行: {i}, 列: {j}, 値: {value}")
-                    
-                    # 選択した要素を記録
-                    self.last_selected_matrix = name
-                    self.last_selected_cell = (i, j)
-                    return
+            # セル情報を表示
+            value = self.matrices[name].values[i, j]
+            status = f"行列: {name}, 行: {i}, 列: {j}, 値: {value}"
+            if hit['color'] is not None:
+                status += f", 色: {hit['color']}"
+            self.status_var.set(status)
+            
+            # 選択した要素を記録
+            self.last_selected_matrix = name
+            self.last_selected_cell = (i, j)
+            self.update_hover(hit['cell'])
+            return
         
         # 行列外の場合
-        self.status_var.set("準備完了")
+        if hit['arrows']:
+            arrow = self.arrows[hit['arrows'][0]]
+            self.status_var.set(f"矢印 {hit['arrows'][0]+1}: "
+                                f"{arrow['source'][0]}[{arrow['source'][1]}][{arrow['source'][2]}] → "
+                                f"{arrow['target'][0]}[{arrow['target'][1]}][{arrow['target'][2]}]")
+        else:
+            self.status_var.set("準備完了")
         self.last_selected_matrix = None
         self.last_selected_cell = None
+        self.update_hover(None)
+    
+    def hit_test(self, x, y):
+        """データ座標の点にある行列のセル・色付きセル・矢印を調べる"""
+        hit = {'cell': None, 'color': None, 'arrows': []}
+        
+        for kind, key in self.spatial_index.query_point(x, y):
+            if kind == 'matrix' and hit['cell'] is None:
+                pos_x, pos_y = self.matrices[key].position
+                i = int(-y - pos_y)
+                j = int(x - pos_x)
+                hit['cell'] = (key, i, j)
+                
+                # 色付きセルなら色も返す
+                hit['color'] = self.colored_cells.get(key, i, j)
+            
+            elif kind == 'arrow':
+                # 矢印の線分までの距離で判定
+                (x0, y0), (x1, y1) = self.arrow_endpoints(self.arrows[key])
+                dx, dy = x1 - x0, y1 - y0
+                length_sq = dx * dx + dy * dy
+                t = 0.0 if length_sq == 0 else max(0.0, min(1.0, ((x - x0) * dx + (y - y0) * dy) / length_sq))
+                distance = math.hypot(x - (x0 + t * dx), y - (y0 + t * dy))
+                if distance <= 0.3 + 0.05 * math.sqrt(length_sq):
+                    hit['arrows'].append(key)
+        
+        hit['arrows'].sort()
+        return hit
+    
+    def ensure_hover_layer(self):
+        """ホバー表示用のアーティストを用意（ax.clear() 後は作り直す）"""
+        if self.scene['hover'] is None:
+            # animated=True のアーティストは通常の描画から除外され、ブリッティングでのみ描かれる
+            self.scene['hover'] = {
+                'row': patches.Rectangle((0, 0), 1, 1, facecolor='gold', edgecolor='none',
+                                         alpha=0.25, zorder=20, animated=True, visible=False),
+                'col': patches.Rectangle((0, 0), 1, 1, facecolor='gold', edgecolor='none',
+                                         alpha=0.25, zorder=20, animated=True, visible=False),
+                'cell': patches.Rectangle((0, 0), 1, 1, facecolor='none', edgecolor='darkorange',
+                                          linewidth=2.5, zorder=21, animated=True, visible=False),
+                'readout': self.ax.text(0, 0, '', ha='left', va='bottom', fontsize=10, zorder=22,
+                                        bbox=dict(facecolor='#ffffe0', edgecolor='gray', alpha=0.9),
+                                        animated=True, visible=False)
+            }
+            for key in ('row', 'col', 'cell'):
+                self.ax.add_patch(self.scene['hover'][key])
+            for artist in self.scene['hover'].values():
+                self.add_overlay('hover', artist)
+        return self.scene['hover']
+    
+    def update_hover(self, hit):
+        """カーソル下のセルとその行・列を強調表示"""
+        if hit == self.hover_cell and self.scene['hover'] is not None:
+            return
+        self.hover_cell = hit
+        layer = self.ensure_hover_layer()
+        
+        if hit is None or hit[0] not in self.matrices:
+            for artist in layer.values():
+                artist.set_visible(False)
+        else:
+            name, i, j = hit
+            matrix_data = self.matrices[name]
+            pos_x, pos_y = matrix_data.position
+            rows, cols = matrix_data.values.shape
+            
+            layer['row'].set_bounds(pos_x, -(pos_y + i) - 1, cols, 1)
+            layer['col'].set_bounds(pos_x + j, -(pos_y + rows), 1, rows)
+            layer['cell'].set_bounds(pos_x + j, -(pos_y + i) - 1, 1, 1)
+            layer['readout'].set_position((pos_x + j + 1.1, -(pos_y + i) - 0.2))
+            layer['readout'].set_text(f"{name}[{i}][{j}] = {matrix_data.values[i, j]}")
+            for artist in layer.values():
+                artist.set_visible(True)
+        
+        self.blit_hover()
+    
+    def blit_hover(self):
+        """保存済みの静的な層にホバー表示を含むオーバーレイを重ねて転送"""
+        # 再描画が予約済みなら、その描画にまとめられる
+        self.request_overlay_redraw()
+    
+    def on_canvas_draw(self, event):
+        """キャンバス全体の描画後に静的な層を保存し、オーバーレイを重ねる"""
+        # 保存中の描画は解像度が違う上、オーバーレイも通常の描画に含めているので保存しない
+        if self.canvas.is_saving():
+            return
+        self.compositor.capture()
+        self.refresh_multiplication_animation()
     
     def choose_color(self, entry_widget):
         """色選択ダイアログを表示して結果をエントリウィジェットに設定"""
         current_color = entry_widget.get()
-        if current_color in mpl.colors.CSS4_COLORS:
-            # 名前付きカラーをRGBに変換
-            rgb = mpl.colors.to_rgb(current_color)
-            initial_color = "#{:02x}{:02x}{:02x}".format(
-                int(rgb[0]*255), int(rgb[1]*255), int(rgb[2]*255))
-        elif mpl.colors.is_color_like(current_color):
-            # 既にカラーコードの場合
-            initial_color = current_color
+        if color_registry.is_valid(current_color):
+            # 名前付きカラーもカラーコードも #rrggbb に変換
+            initial_color = color_registry.to_hex(current_color)
         else:
             # デフォルト色
             initial_color = "#ff0000"
@@ -832,18 +4401,13 @@ class MatrixVisualization:
             values = np.random.randint(min_val, max_val + 1, size=(rows, cols))
             
             # 行列を保存
-            self.matrices[matrix_name] = {
-                'values': values,
-                'position': (pos_x, pos_y),
-                'rows': rows,
-                'cols': cols
-            }
+            self.matrices[matrix_name] = Matrix(matrix_name, values, (pos_x, pos_y))
             
             # リストボックスを更新
             self.update_matrices_listbox()
             
             # 可視化を更新
-            self.visualize_matrices()
+            self.show_matrix(matrix_name)
             
             self.status_var.set(f"ランダム行列 '{matrix_name}' を生成しました")
             
@@ -905,18 +4469,13 @@ class MatrixVisualization:
                     values[i, i] = i + 1
             
             # 行列を保存
-            self.matrices[matrix_name] = {
-                'values': values,
-                'position': (pos_x, pos_y),
-                'rows': rows,
-                'cols': cols
-            }
+            self.matrices[matrix_name] = Matrix(matrix_name, values, (pos_x, pos_y))
             
             # リストボックスを更新
             self.update_matrices_listbox()
             
             # 可視化を更新
-            self.visualize_matrices()
+            self.show_matrix(matrix_name)
             
             matrix_type_names = {
                 "identity": "単位行列",
@@ -948,8 +4507,8 @@ class MatrixVisualization:
             end_row = int(self.range_end_row.get())
             end_col = int(self.range_end_col.get())
             
-            matrix_rows = self.matrices[matrix_name]['rows']
-            matrix_cols = self.matrices[matrix_name]['cols']
+            matrix_rows = self.matrices[matrix_name].rows
+            matrix_cols = self.matrices[matrix_name].cols
             
             # 範囲のバリデーション
             if (start_row < 0 or start_row >= matrix_rows or 
@@ -973,29 +4532,17 @@ class MatrixVisualization:
         if color and color.lower() != "none":
             try:
                 # 色名の検証
-                if not (color in mpl.colors.CSS4_COLORS or mpl.colors.is_color_like(color)):
+                if not color_registry.is_valid(color):
                     raise ValueError(f"'{color}' は有効な色名またはカラーコードではありません。")
                 
-                # 範囲内の各セルに色を適用
-                for row in range(start_row, end_row + 1):
-                    for col in range(start_col, end_col + 1):
-                        # 既存の色設定を削除
-                        self.colored_cells = [cell for cell in self.colored_cells 
-                                          if not (cell['matrix'] == matrix_name and cell['row'] == row and cell['col'] == col)]
-                        
-                        # 色設定を追加
-                        self.colored_cells.append({
-                            'matrix': matrix_name,
-                            'row': row,
-                            'col': col,
-                            'color': color
-                        })
+                # 範囲内の各セルに色を適用（既存の色設定は置き換え）
+                self.colored_cells.set_range(matrix_name, start_row, start_col, end_row, end_col, color)
                 
                 # 色付き要素リストを更新
                 self.update_colored_cells_listbox()
                 
                 # 可視化を更新
-                self.visualize_matrices()
+                self.refresh_colored_range(matrix_name, start_row, start_col, end_row, end_col)
                 
                 self.status_var.set(f"範囲 ({start_row},{start_col}) から ({end_row},{end_col}) に色 '{color}' を適用しました")
                 
@@ -1004,16 +4551,13 @@ class MatrixVisualization:
                 return
         elif color.lower() == "none":
             # 範囲内の色設定を削除
-            for row in range(start_row, end_row + 1):
-                for col in range(start_col, end_col + 1):
-                    self.colored_cells = [cell for cell in self.colored_cells 
-                                       if not (cell['matrix'] == matrix_name and cell['row'] == row and cell['col'] == col)]
+            self.colored_cells.clear_range(matrix_name, start_row, start_col, end_row, end_col)
             
             # 色付き要素リストを更新
             self.update_colored_cells_listbox()
             
             # 可視化を更新
-            self.visualize_matrices()
+            self.refresh_colored_range(matrix_name, start_row, start_col, end_row, end_col)
             
             self.status_var.set(f"範囲 ({start_row},{start_col}) から ({end_row},{end_col}) の色を削除しました")
     
@@ -1049,18 +4593,14 @@ class MatrixVisualization:
             
             # 行列データをコピー
             original_data = self.matrices[selected_matrix]
-            self.matrices[new_name] = {
-                'values': original_data['values'].copy(),
-                'position': (original_data['position'][0] + 1, original_data['position'][1] + 1),  # 少しずらす
-                'rows': original_data['rows'],
-                'cols': original_data['cols']
-            }
+            pos_x, pos_y = original_data.position
+            self.matrices[new_name] = original_data.copy(new_name, (pos_x + 1, pos_y + 1))  # 少しずらす
             
             # リストを更新
             self.update_matrices_listbox()
             
             # 可視化を更新
-            self.visualize_matrices()
+            self.show_matrix(new_name)
             
             self.status_var.set(f"行列 '{selected_matrix}' を '{new_name}' として複製しました")
     
@@ -1071,9 +4611,16 @@ class MatrixVisualization:
         
         # 行列データ
         matrix_data = self.matrices[matrix_name]
-        values = matrix_data['values']
+        values = matrix_data.values
         rows, cols = values.shape
         
+        # 疎行列とメモリマップの行列はすべてのセルの入力欄を作ると大きくなりすぎるので、小さいものだけ編集できる
+        if (matrix_data.is_sparse or matrix_data.is_mapped) and rows * cols > self.editor_max_cells:
+            messagebox.showinfo("情報", f"行列 '{matrix_name}' ({rows}x{cols}) は大きすぎるため、"
+                                "セル操作タブかコンソールで編集してください。")
+            return
+        values = dense_values(values)
+        
         # ダイアログを作成
         editor = tk.Toplevel(self.root)
         editor.title(f"行列 '{matrix_name}' の編集")
@@ -1145,12 +4692,12 @@ class MatrixVisualization:
         ttk.Label(pos_frame, text="X:").grid(row=0, column=0, padx=5, pady=5)
         pos_x_entry = ttk.Spinbox(pos_frame, from_=0, to=20, width=5)
         pos_x_entry.grid(row=0, column=1, padx=5, pady=5)
-        pos_x_entry.set(str(matrix_data['position'][0]))
+        pos_x_entry.set(str(matrix_data.position[0]))
         
         ttk.Label(pos_frame, text="Y:").grid(row=0, column=2, padx=5, pady=5)
         pos_y_entry = ttk.Spinbox(pos_frame, from_=0, to=20, width=5)
         pos_y_entry.grid(row=0, column=3, padx=5, pady=5)
-        pos_y_entry.set(str(matrix_data['position'][1]))
+        pos_y_entry.set(str(matrix_data.position[1]))
         
         # 行列名変更フレーム
         name_frame = ttk.LabelFrame(button_frame, text="行列名")
@@ -1203,32 +4750,39 @@ class MatrixVisualization:
             messagebox.showerror("エラー", "すべての値は数値である必要があります。", parent=dialog)
             return
         
-        # 古い行列のデータを保存
-        old_matrix_data = self.matrices[old_name]
+        # 値と位置を差し替える（値を変えたときだけバージョンが進む）
+        matrix = self.matrices[old_name]
+        if matrix.is_mapped:
+            # メモリマップの行列は値を差し替えるとファイルの参照と書き込みの上書きが失われるので、
+            # 変わったセルだけを書き込む（整数のファイルに書き込めない値があれば何も書き込まない）
+            changed = np.argwhere(matrix.values[:, :] != new_values)
+            if matrix.values.dtype.kind in 'biu' and not all(float(new_values[i, j]).is_integer() for i, j in changed):
+                messagebox.showerror("エラー", f"行列 '{old_name}' は整数の行列のため、整数でない値は書き込めません。", parent=dialog)
+                return
+            for i, j in changed:
+                matrix.set_cell(i, j, new_values[i, j])
+        else:
+            if matrix.is_sparse:
+                new_values = sparse.csr_array(new_values)
+            try:
+                matrix.values = new_values
+            except ValueError as e:
+                messagebox.showerror("エラー", str(e), parent=dialog)
+                return
+        matrix.position = (pos_x, pos_y)
         
         # 行列を更新
         if new_name != old_name:
-            # 名前が変わった場合は古い行列を削除し、新しい行列を追加
+            # 名前が変わった場合は古い名前の登録を削除し、新しい名前で登録し直す
             del self.matrices[old_name]
+            matrix.name = new_name
             
             # 関連する矢印と色付き要素を更新
-            for arrow in self.arrows:
-                if arrow['source'][0] == old_name:
-                    arrow['source'] = (new_name, arrow['source'][1], arrow['source'][2])
-                if arrow['target'][0] == old_name:
-                    arrow['target'] = (new_name, arrow['target'][1], arrow['target'][2])
-            
-            for cell in self.colored_cells:
-                if cell['matrix'] == old_name:
-                    cell['matrix'] = new_name
-        
-        # 新しい行列データを保存
-        self.matrices[new_name] = {
-            'values': new_values,
-            'position': (pos_x, pos_y),
-            'rows': rows,
-            'cols': cols
-        }
+            self.arrows.rename_matrix(old_name, new_name)
+            self.colored_cells.rename_matrix(old_name, new_name)
+            self.cell_labels.discard(old_name)
+        
+        self.matrices[new_name] = matrix
         
         # リストを更新
         self.update_matrices_listbox()
@@ -1294,7 +4848,10 @@ class MatrixVisualization:
             # 矢印を削除（後で更新される）
             del self.arrows[index]
             self.update_arrows_listbox()
-            self.visualize_matrices()
+            self.remove_artists(self.scene['arrows'].pop(index))
+            self.update_arrow_layer()
+            self.reindex_arrows()
+            self.request_overlay_redraw()
             
             self.status_var.set(f"矢印 {index+1} を編集モードにしました。編集後に「矢印を追加」をクリックしてください。")
     
@@ -1324,14 +4881,15 @@ class MatrixVisualization:
             
             # 値も設定
             if cell_data['matrix'] in self.matrices:
-                value = self.matrices[cell_data['matrix']]['values'][cell_data['row'], cell_data['col']]
+                value = self.matrices[cell_data['matrix']].values[cell_data['row'], cell_data['col']]
                 self.cell_value.delete(0, tk.END)
                 self.cell_value.insert(0, str(value))
             
             # 色付き要素を削除（後で更新される）
-            del self.colored_cells[index]
+            self.colored_cells.pop_index(index)
             self.update_colored_cells_listbox()
-            self.visualize_matrices()
+            self.refresh_colored_cell(cell_data['matrix'], cell_data['row'], cell_data['col'])
+            self.request_overlay_redraw()
             
             self.status_var.set(f"色付き要素 {index+1} を編集モードにしました。編集後に「設定」をクリックしてください。")
     
@@ -1351,22 +4909,56 @@ class MatrixVisualization:
         self.ax.set_xlim(center_x - width/2, center_x + width/2)
         self.ax.set_ylim(center_y - height/2, center_y + height/2)
         
+        # 詳細度を更新（xlim_changed コールバックでも呼ばれるが明示的に）
+        self.update_level_of_detail()
+        
         # キャンバスを更新
-        self.canvas.draw()
+        self.request_redraw()
         
         zoom_type = "拡大" if factor > 1 else "縮小"
         self.status_var.set(f"表示を{zoom_type}しました")
     
+    def pan(self, dx, dy):
+        """表示範囲を幅・高さに対する割合だけ移動"""
+        x_min, x_max = self.ax.get_xlim()
+        y_min, y_max = self.ax.get_ylim()
+        shift_x = (x_max - x_min) * dx
+        shift_y = (y_max - y_min) * dy
+        self.ax.set_xlim(x_min + shift_x, x_max + shift_x)
+        self.ax.set_ylim(y_min + shift_y, y_max + shift_y)
+        self.request_redraw()
+
+    def on_pan_press(self, event):
+        """中ボタンでのドラッグ移動を開始"""
+        if event.button == 2 and event.inaxes == self.ax:
+            self.pan_start = (event.x, event.y, self.ax.get_xlim(), self.ax.get_ylim())
+
+    def on_pan_release(self, event):
+        """ドラッグ移動を終了"""
+        self.pan_start = None
+
+    def drag_pan(self, event):
+        """ドラッグ中のマウス位置に合わせて表示範囲を移動"""
+        x, y, (x_min, x_max), (y_min, y_max) = self.pan_start
+        # ピクセルの移動量をデータ座標に換算
+        width, height = self.ax.bbox.width, self.ax.bbox.height
+        shift_x = (event.x - x) / width * (x_max - x_min)
+        shift_y = (event.y - y) / height * (y_max - y_min)
+        self.ax.set_xlim(x_min - shift_x, x_max - shift_x)
+        self.ax.set_ylim(y_min - shift_y, y_max - shift_y)
+        self.request_redraw()
+
     def reset_view(self):
         """表示範囲をリセット"""
         self.adjust_plot_limits()
-        self.canvas.draw()
+        self.update_level_of_detail()
+        self.request_redraw()
         self.status_var.set("表示範囲をリセットしました")
     
     def toggle_grid(self):
         """グリッド表示を切り替え"""
         self.ax.grid(not self.ax.xaxis._gridOnMajor)
-        self.canvas.draw()
+        self.request_redraw()
         
         grid_status = "表示" if self.ax.xaxis._gridOnMajor else "非表示"
         self.status_var.set(f"グリッドを{grid_status}にしました")
@@ -1386,12 +4978,22 @@ class MatrixVisualization:
         
         if selected_matrix in self.matrices:
             matrix_data = self.matrices[selected_matrix]
-            values = matrix_data['values']
+            values = matrix_data.values
+            if matrix_data.is_mapped and matrix_data.rows * matrix_data.cols > self.editor_max_cells:
+                messagebox.showinfo("情報", f"行列 '{selected_matrix}' はファイルをメモリマップした大きな行列のため、"
+                                    f"コピーできません: {matrix_data.source}")
+                return
             
-            # 行列をテキスト形式に変換
+            # 行列をテキスト形式に変換（疎行列は非ゼロ要素を「行 列 値」の行で書き出す）
             text = f"行列 {selected_matrix}:\n"
-            for row in values:
-                text += " ".join(str(val) for val in row) + "\n"
+            if matrix_data.is_sparse:
+                rows, cols = matrix_data.nonzero_cells()
+                text += f"疎行列 {matrix_data.rows}x{matrix_data.cols} 非ゼロ {matrix_data.nnz} 個\n"
+                text += "".join(f"{i} {j} {val}\n" for i, j, val in
+                                zip(rows.tolist(), cols.tolist(), values[rows, cols].tolist()))
+            else:
+                for row in values:
+                    text += " ".join(str(val) for val in row) + "\n"
             
             # クリップボードにコピー
             self.root.clipboard_clear()
@@ -1525,123 +5127,124 @@ class MatrixVisualization:
                 self.matrix_name.insert(0, selected_matrix)
                 
                 self.rows.delete(0, tk.END)
-                self.rows.insert(0, str(matrix_data['rows']))
+                self.rows.insert(0, str(matrix_data.rows))
                 
                 self.cols.delete(0, tk.END)
-                self.cols.insert(0, str(matrix_data['cols']))
+                self.cols.insert(0, str(matrix_data.cols))
                 
                 self.pos_x.delete(0, tk.END)
-                self.pos_x.insert(0, str(matrix_data['position'][0]))
+                self.pos_x.insert(0, str(matrix_data.position[0]))
                 
                 self.pos_y.delete(0, tk.END)
-                self.pos_y.insert(0, str(matrix_data['position'][1]))
+                self.pos_y.insert(0, str(matrix_data.position[1]))
                 
                 self.status_var.set(f"行列 '{selected_matrix}' を選択しました")
                 
-                # 行列を強調表示（一時的に枠を変更）
-                for name, data in self.matrices.items():
-                    pos_x, pos_y = data['position']
-                    rows, cols = data['values'].shape
-                    
-                    if name == selected_matrix:
-                        # 選択された行列を強調
-                        rect = patches.Rectangle((pos_x-0.2, -(pos_y-0.2)-rows-0.2), cols+0.4, rows+0.4, 
-                                             linewidth=2, edgecolor='blue', facecolor='none', linestyle='--')
-                        self.ax.add_patch(rect)
+                # 選択された行列を強調（前の選択の強調は消す）
+                pos_x, pos_y = matrix_data.position
+                rows, cols = matrix_data.values.shape
+                self.clear_overlay('selection')
+                rect = patches.Rectangle((pos_x-0.2, -(pos_y-0.2)-rows-0.2), cols+0.4, rows+0.4, 
+                                     linewidth=2, edgecolor='blue', facecolor='none', linestyle='--', zorder=12)
+                self.add_overlay('selection', self.ax.add_patch(rect))
                 
-                # キャンバスを更新
-                self.canvas.draw()
+                # キャンバスを更新（選択の強調はオーバーレイなので格子は描き直さない）
+                self.request_overlay_redraw()
 
     def reset_all(self):
         """すべてのデータをリセット"""
         if messagebox.askyesno("確認", "すべての行列、矢印、色付き要素をリセットしますか？"):
             self.matrices = {}
-            self.arrows = []
-            self.colored_cells = []
+            self.arrows = ArrowTable()
+            self.colored_cells = ColoredCellIndex()
+            self.cell_labels = CellLabelCache()
+            self.tile_cache.clear()
+            self.expression_results = {}
             self.matrices_listbox.delete(0, tk.END)
             self.arrows_listbox.delete(0, tk.END)
             self.colored_cells_listbox.delete(0, tk.END)
             self.ax.clear()
+            self.reset_scene()
             self.ax.set_title('行列演算の可視化', fontsize=16, color='black' if not self.is_dark_mode else 'white')
             self.ax.axis('off')
-            self.canvas.draw()
+            self.request_redraw()
             self.status_var.set("すべてのデータをリセットしました")
 
     def update_matrices_listbox(self):
         """行列リストを更新"""
         self.matrices_listbox.delete(0, tk.END)
         for name, matrix_data in self.matrices.items():
-            shape = f"{matrix_data['rows']}x{matrix_data['cols']}"
-            pos = f"位置: ({matrix_data['position'][0]}, {matrix_data['position'][1]})"
+            # 式の評価結果の行列は一時的なので載せない
+            if self.is_expression_result(name):
+                continue
+            shape = f"{matrix_data.rows}x{matrix_data.cols}"
+            pos = f"位置: ({matrix_data.position[0]}, {matrix_data.position[1]})"
             self.matrices_listbox.insert(tk.END, f"{name} ({shape}) - {pos}")
 
     def update_arrows_listbox(self):
         """矢印リストを更新"""
         self.arrows_listbox.delete(0, tk.END)
+        items = []
         for i, arrow in enumerate(self.arrows):
             source = f"{arrow['source'][0]}[{arrow['source'][1]},{arrow['source'][2]}]"
             target = f"{arrow['target'][0]}[{arrow['target'][1]},{arrow['target'][2]}]"
-            style_info = f" {arrow.get('style', '-|>')} {arrow.get('width', 2.0)}"
-            self.arrows_listbox.insert(tk.END, f"{i+1}: {source} → {target} ({arrow['color']}{style_info})")
+            style_info = f" {arrow['style']} {arrow['width']}"
+            items.append(f"{i+1}: {source} → {target} ({arrow['color']}{style_info})")
+        if items:
+            self.arrows_listbox.insert(tk.END, *items)
 
     def update_colored_cells_listbox(self):
         """色付き要素リストを更新"""
         self.colored_cells_listbox.delete(0, tk.END)
+        items = []
         for i, cell in enumerate(self.colored_cells):
             value = "?"
             if cell['matrix'] in self.matrices:
-                if 0 <= cell['row'] < self.matrices[cell['matrix']]['rows'] and \
-                0 <= cell['col'] < self.matrices[cell['matrix']]['cols']:
-                    value = str(self.matrices[cell['matrix']]['values'][cell['row'], cell['col']])
+                if 0 <= cell['row'] < self.matrices[cell['matrix']].rows and \
+                0 <= cell['col'] < self.matrices[cell['matrix']].cols:
+                    value = str(self.matrices[cell['matrix']].values[cell['row'], cell['col']])
             
-            self.colored_cells_listbox.insert(tk.END, 
-                f"{i+1}: {cell['matrix']}[{cell['row']},{cell['col']}] = {value} ({cell['color']})")
+            items.append(f"{i+1}: {cell['matrix']}[{cell['row']},{cell['col']}] = {value} ({cell['color']})")
+        
+        # まとめて挿入（1件ずつの挿入は件数が多いと遅い）
+        if items:
+            self.colored_cells_listbox.insert(tk.END, *items)
 
     def save_matrix_data(self, file_path):
         """行列データをJSONファイルに保存"""
         try:
             # 行列データの変換
             matrices_data = []
+            # 式の評価結果の行列は一時的なので、それに付けた矢印や色付きセルも含めて保存しない
+            transient = {name for name in self.matrices if self.is_expression_result(name)}
             for name, matrix_data in self.matrices.items():
-                matrices_data.append({
+                if name in transient:
+                    continue
+                entry = {
                     'name': name,
-                    'rows': matrix_data['rows'],
-                    'cols': matrix_data['cols'],
-                    'position': list(matrix_data['position']),
-                    'values': matrix_data['values'].tolist()  # NumPy配列をリストに変換
-                })
-            
-            # 矢印データの変換
-            arrows_data = []
-            for arrow in self.arrows:
-                arrow_data = {
-                    'source': list(arrow['source']),
-                    'target': list(arrow['target']),
-                    'color': arrow['color']
+                    'rows': matrix_data.rows,
+                    'cols': matrix_data.cols,
+                    'position': list(matrix_data.position),
+                    'dtype_policy': matrix_data.dtype_policy
                 }
-                if 'style' in arrow:
-                    arrow_data['style'] = arrow['style']
-                if 'width' in arrow:
-                    arrow_data['width'] = arrow['width']
-                if 'label' in arrow:
-                    arrow_data['label'] = arrow['label']
-                arrows_data.append(arrow_data)
-            
-            # 色付きセルデータの変換
-            colored_cells_data = []
-            for cell in self.colored_cells:
-                colored_cells_data.append({
-                    'matrix': cell['matrix'],
-                    'row': cell['row'],
-                    'col': cell['col'],
-                    'color': cell['color']
-                })
+                if matrix_data.is_mapped:
+                    # メモリマップの行列はファイルを参照し、書き込んだセルだけを保存する
+                    entry['file'] = os.path.relpath(matrix_data.source, os.path.dirname(os.path.abspath(file_path)))
+                    entry['edits'] = [[row, col, value] for (row, col), value in matrix_data.edits.items()]
+                elif matrix_data.is_sparse:
+                    # 疎行列は非ゼロ要素だけを COO 形式で保存
+                    coo = matrix_data.values.tocoo()
+                    entry['sparse'] = {'row': coo.row.tolist(), 'col': coo.col.tolist(), 'data': coo.data.tolist()}
+                else:
+                    entry['values'] = matrix_data.values.tolist()  # NumPy配列をリストに変換
+                matrices_data.append(entry)
             
-            # 全データを１つのオブジェクトにまとめる
+            # 全データを１つのオブジェクトにまとめる（矢印と色付きセルは列単位で変換）
             data = {
                 'matrices': matrices_data,
-                'arrows': arrows_data,
-                'colored_cells': colored_cells_data
+                'arrows': [arrow for arrow in self.arrows.to_json()
+                           if arrow['source'][0] not in transient and arrow['target'][0] not in transient],
+                'colored_cells': [cell for cell in self.colored_cells.to_json() if cell['matrix'] not in transient]
             }
             
             # JSONファイルに保存
@@ -1669,6 +5272,7 @@ class MatrixVisualization:
             self.matrices = matrices
             self.arrows = arrows
             self.colored_cells = colored_cells
+            self.expression_results = {}
             
             # リストを更新
             self.update_matrices_listbox()
@@ -1732,18 +5336,13 @@ class MatrixVisualization:
                 counter += 1
         
         # 行列を保存
-        self.matrices[name] = {
-            'values': values,
-            'position': (pos_x, pos_y),
-            'rows': rows,
-            'cols': cols
-        }
+        self.matrices[name] = Matrix(name, values, (pos_x, pos_y))
         
         # リストボックスを更新
         self.update_matrices_listbox()
         
         # 可視化を更新
-        self.visualize_matrices()
+        self.show_matrix(name)
         
         self.status_var.set(f"行列 '{name}' を追加しました")
 
@@ -1758,13 +5357,13 @@ class MatrixVisualization:
         
         if messagebox.askyesno("確認", f"行列 '{selected_matrix}' を削除しますか？"):
             # 関連する矢印と色付き要素も削除
-            self.arrows = [arrow for arrow in self.arrows 
-                        if arrow['source'][0] != selected_matrix and arrow['target'][0] != selected_matrix]
-            self.colored_cells = [cell for cell in self.colored_cells if cell['matrix'] != selected_matrix]
+            self.arrows.remove_matrix(selected_matrix)
+            self.colored_cells.remove_matrix(selected_matrix)
             
             # 行列を削除
             if selected_matrix in self.matrices:
                 del self.matrices[selected_matrix]
+            self.cell_labels.discard(selected_matrix)
                 
             # リストを更新
             self.update_matrices_listbox()
@@ -1772,48 +5371,21 @@ class MatrixVisualization:
             self.update_colored_cells_listbox()
             
             # 可視化を更新
-            self.visualize_matrices()
+            self.sync_multiplication_animation(selected_matrix)
+            self.remove_matrix_artists(selected_matrix)
+            self.remove_colored_overlay(selected_matrix)
+            self.refresh_arrows()
+            self.adjust_plot_limits()
+            self.request_redraw()
             
             self.status_var.set(f"行列 '{selected_matrix}' を削除しました")
 
     def visualize_matrices(self):
         """行列と矢印を描画"""
-        self.ax.clear()
-        
-        # 行列を描画
-        self.draw_matrices()
-        
-        # 矢印を描画
-        self.draw_arrows()
-        
-        # 色付き要素を描画
-        self.draw_colored_cells()
-        
-        # グラフの表示範囲を調整
-        self.adjust_plot_limits()
-        
-        # タイトルを設定
-        self.ax.set_title('行列演算の可視化', fontsize=16, color='black' if not self.is_dark_mode else 'white')
+        self.render_scene()
         
         # キャンバスを更新
-        self.canvas.draw()
-
-    def adjust_plot_limits(self):
-        """プロットの表示範囲を調整"""
-        max_x, min_y = 0, 0
-        padding = 2
-        
-        # 行列の範囲を計算
-        for matrix_data in self.matrices.values():
-            pos_x, pos_y = matrix_data['position']
-            rows, cols = matrix_data['values'].shape
-            max_x = max(max_x, pos_x + cols + 0.5)
-            min_y = min(min_y, -(pos_y + rows + 0.5))
-        
-        self.ax.set_xlim(-padding, max_x + padding)
-        self.ax.set_ylim(min_y - padding, padding)
-        self.ax.set_aspect('equal')
-        self.ax.axis('off')
+        self.request_redraw()
 
     def evaluate_expression(self):
         """行列式を評価"""
@@ -1827,234 +5399,56 @@ class MatrixVisualization:
 
     def parse_and_visualize_expression(self, expr):
         """式を解析して可視化する"""
-        # イコールで分割
-        parts = expr.split('=')
-        
-        # それぞれの部分を個別に解析
-        equation_parts = []
+        # 構文木は式の文字列ごとにキャッシュされる（同じ式の再評価では解析しない）
+        try:
+            trees = expression_parser.parse(expr)
+        except ValueError as e:
+            messagebox.showerror("エラー", f"式を解析できません: {e}")
+            return
         
-        for part in parts:
-            part = part.strip()
-            if not part:
-                continue
-                
-            # 式を分解する
-            # まずかっこ付きの演算子（Det, Tr）を処理
-            parenthesis_ops = {'Det(': 'Det', 'Tr(': 'Tr'}
-            processed_expr = part
-            bracket_contents = {}
-            bracket_count = 0
-            
-            for op_start in parenthesis_ops:
-                op_name = parenthesis_ops[op_start]
-                start_idx = 0
-                while True:
-                    # 演算子の開始位置を見つける
-                    start_pos = processed_expr.find(op_start, start_idx)
-                    if start_pos == -1:
-                        break
-                        
-                    # 対応する閉じかっこを見つける
-                    bracket_level = 1
-                    end_pos = start_pos + len(op_start)
-                    while end_pos < len(processed_expr) and bracket_level > 0:
-                        if processed_expr[end_pos] == '(':
-                            bracket_level += 1
-                        elif processed_expr[end_pos] == ')':
-                            bracket_level -= 1
-                        end_pos += 1
-                    
-                    if bracket_level > 0:
-                        messagebox.showerror("エラー", f"式の括弧が閉じられていません: {expr}")
-                        return
-                    
-                    # 括弧内の内容を保存
-                    content = processed_expr[start_pos + len(op_start):end_pos - 1]
-                    placeholder = f"__OP{bracket_count}__"
-                    bracket_contents[placeholder] = (op_name, content)
-                    
-                    # 式を更新
-                    processed_expr = processed_expr[:start_pos] + placeholder + processed_expr[end_pos:]
-                    bracket_count += 1
-                    start_idx = start_pos + len(placeholder)
-            
-            # 残りの演算子を処理
-            remaining_ops = ['+', '-', '*', '^']
-            operations = []
-            terms = []
-            current_term = ""
-            
-            i = 0
-            while i < len(processed_expr):
-                char = processed_expr[i]
-                
-                # べき乗の特殊処理
-                if char == '^':
-                    operations.append(char)
-                    if current_term:
-                        terms.append(current_term.strip())
-                        current_term = ""
-                    
-                    # 指数を取得
-                    i += 1
-                    exponent = ""
-                    # 負の指数のケース
-                    if i < len(processed_expr) and processed_expr[i] == '-':
-                        exponent += '-'
-                        i += 1
-                    
-                    # 指数の数値部分
-                    while i < len(processed_expr) and (processed_expr[i].isdigit() or processed_expr[i] == '.'):
-                        exponent += processed_expr[i]
-                        i += 1
-                    
-                    # 指数が既存の行列名でない場合、自動的に作成
-                    if exponent and exponent not in self.matrices:
-                        try:
-                            exponent_value = float(exponent)
-                            # 整数に変換可能なら整数に
-                            if exponent_value == int(exponent_value):
-                                exponent_value = int(exponent_value)
-                            
-                            # 1x1の行列として作成
-                            self.matrices[exponent] = {
-                                'values': np.array([[exponent_value]]),
-                                'position': (10, 0),  # 適当な位置
-                                'rows': 1,
-                                'cols': 1
-                            }
-                            self.update_matrices_listbox()
-                        except ValueError:
-                            pass  # 数値でない場合は無視
-                    
-                    terms.append(exponent.strip())
-                    continue
-                
-                # 通常の演算子
-                elif char in remaining_ops:
-                    if current_term:
-                        terms.append(current_term.strip())
-                        current_term = ""
-                    operations.append(char)
-                else:
-                    current_term += char
-                
-                i += 1
-            
-            if current_term:
-                terms.append(current_term.strip())
-            
-            # 括弧内容を元に戻す
-            for i, term in enumerate(terms):
-                if term in bracket_contents:
-                    op_name, content = bracket_contents[term]
-                    terms[i] = (op_name, content)
-            
-            # 行列が定義されているか確認し、必要に応じて自動作成
-            all_matrices = set()
-            for term in terms:
-                if isinstance(term, str):
-                    if term not in self.matrices and term.strip().isdigit():
-                        # 数値の場合、1x1行列として自動作成
-                        value = int(term.strip())
-                        self.matrices[term] = {
-                            'values': np.array([[value]]),
-                            'position': (10, 0),  # 適当な位置
-                            'rows': 1,
-                            'cols': 1
-                        }
-                        self.update_matrices_listbox()
-                    
-                    if term in self.matrices:
-                        all_matrices.add(term)
-                    else:
-                        messagebox.showerror("エラー", f"行列 '{term}' が定義されていません。")
-                        return
-                elif isinstance(term, tuple):
-                    op_name, content = term
-                    if content in self.matrices:
-                        all_matrices.add(content)
-                    else:
-                        messagebox.showerror("エラー", f"行列 '{content}' が定義されていません。")
-                        return
-            
-            equation_parts.append((terms, operations))
+        # 数値の項や指数はスカラーとして評価する（行列は作らない）
+        for tree in trees:
+            # 行列が定義されているか確認
+            for name in tree.names():
+                if name not in self.matrices:
+                    messagebox.showerror("エラー", f"行列 '{name}' が定義されていません。")
+                    return
         
         # 可視化
-        self.visualize_expression(equation_parts)
+        self.visualize_expression(trees)
+
+    def expression_operand(self, node):
+        """ノードが行列1つだけを表すならその行列名を返す"""
+        if isinstance(node, NameNode) and node.name in self.matrices:
+            return node.name
+        return None
 
-    def visualize_expression(self, equation_parts):
-        """式の評価結果をビジュアライズ"""
+    def visualize_expression(self, trees):
+        """式の評価結果をビジュアライズ（trees は等式の各辺の構文木）"""
+        # 各辺を評価し、行列になった結果はキャンバスに配置してから描画する
+        message = self.evaluate_expression_sides(trees)
+        
         self.ax.clear()
+        self.reset_scene()
+        self.connect_view_callbacks()
         
         # 行列を描画
         self.draw_matrices()
         
-        # 各部分の式を評価
-        for part_idx, (terms, operations) in enumerate(equation_parts):
-            # 特殊演算（Det, Tr）を適用
-            for i, term in enumerate(terms):
-                if isinstance(term, tuple):
-                    op_name, matrix_name = term
-                    if matrix_name in self.matrices:
-                        matrix_data = self.matrices[matrix_name]
-                        
-                        if op_name == 'Det':
-                            # 行列式の視覚化
-                            self.visualize_determinant(matrix_name, matrix_data)
-                            
-                        elif op_name == 'Tr':
-                            # トレースの視覚化
-                            self.visualize_trace(matrix_name, matrix_data)
-            
-            # 通常の二項演算を適用
-            if len(terms) >= 2 and len(operations) >= 1:
-                for i in range(len(operations)):
-                    if i+1 < len(terms):
-                        left_term = terms[i]
-                        right_term = terms[i+1]
-                        op = operations[i]
-                        
-                        # 項が特殊演算の場合は処理をスキップ（既に処理済み）
-                        if isinstance(left_term, tuple) or isinstance(right_term, tuple):
-                            continue
-                        
-                        if left_term in self.matrices and right_term in self.matrices:
-                            if op == '+' or op == '-':
-                                self.visualize_addition_subtraction(left_term, right_term, op)
-                            elif op == '*':
-                                self.visualize_multiplication(left_term, right_term)
-                            elif op == '^':
-                                self.visualize_power(left_term, right_term)
+        # 各辺の式の演算を順に可視化
+        for tree in trees:
+            self.visualize_expression_node(tree)
         
         # 等号の表示（2つ以上の部分がある場合）
-        if len(equation_parts) >= 2:
+        if len(trees) >= 2:
             # 左辺と右辺の中央位置を計算
-            left_matrices = equation_parts[0][0]
-            right_matrices = equation_parts[1][0]
-            
             left_positions = []
             right_positions = []
-            
-            for term in left_matrices:
-                if isinstance(term, str) and term in self.matrices:
-                    pos_x, pos_y = self.matrices[term]['position']
-                    rows, cols = self.matrices[term]['values'].shape
-                    left_positions.append((pos_x, pos_y, cols, rows))
-                elif isinstance(term, tuple) and term[1] in self.matrices:
-                    pos_x, pos_y = self.matrices[term[1]]['position']
-                    rows, cols = self.matrices[term[1]]['values'].shape
-                    left_positions.append((pos_x, pos_y, cols, rows))
-            
-            for term in right_matrices:
-                if isinstance(term, str) and term in self.matrices:
-                    pos_x, pos_y = self.matrices[term]['position']
-                    rows, cols = self.matrices[term]['values'].shape
-                    right_positions.append((pos_x, pos_y, cols, rows))
-                elif isinstance(term, tuple) and term[1] in self.matrices:
-                    pos_x, pos_y = self.matrices[term[1]]['position']
-                    rows, cols = self.matrices[term[1]]['values'].shape
-                    right_positions.append((pos_x, pos_y, cols, rows))
+            for tree, positions in ((trees[0], left_positions), (trees[1], right_positions)):
+                for name in self.expression_matrix_names(tree):
+                    pos_x, pos_y = self.matrices[name].position
+                    rows, cols = self.matrices[name].values.shape
+                    positions.append((pos_x, pos_y, cols, rows))
             
             if left_positions and right_positions:
                 # 左辺の最右端
@@ -2069,7 +5463,7 @@ class MatrixVisualization:
                 avg_y = -sum(y + h/2 for x, y, w, h in left_positions + right_positions) / len(left_positions + right_positions)
                 
                 # 等号を表示
-                self.ax.text(eq_center_x, avg_y, "=", ha='center', va='center', fontsize=16, fontweight='bold')
+                self.add_overlay('operations', self.ax.text(eq_center_x, avg_y, "=", ha='center', va='center', fontsize=16, fontweight='bold'))
         
         # 矢印と色付き要素を描画
         self.draw_arrows()
@@ -2078,83 +5472,255 @@ class MatrixVisualization:
         # グラフの表示範囲を調整
         self.adjust_plot_limits()
         
+        self.update_level_of_detail()
+        
         # キャンバスを更新
-        self.canvas.draw()
+        self.request_redraw()
+        self.status_var.set(message)
+
+    def evaluate_expression_sides(self, trees):
+        """等式の各辺を評価して結果の行列を配置し、ステータスバーに出す文字列を返す"""
+        messages = []
+        values = []
+        # 前の評価の結果の行列は、同じ式の辺のもの以外は取り除く（結果は辺ごとに1つだけ置く）
+        self.remove_expression_results(keep={str(tree) for tree in trees})
+        # 辺をまたいで共通の部分式は1回だけ計算される
+        evaluator = self.expression_evaluator
+        for tree, value in zip(trees, evaluator.evaluate_all(trees, self.matrices)):
+            if isinstance(value, ValueError):
+                messages.append(str(value))
+                continue
+            values.append(value)
+            shape = value_shape(value)
+            if not shape:
+                messages.append(f"{tree} = {format_cell_value(value)}")
+            elif self.expression_operand(tree) is None:
+                name = self.place_expression_result(tree, value)
+                if name is None:
+                    messages.append(f"{tree}: 同じ名前の行列があるため結果を配置しません")
+                else:
+                    messages.append(f"{tree} = 行列 '{name}' ({shape[0]}×{shape[1]})")
+            messages.extend(self.expression_chain_messages(tree))
+        
+        # すべての辺を評価できたら等式が成り立つかを示す
+        if len(trees) >= 2 and len(values) == len(trees):
+            holds = all(self.expression_values_equal(values[0], value) for value in values[1:])
+            messages.append("等式は成立" if holds else "等式は不成立")
+        if evaluator.shared_hits:
+            messages.append(f"共通の部分式 {evaluator.shared_hits} 個を再利用")
+        for source, promoted in sorted(evaluator.promotions):
+            messages.append(f"整数の桁あふれを避けて {source} を {promoted} に昇格")
+        return " / ".join(messages)
+
+    def expression_chain_messages(self, tree):
+        """式の中の3つ以上の行列の積について、選んだ掛ける順と見積もった FLOP の削減を文字列で返す"""
+        messages = []
+        plans = self.expression_evaluator.chain_plans
+        for node in tree.walk():
+            plan = plans.get(node) if isinstance(node, ProductNode) else None
+            if plan is None:
+                continue
+            order, left_to_right, optimal = plan
+            saved = left_to_right - optimal
+            ratio = saved / left_to_right * 100 if left_to_right else 0.0
+            messages.append(f"積の順序 {order}（推定 {left_to_right:.3g} → {optimal:.3g} FLOP、{ratio:.1f}% 削減）")
+        return messages
+
+    @staticmethod
+    def expression_values_equal(left, right):
+        """評価した2つの値が（浮動小数点の誤差を除いて）等しいか"""
+        if value_shape(left) != value_shape(right):
+            return False
+        if is_sparse(left) and is_sparse(right):
+            difference = (left - right).tocsr()
+            return bool(np.allclose(difference.data, 0))
+        return bool(np.allclose(dense_values(left), dense_values(right)))
+
+    def place_expression_result(self, tree, value):
+        """評価結果の行列を式の文字列を名前にしてキャンバスに配置し、その名前を返す
+
+        前回配置した結果で値もバージョンも変わっていなければ何もしない（キャッシュから
+        返った結果なら再描画のキャッシュもそのまま使える）。同じ名前の行列が利用者の作った
+        行列なら上書きせずに None を返す。
+        """
+        name = str(tree)
+        matrix = self.matrices.get(name)
+        entry = self.expression_results.get(name)
+        if matrix is not None:
+            if entry is None or entry[1] is not matrix:
+                return None
+            if entry[0] is value and entry[2] == matrix.version:
+                return name
+        # キャッシュの値を編集で書き換えないように複製して持たせる
+        values = value.copy()
+        if matrix is None:
+            matrix = Matrix(name, values, self.expression_result_position(tree, values.shape))
+            self.matrices[name] = matrix
+        else:
+            matrix.values = values
+        self.expression_results[name] = (value, matrix, matrix.version)
+        return name
+
+    def is_expression_result(self, name):
+        """行列が式の評価でキャンバスに配置した一時的な結果かどうか"""
+        entry = self.expression_results.get(name)
+        return entry is not None and self.matrices.get(name) is entry[1]
+
+    def remove_expression_results(self, keep=()):
+        """keep にない評価結果の行列を、その矢印と色付きセルごと取り除く"""
+        removed = False
+        for name in [name for name in self.expression_results if name not in keep]:
+            if self.is_expression_result(name):
+                self.arrows.remove_matrix(name)
+                self.colored_cells.remove_matrix(name)
+                del self.matrices[name]
+                self.cell_labels.discard(name)
+                removed = True
+            del self.expression_results[name]
+        if removed:
+            self.update_arrows_listbox()
+            self.update_colored_cells_listbox()
+
+    def expression_result_position(self, tree, shape):
+        """結果の行列の位置（式に現れる行列の左端で、それらと演算の説明の下）"""
+        names = self.expression_matrix_names(tree)
+        if not names:
+            return (0, 0)
+        left = min(self.matrices[name].position[0] for name in names)
+        top = max(self.matrices[name].position[1] + self.matrices[name].rows for name in names) + 3
+        rows, cols = shape
+        # ほかの行列（前に配置した結果など）と重なるなら、その下へずらす
+        moved = True
+        while moved:
+            moved = False
+            for matrix in self.matrices.values():
+                x, y = matrix.position
+                if x < left + cols and left < x + matrix.cols and y < top + rows and top < y + matrix.rows:
+                    top = y + matrix.rows + 3
+                    moved = True
+        return (left, top)
+
+    def expression_pair_value(self, node):
+        """隣り合う2項の演算の値を評価器から返す（キャッシュを共有する、評価できなければ None）"""
+        try:
+            return self.expression_evaluator.evaluate(node, self.matrices)
+        except ValueError:
+            return None
+
+    def expression_matrix_names(self, tree):
+        """式に現れる行列名を出現順に重複なしで返す"""
+        names = (self.expression_operand(node) for node in tree.walk())
+        return list(dict.fromkeys(name for name in names if name is not None))
+
+    def visualize_expression_node(self, node):
+        """構文木のノードの演算を可視化（行列同士の演算だけを描き、入れ子の式は中へたどる）"""
+        operand = self.expression_operand
+        if isinstance(node, CallNode):
+            name = operand(node.arg)
+            if name is None:
+                self.visualize_expression_node(node.arg)
+            elif node.func == 'Det':
+                # 行列式の視覚化
+                self.visualize_determinant(name, self.matrices[name])
+            else:
+                # トレースの視覚化
+                self.visualize_trace(name, self.matrices[name])
+        elif isinstance(node, SumNode):
+            for (_, left), (sign, right) in zip(node.terms, node.terms[1:]):
+                if operand(left) and operand(right):
+                    result = self.expression_pair_value(SumNode((('+', left), (sign, right))))
+                    self.visualize_addition_subtraction(operand(left), operand(right), sign, result)
+            for _, term in node.terms:
+                self.visualize_expression_node(term)
+        elif isinstance(node, ProductNode):
+            for left, right in zip(node.factors, node.factors[1:]):
+                if operand(left) and operand(right):
+                    result = self.expression_pair_value(ProductNode((left, right)))
+                    self.visualize_multiplication(operand(left), operand(right), result)
+            for factor in node.factors:
+                self.visualize_expression_node(factor)
+        elif isinstance(node, PowerNode):
+            exponent = node.exponent
+            if isinstance(exponent, NegateNode):
+                exponent = exponent.operand
+            if operand(node.base) and (isinstance(exponent, NumberNode) or operand(exponent)):
+                self.visualize_power(operand(node.base), str(node.exponent), self.expression_pair_value(node))
+            self.visualize_expression_node(node.base)
+        elif isinstance(node, NegateNode):
+            self.visualize_expression_node(node.operand)
 
     def visualize_determinant(self, matrix_name, matrix_data):
         """行列式の視覚化"""
-        values = matrix_data['values']
-        pos_x, pos_y = matrix_data['position']
+        values = matrix_data.values
+        pos_x, pos_y = matrix_data.position
         rows, cols = values.shape
         
         # 行列式は正方行列のみ定義される
         if rows != cols:
             warning_text = f"行列式 Det({matrix_name}) は正方行列でのみ定義されます"
-            self.ax.text(pos_x + cols/2, -(pos_y + rows + 1.5), warning_text, 
+            self.add_overlay('operations', self.ax.text(pos_x + cols/2, -(pos_y + rows + 1.5), warning_text, 
                         ha='center', va='center', fontsize=14, color='red',
-                        bbox=dict(facecolor='white', alpha=0.7, edgecolor='red'))
+                        bbox=dict(facecolor='white', alpha=0.7, edgecolor='red')))
             return
         
-        # 行列全体を強調
-        for i in range(rows):
-            for j in range(cols):
-                x = pos_x + j
-                y = pos_y + i
-                rect = patches.Rectangle((x, -y-1), 1, 1, linewidth=1, edgecolor='blue', facecolor='lightcyan')
-                self.ax.add_patch(rect)
+        # 行列全体を強調（疎行列は非ゼロのセルだけ）
+        ii, jj = self.matrix_cells(matrix_name)
+        self.highlight_cells('operations', matrix_name, ii, jj,
+                             facecolor='lightcyan', edgecolor='blue', linewidth=1)
         
         # 行列式の記号を表示
-        self.ax.text(pos_x - 0.5, -(pos_y + rows/2), "det", ha='right', va='center', fontsize=14, color='blue')
+        self.add_overlay('operations', self.ax.text(pos_x - 0.5, -(pos_y + rows/2), "det", ha='right', va='center', fontsize=14, color='blue'))
         
         # 行列式の値を計算して表示
-        det_val = round(np.linalg.det(values), 2)
+        det_val = round(matrix_determinant(values), 2)
         result_text = f"Det({matrix_name}) = {det_val}"
-        self.ax.text(pos_x + cols/2, -(pos_y + rows + 1.5), result_text, 
+        self.add_overlay('operations', self.ax.text(pos_x + cols/2, -(pos_y + rows + 1.5), result_text, 
                     ha='center', va='center', fontsize=14, color='blue',
-                    bbox=dict(facecolor='white', alpha=0.7, edgecolor='blue'))
+                    bbox=dict(facecolor='white', alpha=0.7, edgecolor='blue')))
 
     def visualize_trace(self, matrix_name, matrix_data):
         """トレースの視覚化"""
-        values = matrix_data['values']
-        pos_x, pos_y = matrix_data['position']
+        values = matrix_data.values
+        pos_x, pos_y = matrix_data.position
         rows, cols = values.shape
         
-        # 対角成分を強調
-        for i in range(min(rows, cols)):
-            x = pos_x + i
-            y = pos_y + i
-            rect = patches.Rectangle((x, -y-1), 1, 1, linewidth=2, edgecolor='red', facecolor='lightyellow')
-            self.ax.add_patch(rect)
+        # 対角成分を強調（疎行列は非ゼロの対角成分だけ）
+        if matrix_data.is_sparse:
+            diagonal = np.flatnonzero(values.diagonal())
+        else:
+            diagonal = np.arange(min(rows, cols))
+        self.highlight_cells('operations', matrix_name, diagonal, diagonal,
+                             facecolor='lightyellow', edgecolor='red', linewidth=2)
         
         # トレースの記号を表示
-        self.ax.text(pos_x - 0.5, -(pos_y + rows/2), "tr", ha='right', va='center', fontsize=14, color='red')
+        self.add_overlay('operations', self.ax.text(pos_x - 0.5, -(pos_y + rows/2), "tr", ha='right', va='center', fontsize=14, color='red'))
         
         # トレース値を計算して表示
-        trace_val = np.trace(values)
+        trace_val = matrix_trace(values)
         result_text = f"Tr({matrix_name}) = {trace_val}"
-        self.ax.text(pos_x + cols/2, -(pos_y + rows + 1.5), result_text, 
+        self.add_overlay('operations', self.ax.text(pos_x + cols/2, -(pos_y + rows + 1.5), result_text, 
                     ha='center', va='center', fontsize=14, color='red',
-                    bbox=dict(facecolor='white', alpha=0.7, edgecolor='red'))
+                    bbox=dict(facecolor='white', alpha=0.7, edgecolor='red')))
 
-    def visualize_addition_subtraction(self, left_name, right_name, operator):
-        """行列の加算・減算の視覚化"""
+    def visualize_addition_subtraction(self, left_name, right_name, operator, result=None):
+        """行列の加算・減算の視覚化（result は評価済みの結果、なければここで計算する）"""
         left_data = self.matrices[left_name]
         right_data = self.matrices[right_name]
         
-        left_pos_x, left_pos_y = left_data['position']
-        right_pos_x, right_pos_y = right_data['position']
+        left_pos_x, left_pos_y = left_data.position
+        right_pos_x, right_pos_y = right_data.position
         
-        left_rows, left_cols = left_data['values'].shape
-        right_rows, right_cols = right_data['values'].shape
+        left_rows, left_cols = left_data.values.shape
+        right_rows, right_cols = right_data.values.shape
         
         # 加減算は同じサイズの行列のみ可能
         if left_rows != right_rows or left_cols != right_cols:
             warning_text = f"{left_name} {operator} {right_name}: 行列のサイズが一致しません"
             mid_x = (left_pos_x + left_cols + right_pos_x) / 2
             mid_y = -(max(left_pos_y, right_pos_y) + max(left_rows, right_rows) + 1.5)
-            self.ax.text(mid_x, mid_y, warning_text, 
+            self.add_overlay('operations', self.ax.text(mid_x, mid_y, warning_text, 
                         ha='center', va='center', fontsize=14, color='red',
-                        bbox=dict(facecolor='white', alpha=0.7, edgecolor='red'))
+                        bbox=dict(facecolor='white', alpha=0.7, edgecolor='red')))
             return
         
         # 行列間に演算子を表示
@@ -2162,41 +5728,40 @@ class MatrixVisualization:
         mid_y = -(left_pos_y + left_rows/2 + right_pos_y + right_rows/2) / 2
         
         # 演算子の表示
-        self.ax.text(mid_x, mid_y, operator, ha='center', va='center', 
-                    color='purple', fontweight='bold', fontsize=16)
+        self.add_overlay('operations', self.ax.text(mid_x, mid_y, operator, ha='center', va='center', 
+                    color='purple', fontweight='bold', fontsize=16))
         
         # 演算結果を表示（オプション）
-        if operator == '+':
-            result = left_data['values'] + right_data['values']
-            op_name = "加算"
-        else:  # operator == '-'
-            result = left_data['values'] - right_data['values']
-            op_name = "減算"
+        if result is None:
+            result = combine_values(left_data.values, right_data.values, operator)
+        op_name = "加算" if operator == '+' else "減算"
         
-        # 演算結果のテキストを表示
+        # 演算結果のテキストを表示（疎行列の結果は非ゼロ要素の数も示す）
         result_text = f"{left_name} {operator} {right_name} ({op_name})"
-        self.ax.text(mid_x, -(max(left_pos_y, right_pos_y) + max(left_rows, right_rows) + 1.5), 
-                    result_text, ha='center', va='center', fontsize=14, color='purple')
+        if is_sparse(result):
+            result_text += f" 非ゼロ {result.nnz} 個"
+        self.add_overlay('operations', self.ax.text(mid_x, -(max(left_pos_y, right_pos_y) + max(left_rows, right_rows) + 1.5), 
+                    result_text, ha='center', va='center', fontsize=14, color='purple'))
 
-    def visualize_multiplication(self, left_name, right_name):
-        """行列の乗算の視覚化"""
+    def visualize_multiplication(self, left_name, right_name, result=None):
+        """行列の乗算の視覚化（result は評価済みの結果、なければ疎行列同士のときだけここで計算する）"""
         left_data = self.matrices[left_name]
         right_data = self.matrices[right_name]
         
-        left_pos_x, left_pos_y = left_data['position']
-        right_pos_x, right_pos_y = right_data['position']
+        left_pos_x, left_pos_y = left_data.position
+        right_pos_x, right_pos_y = right_data.position
         
-        left_rows, left_cols = left_data['values'].shape
-        right_rows, right_cols = right_data['values'].shape
+        left_rows, left_cols = left_data.values.shape
+        right_rows, right_cols = right_data.values.shape
         
         # 行列の乗算条件: 1つ目の行列の列数 = 2つ目の行列の行数
         if left_cols != right_rows:
             warning_text = f"{left_name} * {right_name}: 行列乗算の条件を満たしません"
             mid_x = (left_pos_x + left_cols + right_pos_x) / 2
             mid_y = -(max(left_pos_y, right_pos_y) + max(left_rows, right_rows) + 1.5)
-            self.ax.text(mid_x, mid_y, warning_text, 
+            self.add_overlay('operations', self.ax.text(mid_x, mid_y, warning_text, 
                         ha='center', va='center', fontsize=14, color='red',
-                        bbox=dict(facecolor='white', alpha=0.7, edgecolor='red'))
+                        bbox=dict(facecolor='white', alpha=0.7, edgecolor='red')))
             return
         
         # 行列間に演算子を表示
@@ -2204,8 +5769,8 @@ class MatrixVisualization:
         mid_y = -(left_pos_y + left_rows/2 + right_pos_y + right_rows/2) / 2
         
         # 演算子の表示
-        self.ax.text(mid_x, mid_y, "×", ha='center', va='center', 
-                    color='green', fontweight='bold', fontsize=16)
+        self.add_overlay('operations', self.ax.text(mid_x, mid_y, "×", ha='center', va='center', 
+                    color='green', fontweight='bold', fontsize=16))
         
         # いくつかの乗算パターンを可視化（最大3×3まで）
         colors = ['red', 'blue', 'green', 'orange', 'purple', 'brown', 'magenta', 'cyan', 'olive']
@@ -2222,53 +5787,175 @@ class MatrixVisualization:
                 # A_ik * B_kj の計算を視覚化
                 for k in range(min(3, left_cols)):
                     # 元の行列の要素を強調
-                    self.ax.add_patch(patches.Rectangle(
+                    self.add_overlay('operations', self.ax.add_patch(patches.Rectangle(
                         (left_pos_x + k, -(left_pos_y + i + 1)), 1, 1, 
-                        linewidth=2, edgecolor=color, facecolor='none', alpha=0.7))
+                        linewidth=2, edgecolor=color, facecolor='none', alpha=0.7)))
                     
-                    self.ax.add_patch(patches.Rectangle(
+                    self.add_overlay('operations', self.ax.add_patch(patches.Rectangle(
                         (right_pos_x + j, -(right_pos_y + k + 1)), 1, 1, 
-                        linewidth=2, edgecolor=color, facecolor='none', alpha=0.7))
+                        linewidth=2, edgecolor=color, facecolor='none', alpha=0.7)))
         
-        # 演算結果のテキストを表示
+        # 演算結果のテキストを表示（疎行列同士の積は疎なまま計算し、非ゼロ要素の数も示す）
         result_text = f"{left_name} × {right_name} (行列乗算)"
-        self.ax.text(mid_x, -(max(left_pos_y, right_pos_y) + max(left_rows, right_rows) + 1.5), 
-                    result_text, ha='center', va='center', fontsize=14, color='green')
+        if result is None and left_data.is_sparse and right_data.is_sparse:
+            result = combine_values(left_data.values, right_data.values, '*')
+        if is_sparse(result):
+            result_text += f" 非ゼロ {result.nnz} 個"
+        self.add_overlay('operations', self.ax.text(mid_x, -(max(left_pos_y, right_pos_y) + max(left_rows, right_rows) + 1.5), 
+                    result_text, ha='center', va='center', fontsize=14, color='green'))
 
-    def visualize_power(self, base_name, exponent_name):
-        """行列のべき乗の視覚化"""
+    def visualize_power(self, base_name, exponent_name, result=None):
+        """行列のべき乗の視覚化（exponent_name は指数の表記、result は評価済みの結果）"""
         base_data = self.matrices[base_name]
-        exponent_data = self.matrices[exponent_name]
         
-        base_pos_x, base_pos_y = base_data['position']
-        base_rows, base_cols = base_data['values'].shape
+        base_pos_x, base_pos_y = base_data.position
+        base_rows, base_cols = base_data.values.shape
         
         # べき乗は正方行列でのみ有効
         if base_rows != base_cols:
             warning_text = f"{base_name}^{exponent_name}: べき乗は正方行列でのみ有効です"
-            self.ax.text(base_pos_x + base_cols/2, -(base_pos_y + base_rows + 1.5), 
+            self.add_overlay('operations', self.ax.text(base_pos_x + base_cols/2, -(base_pos_y + base_rows + 1.5), 
                         warning_text, ha='center', va='center', fontsize=14, color='red',
-                        bbox=dict(facecolor='white', alpha=0.7, edgecolor='red'))
+                        bbox=dict(facecolor='white', alpha=0.7, edgecolor='red')))
             return
         
         # べき指数の表示
-        exponent_pos_x, exponent_pos_y = exponent_data['position']
-        self.ax.text(base_pos_x + base_cols + 0.2, -(base_pos_y), exponent_name, 
-                    ha='left', va='top', fontsize=12, color='blue')
-        
-        # 元の行列を強調
-        for i in range(base_rows):
-            for j in range(base_cols):
-                x = base_pos_x + j
-                y = base_pos_y + i
-                rect = patches.Rectangle((x, -y-1), 1, 1, linewidth=1, edgecolor='blue', facecolor='lightblue', alpha=0.3)
-                self.ax.add_patch(rect)
+        self.add_overlay('operations', self.ax.text(base_pos_x + base_cols + 0.2, -(base_pos_y), exponent_name, 
+                    ha='left', va='top', fontsize=12, color='blue'))
+        
+        # 元の行列を強調（疎行列は非ゼロのセルだけ）
+        ii, jj = self.matrix_cells(base_name)
+        self.highlight_cells('operations', base_name, ii, jj,
+                             facecolor='lightblue', edgecolor='blue', linewidth=1, alpha=0.3)
         
         # 演算結果のテキストを表示
         result_text = f"{base_name}^{exponent_name} (行列のべき乗)"
-        self.ax.text(base_pos_x + base_cols/2, -(base_pos_y + base_rows + 1.5), 
-                    result_text, ha='center', va='center', fontsize=14, color='blue')
+        # 桁あふれを避けて型を昇格した結果はそれも示す
+        if result is not None and value_shape(result) and result.dtype != base_data.values.dtype:
+            result_text += f" {base_data.values.dtype} → {result.dtype}"
+        self.add_overlay('operations', self.ax.text(base_pos_x + base_cols/2, -(base_pos_y + base_rows + 1.5), 
+                    result_text, ha='center', va='center', fontsize=14, color='blue'))
     
+    def start_multiplication_animation(self):
+        """左右の行列の乗算を、結果のセルごとに強調するアニメーションで再生"""
+        left_name = self.anim_left.get().strip()
+        right_name = self.anim_right.get().strip()
+        for name in (left_name, right_name):
+            if name not in self.matrices:
+                messagebox.showerror("エラー", f"行列 '{name}' が定義されていません。")
+                return
+        try:
+            interval = int(self.anim_interval.get())
+            if interval <= 0:
+                raise ValueError
+        except ValueError:
+            messagebox.showerror("エラー", "間隔には正の整数（ミリ秒）を入力してください。")
+            return
+        
+        # 前の演算の表示を消してから、強調のフレームを用意する
+        self.render_scene()
+        try:
+            self.multiplication_animator = MultiplicationAnimator(self, left_name, right_name)
+        except ValueError as e:
+            messagebox.showerror("エラー", str(e))
+            self.request_redraw()
+            return
+        # 最初の描画のあとで再生が始まる（以降は強調だけをブリッティングで描き直す）
+        self.animation = self.multiplication_animator.animate(interval)
+        self.animation_paused = False
+        self.request_redraw()
+        
+        rows, cols = self.multiplication_animator.shape
+        self.status_var.set(f"{left_name} × {right_name} のアニメーションを再生中（{rows}×{cols} = {rows * cols} フレーム）")
+
+    def toggle_multiplication_animation(self):
+        """アニメーションの再生と一時停止を切り替える（未開始なら開始）"""
+        if self.animation is None:
+            self.start_multiplication_animation()
+            return
+        # Animation.pause() は強調を通常の描画に戻してしまうので、タイマーだけを止める
+        if self.animation_paused:
+            self.animation.event_source.start()
+            self.status_var.set("アニメーションを再開しました")
+        else:
+            self.animation.event_source.stop()
+            self.status_var.set("アニメーションを一時停止しました")
+        self.animation_paused = not self.animation_paused
+
+    def step_multiplication_animation(self):
+        """一時停止して次の結果のセルに進む"""
+        if self.animation is None:
+            self.start_multiplication_animation()
+            return
+        self.animation.event_source.stop()
+        self.animation_paused = True
+        animator = self.multiplication_animator
+        animator.step()
+        self.animation.refresh()
+        
+        row, col = divmod(animator.frame, animator.shape[1])
+        self.status_var.set(f"フレーム {animator.frame + 1}/{animator.frame_count}: 結果のセル [{row}][{col}]")
+
+    def stop_multiplication_animation(self, remove_artists=True):
+        """アニメーションを終えて強調を消す"""
+        if self.animation is not None:
+            self.animation.event_source.stop()
+            self.animation = None
+        if self.multiplication_animator is not None:
+            if remove_artists:
+                self.multiplication_animator.remove()
+                self.request_overlay_redraw()
+            self.multiplication_animator = None
+
+    def refresh_multiplication_animation(self):
+        """キャンバスを描き直した後、アニメーションの背景を取り直して強調を重ねる"""
+        if self.animation is not None:
+            self.animation.refresh(recapture=True)
+
+    def sync_multiplication_animation(self, name):
+        """行列の変更をアニメーションのフレームに反映（乗算できなくなったら終える）"""
+        animator = self.multiplication_animator
+        if animator is None or name not in animator.operands:
+            return
+        try:
+            if animator.prepare():
+                animator.draw_frame(animator.frame)
+        except (KeyError, ValueError):
+            self.stop_multiplication_animation()
+
+    def export_multiplication_animation(self):
+        """再生中の乗算のアニメーションを GIF / MP4 として書き出す"""
+        animator = self.multiplication_animator
+        if animator is None:
+            messagebox.showinfo("情報", "先に乗算のアニメーションを再生してください。")
+            return
+        
+        filename = filedialog.asksaveasfilename(
+            title="アニメーションを書き出す",
+            filetypes=[('GIF ファイル', '*.gif'), ('MP4 ファイル', '*.mp4')],
+            defaultextension='.gif'
+        )
+        if not filename:
+            return
+        
+        # 書き出しの間は再生を止め、オーバーレイも書き出す画像に含める
+        self.animation.event_source.stop()
+        self.flatten_overlays(True)
+        self.status_var.set(f"{animator.frame_count} フレームを書き出しています...")
+        self.root.update_idletasks()
+        try:
+            animator.save(filename)
+            self.status_var.set(f"アニメーションを {filename} に保存しました")
+            messagebox.showinfo("保存完了", f"アニメーションを {filename} に保存しました。")
+        except Exception as e:
+            messagebox.showerror("保存エラー", f"書き出し中にエラーが発生しました: {str(e)}")
+            self.status_var.set(f"保存エラー: {str(e)}")
+        finally:
+            self.flatten_overlays(False)
+            if self.animation is not None and not self.animation_paused:
+                self.animation.event_source.start()
+            self.request_redraw()
+
     def add_arrow(self):
         """矢印を追加"""
         source_matrix = self.source_matrix.get().strip()
@@ -2290,10 +5977,10 @@ class MatrixVisualization:
             target_row = int(self.target_row.get())
             target_col = int(self.target_col.get())
             
-            source_rows = self.matrices[source_matrix]['rows']
-            source_cols = self.matrices[source_matrix]['cols']
-            target_rows = self.matrices[target_matrix]['rows']
-            target_cols = self.matrices[target_matrix]['cols']
+            source_rows = self.matrices[source_matrix].rows
+            source_cols = self.matrices[source_matrix].cols
+            target_rows = self.matrices[target_matrix].rows
+            target_cols = self.matrices[target_matrix].cols
             
             if source_row < 0 or source_row >= source_rows or source_col < 0 or source_col >= source_cols:
                 raise ValueError(f"始点の位置が範囲外です。行: 0-{source_rows-1}, 列: 0-{source_cols-1}")
@@ -2309,7 +5996,7 @@ class MatrixVisualization:
         color = self.arrow_color.get().strip()
         try:
             # 色名の検証
-            if color not in mpl.colors.CSS4_COLORS and not mpl.colors.is_color_like(color):
+            if not color_registry.is_valid(color):
                 raise ValueError(f"'{color}' は有効な色名またはカラーコードではありません。")
         except ValueError as e:
             messagebox.showerror("エラー", str(e))
@@ -2345,8 +6032,9 @@ class MatrixVisualization:
         # 矢印リストを更新
         self.update_arrows_listbox()
         
-        # 可視化を更新
-        self.visualize_matrices()
+        # 可視化を更新（矢印はオーバーレイなので格子は描き直さない）
+        self.append_arrow_artists(arrow_data)
+        self.request_overlay_redraw()
         
         self.status_var.set(f"矢印 {source_matrix}[{source_row}][{source_col}] → {target_matrix}[{target_row}][{target_col}] を追加しました")
 
@@ -2369,7 +6057,10 @@ class MatrixVisualization:
                 self.update_arrows_listbox()
                 
                 # 可視化を更新
-                self.visualize_matrices()
+                self.remove_artists(self.scene['arrows'].pop(index))
+                self.update_arrow_layer()
+                self.reindex_arrows()
+                self.request_overlay_redraw()
                 
                 self.status_var.set(f"矢印 {source} → {target} を削除しました")
 
@@ -2387,8 +6078,8 @@ class MatrixVisualization:
             row = int(self.cell_row.get())
             col = int(self.cell_col.get())
             
-            matrix_rows = self.matrices[matrix_name]['rows']
-            matrix_cols = self.matrices[matrix_name]['cols']
+            matrix_rows = self.matrices[matrix_name].rows
+            matrix_cols = self.matrices[matrix_name].cols
             
             if row < 0 or row >= matrix_rows or col < 0 or col >= matrix_cols:
                 raise ValueError(f"要素の位置が範囲外です。行: 0-{matrix_rows-1}, 列: 0-{matrix_cols-1}")
@@ -2399,36 +6090,34 @@ class MatrixVisualization:
         # 値を更新
         try:
             value = self.cell_value.get().strip()
+            value_changed = bool(value)
             if value:
                 # 数値に変換可能か確認
                 if '.' in value:
                     value = float(value)
                 else:
                     value = int(value)
-                self.matrices[matrix_name]['values'][row, col] = value
         except ValueError:
             messagebox.showerror("エラー", "値は数値である必要があります。")
             return
+        if value_changed:
+            try:
+                self.set_cell_value(matrix_name, row, col, value)
+            except ValueError as e:
+                # 整数の型の方針の行列に整数でない値を書こうとした
+                messagebox.showerror("エラー", str(e))
+                return
         
         # 色を更新
         color = self.cell_color.get().strip()
         if color and color.lower() != "none":
             try:
                 # 色名の検証
-                if not (color in mpl.colors.CSS4_COLORS or mpl.colors.is_color_like(color)):
+                if not color_registry.is_valid(color):
                     raise ValueError(f"'{color}' は有効な色名またはカラーコードではありません。")
                 
-                # 既存の色設定を削除
-                self.colored_cells = [cell for cell in self.colored_cells 
-                                if not (cell['matrix'] == matrix_name and cell['row'] == row and cell['col'] == col)]
-                
-                # 色設定を追加
-                self.colored_cells.append({
-                    'matrix': matrix_name,
-                    'row': row,
-                    'col': col,
-                    'color': color
-                })
+                # 色設定を追加（既存の設定は置き換え）
+                self.colored_cells.set(matrix_name, row, col, color)
                 
                 # 色付き要素リストを更新
                 self.update_colored_cells_listbox()
@@ -2438,12 +6127,17 @@ class MatrixVisualization:
                 return
         elif color.lower() == "none":
             # 色設定を削除
-            self.colored_cells = [cell for cell in self.colored_cells 
-                            if not (cell['matrix'] == matrix_name and cell['row'] == row and cell['col'] == col)]
+            self.colored_cells.discard(matrix_name, row, col)
             self.update_colored_cells_listbox()
         
-        # 可視化を更新
-        self.visualize_matrices()
+        # 可視化を更新（値が変わらなければ色付きセルのオーバーレイだけを重ね直す）
+        if value_changed:
+            self.refresh_cell(matrix_name, row, col)
+        self.refresh_colored_cell(matrix_name, row, col)
+        if value_changed:
+            self.request_redraw()
+        else:
+            self.request_overlay_redraw()
         
         self.status_var.set(f"要素 {matrix_name}[{row}][{col}] を更新しました")
 
@@ -2459,228 +6153,146 @@ class MatrixVisualization:
             cell_desc = f"{cell['matrix']}[{cell['row']}][{cell['col']}]"
             
             if messagebox.askyesno("確認", f"色付き要素 {cell_desc} を削除しますか？"):
-                del self.colored_cells[index]
+                self.colored_cells.pop_index(index)
                 
                 # リストを更新
                 self.update_colored_cells_listbox()
                 
                 # 可視化を更新
-                self.visualize_matrices()
+                self.refresh_colored_cell(cell['matrix'], cell['row'], cell['col'])
+                self.request_overlay_redraw()
                 
                 self.status_var.set(f"色付き要素 {cell_desc} を削除しました")
 
-    def draw_matrices(self):
-        """すべての行列を描画"""
-        for name, matrix_data in self.matrices.items():
-            values = matrix_data['values']
-            pos_x, pos_y = matrix_data['position']
-            rows, cols = values.shape
-            
-            # 行列全体の背景（わずかに大きめに）
-            background = patches.Rectangle(
-                (pos_x - 0.1, -(pos_y + rows) - 0.1), 
-                cols + 0.2, rows + 0.2, 
-                linewidth=1.5, 
-                edgecolor='gray', 
-                facecolor='#f8f8f8' if not self.is_dark_mode else '#2a2a2a',
-                alpha=0.7,
-                zorder=0
-            )
-            self.ax.add_patch(background)
-            
-            # 行列のセルを描画
-            for i in range(rows):
-                for j in range(cols):
-                    x = pos_x + j
-                    y = pos_y + i
-                    
-                    # セルのカラーを決定
-                    cell_color = 'white' if not self.is_dark_mode else '#3a3a3a'
-                    text_color = 'black' if not self.is_dark_mode else 'white'
-                    
-                    rect = patches.Rectangle(
-                        (x, -y-1), 1, 1, 
-                        linewidth=1, 
-                        edgecolor='black' if not self.is_dark_mode else '#555555', 
-                        facecolor=cell_color,
-                        zorder=1
-                    )
-                    self.ax.add_patch(rect)
-                    
-                    # 値が整数か浮動小数点数かに基づいてフォーマット
-                    val = values[i, j]
-                    if isinstance(val, int) or (isinstance(val, float) and val.is_integer()):
-                        text = str(int(val))
-                    else:
-                        text = f"{val:.2f}"
-                    
-                    self.ax.text(
-                        x + 0.5, -y - 0.5, 
-                        text, 
-                        ha='center', 
-                        va='center', 
-                        fontsize=12,
-                        color=text_color,
-                        zorder=2
-                    )
-            
-            # 行列名を左上に表示（影付き）
-            text_color = 'black' if not self.is_dark_mode else 'white'
-            # 影の効果（オフセット付きで同じテキストを描画）
-            if not self.is_dark_mode:
-                self.ax.text(
-                    pos_x - 0.18, -pos_y + 0.02, 
-                    name, 
-                    ha='right', 
-                    va='center', 
-                    fontsize=14, 
-                    fontweight='bold',
-                    color='lightgray',
-                    zorder=3
-                )
-            
-            self.ax.text(
-                pos_x - 0.2, -pos_y, 
-                name, 
-                ha='right', 
-                va='center', 
-                fontsize=14, 
-                fontweight='bold',
-                color=text_color,
-                zorder=4
-            )
+    def reset_scene(self):
+        """描画済みアーティストの管理テーブルとホバーの状態を初期化"""
+        super().reset_scene()
+        self.hover_cell = None
+        # 軸をクリアするとアニメーションの強調も消えるので、アニメーションも終える
+        self.stop_multiplication_animation(remove_artists=False)
 
-    def draw_arrows(self):
-        """すべての矢印を描画"""
-        for arrow in self.arrows:
-            source_name, source_row, source_col = arrow['source']
-            target_name, target_row, target_col = arrow['target']
-            color = arrow['color']
-            
-            # 追加のスタイル情報
-            style = arrow.get('style', '-|>')
-            width = arrow.get('width', 2.0)
-            label = arrow.get('label', '')
-            
-            if source_name in self.matrices and target_name in self.matrices:
-                source_pos = self.matrices[source_name]['position']
-                target_pos = self.matrices[target_name]['position']
-                
-                # 矢印の始点と終点を計算
-                start_x = source_pos[0] + source_col + 0.5
-                start_y = -(source_pos[1] + source_row + 0.5)
-                end_x = target_pos[0] + target_col + 0.5
-                end_y = -(target_pos[1] + target_row + 0.5)
-                
-                # 矢印スタイルを設定
-                arrow_style = None
-                if style == '-|>':
-                    arrow_style = '-|>'
-                elif style == '->>':
-                    arrow_style = '->'
-                elif style == '-[':
-                    arrow_style = '-['
-                elif style == '-|':
-                    arrow_style = '-|'
-                elif style == '<->':
-                    arrow_style = '<->'
-                elif style == '<-|>':
-                    arrow_style = '<-|>'
-                else:
-                    arrow_style = '-|>'  # デフォルト
-                
-                # 矢印を描画
-                annotation = self.ax.annotate(
-                    '', 
-                    xy=(end_x, end_y), 
-                    xytext=(start_x, start_y),
-                    arrowprops=dict(
-                        arrowstyle=arrow_style, 
-                        color=color, 
-                        lw=width,
-                        alpha=0.8,
-                        connectionstyle="arc3,rad=.1"  # 少し湾曲させる
-                    ),
-                    zorder=10
-                )
-                
-                # ラベルがあれば表示
-                if label:
-                    # 矢印の中点を計算
-                    mid_x = (start_x + end_x) / 2
-                    mid_y = (start_y + end_y) / 2
-                    
-                    # 少しオフセットを加える
-                    offset_x = (end_y - start_y) * 0.1
-                    offset_y = (start_x - end_x) * 0.1
-                    
-                    # ラベルのテキストを描画
-                    self.ax.text(
-                        mid_x + offset_x, 
-                        mid_y + offset_y, 
-                        label,
-                        ha='center',
-                        va='center',
-                        fontsize=10,
-                        fontweight='bold',
-                        color=color,
-                        bbox=dict(facecolor='white' if not self.is_dark_mode else '#2a2a2a', alpha=0.8),
-                        zorder=11
-                    )
+    def poll_tiles(self):
+        """バックグラウンドで生成が終わったタイルがあれば再描画を予約（定期的に呼ばれる）"""
+        if self.tile_cache.take_completed():
+            self.request_redraw()
+        self.root.after(50, self.poll_tiles)
 
-    def draw_colored_cells(self):
-        """色付き要素を描画"""
-        for cell in self.colored_cells:
-            matrix_name = cell['matrix']
-            row = cell['row']
-            col = cell['col']
-            color = cell['color']
-            
-            if matrix_name in self.matrices:
-                matrix_pos = self.matrices[matrix_name]['position']
-                
-                # セルの位置を計算
-                x = matrix_pos[0] + col
-                y = matrix_pos[1] + row
-                
-                # 色の輝度を計算して、適切なテキスト色を選択
-                try:
-                    rgb = mpl.colors.to_rgb(color)
-                    brightness = 0.299 * rgb[0] + 0.587 * rgb[1] + 0.114 * rgb[2]
-                    text_color = 'black' if brightness > 0.5 else 'white'
-                except:
-                    text_color = 'black'  # 変換できない場合はデフォルト
-                
-                # 色付きセルを描画
-                rect = patches.Rectangle(
-                    (x, -y-1), 1, 1, 
-                    linewidth=1, 
-                    edgecolor='black', 
-                    facecolor=color,
-                    alpha=0.8,
-                    zorder=5
-                )
-                self.ax.add_patch(rect)
-                
-                # セルの値を再描画
-                cell_value = self.matrices[matrix_name]['values'][row, col]
-                
-                # 値が整数か浮動小数点数かに基づいてフォーマット
-                if isinstance(cell_value, int) or (isinstance(cell_value, float) and cell_value.is_integer()):
-                    value_text = str(int(cell_value))
-                else:
-                    value_text = f"{cell_value:.2f}"
-                
-                self.ax.text(
-                    x + 0.5, -y - 0.5, 
-                    value_text, 
-                    ha='center', 
-                    va='center', 
-                    fontsize=12,
-                    color=text_color,
-                    fontweight='bold',
-                    zorder=6
-                )
+    def request_redraw(self):
+        """キャンバスの再描画を予約（同じフレーム内の要求は1回の描画にまとめる）"""
+        self.render_scheduler.request()
+
+    def request_overlay_redraw(self):
+        """オーバーレイ（矢印・色付きセル・選択・演算の強調・ホバー）だけの再描画を予約"""
+        self.render_scheduler.request(overlay_only=True)
+
+    def on_view_changed(self):
+        """表示範囲が変わったら、描画対象の選び直しを次の描画まで遅らせる"""
+        # ドラッグ中は xlim と ylim の変更が何度も届くため、その都度は作り直さない
+        self.view_dirty = True
+        self.request_redraw()
+
+    def render_frame(self):
+        """表示範囲が変わっていれば描画対象を選び直してからキャンバスを描画"""
+        if self.view_dirty:
+            self.view_dirty = False
+            self.update_level_of_detail()
+        self.canvas.draw()
+
+    def composite_frame(self):
+        """保存済みの静的な層にオーバーレイを重ねる（表示範囲が変わっていれば False）"""
+        if self.view_dirty:
+            return False
+        if not self.compositor.composite():
+            return False
+        self.refresh_multiplication_animation()
+        return True
+
+    def refresh_matrix(self, name):
+        """行列を再描画（サイズ・位置・名前の変更時）"""
+        self.sync_multiplication_animation(name)
+        self.remove_matrix_artists(name)
+        if name in self.matrices:
+            self.draw_matrix(name)
+            self.update_level_of_detail()
+        
+        # 行列に接続している矢印を描き直す
+        connected = np.flatnonzero(self.arrows.touching(name)).tolist()
+        for index in connected:
+            self.remove_artists(self.scene['arrows'][index])
+            self.scene['arrows'][index] = self.draw_arrow(self.arrows[index])
+            self.index_arrow(index)
+        if connected:
+            self.update_arrow_layer()
+        
+        # 行列の上に重なる色付きセルも描き直す
+        self.draw_colored_overlay(name)
+
+    def show_matrix(self, name):
+        """追加・上書きされた行列を描画し、表示範囲を合わせる"""
+        self.refresh_matrix(name)
+        self.adjust_plot_limits()
+        self.request_redraw()
+
+    def refresh_cell(self, name, row, col):
+        """1つのセルの値表示だけを更新"""
+        artists = self.scene['matrices'].get(name)
+        if artists is None:
+            return
+        
+        self.sync_multiplication_animation(name)
+        values = self.matrices[name].values
+        if artists['values'] is not values or self.matrices[name].is_sparse:
+            # float への昇格で値の配列が作り直されたら、行列ごと描き直す
+            # （疎行列は書き込みで非ゼロのセルが増減するので、常に描き直す）
+            self.refresh_matrix(name)
+            return
+        # ラベルは表示しているときだけ作る（密な行列は set_cell_value で更新済みのキャッシュを使う）
+        if artists['tiles'] is not None:
+            artists['tiles'].invalidate_cell(row, col)
+        elif artists['window'] is not None:
+            # 格子と値を作ってある範囲のセルならラベルを差し替える
+            r0, r1, c0, c1 = artists['window']
+            if r0 <= row < r1 and c0 <= col < c1:
+                artists['labels'].set_text((row - r0) * (c1 - c0) + (col - c0), self.cell_label(name, row, col))
+        step = artists['heatmap_step']
+        if step == 1 and not self.matrices[name].is_mapped:
+            artists['heatmap'].set_data(values)
+        elif row % step == 0 and col % step == 0:
+            # 間引いたヒートマップ（とメモリマップの行列から読み込んだ画像）は、
+            # そのセルが標本になっているピクセルだけを更新する
+            image = artists['heatmap'].get_array()
+            image[row // step, col // step] = values[row, col]
+            artists['heatmap'].set_data(image)
+        
+        # 色付きセルの場合はその値表示も更新
+        overlay = self.scene['colored_cells'].get(name)
+        if overlay is not None and (row, col) in overlay['index']:
+            overlay['labels'].set_text(overlay['index'][(row, col)], self.cell_label(name, row, col))
+
+    def refresh_colored_range(self, matrix_name, start_row, start_col, end_row, end_col):
+        """範囲内の色付きセルの表示を更新"""
+        # オーバーレイは行列単位なので、範囲の大きさによらず1回で描き直す
+        self.draw_colored_overlay(matrix_name)
+        self.request_overlay_redraw()
+
+    def append_arrow_artists(self, arrow):
+        """追加された矢印を描画してシーンに登録"""
+        self.scene['arrows'].append(self.draw_arrow(arrow))
+        args = self.bulk_arrow(arrow)
+        if args is not None:
+            self.ensure_arrow_layer().append_arrow(*args)
+        self.index_arrow(len(self.arrows) - 1)
+
+    def refresh_arrows(self):
+        """矢印をすべて描き直す（追加・削除・並べ替えの後）"""
+        for artists in self.scene['arrows']:
+            self.remove_artists(artists)
+        self.scene['arrows'] = []
+        self.draw_arrows()
+
+    def refresh_colored_cell(self, matrix_name, row, col):
+        """1つの色付きセルの表示を現在の設定に合わせて更新"""
+        self.draw_colored_overlay(matrix_name)
 
     def execute_console_commands(self):
         """コンソールテキストエリアのコマンドをすべて実行"""
@@ -2718,7 +6330,7 @@ class MatrixVisualization:
         self.console_history.config(state=tk.DISABLED)
         
         # 可視化を更新
-        self.visualize_matrices()
+        self.request_redraw()
         
         self.status_var.set(f"コマンド実行: 成功 {success_count}, 失敗 {error_count}")
 
@@ -2763,15 +6375,12 @@ class MatrixVisualization:
                     counter += 1
             
             # 行列を追加
-            self.matrices[matrix_name] = {
-                'values': values,
-                'position': (pos_x, pos_y),
-                'rows': rows,
-                'cols': cols
-            }
+            self.matrices[matrix_name] = Matrix(matrix_name, values, (pos_x, pos_y))
             
-            # リストを更新
+            # リストと表示を更新
             self.update_matrices_listbox()
+            self.refresh_matrix(matrix_name)
+            self.adjust_plot_limits()
             
             return f"行列 '{matrix_name}' を作成しました ({rows}x{cols})"
             
@@ -2812,10 +6421,10 @@ class MatrixVisualization:
                 raise ValueError(f"終点行列 '{target_matrix}' が定義されていません。")
             
             # インデックスの範囲チェック
-            source_rows = self.matrices[source_matrix]['rows']
-            source_cols = self.matrices[source_matrix]['cols']
-            target_rows = self.matrices[target_matrix]['rows']
-            target_cols = self.matrices[target_matrix]['cols']
+            source_rows = self.matrices[source_matrix].rows
+            source_cols = self.matrices[source_matrix].cols
+            target_rows = self.matrices[target_matrix].rows
+            target_cols = self.matrices[target_matrix].cols
             
             if source_row < 0 or source_row >= source_rows or source_col < 0 or source_col >= source_cols:
                 raise ValueError(f"始点の位置が範囲外です。行: 0-{source_rows-1}, 列: 0-{source_cols-1}")
@@ -2833,8 +6442,9 @@ class MatrixVisualization:
             
             self.arrows.append(arrow_data)
             
-            # リストを更新
+            # リストと表示を更新
             self.update_arrows_listbox()
+            self.append_arrow_artists(arrow_data)
             
             return f"矢印 {source_matrix}[{source_row}][{source_col}] → {target_matrix}[{target_row}][{target_col}] を追加しました"
             
@@ -2858,32 +6468,28 @@ class MatrixVisualization:
                 raise ValueError(f"行列 '{matrix_name}' が定義されていません。")
             
             # インデックスの範囲チェック
-            matrix_rows = self.matrices[matrix_name]['rows']
-            matrix_cols = self.matrices[matrix_name]['cols']
+            matrix_rows = self.matrices[matrix_name].rows
+            matrix_cols = self.matrices[matrix_name].cols
             
             if row < 0 or row >= matrix_rows or col < 0 or col >= matrix_cols:
                 raise ValueError(f"要素の位置が範囲外です。行: 0-{matrix_rows-1}, 列: 0-{matrix_cols-1}")
             
-            # 既存の色設定を削除
-            self.colored_cells = [cell for cell in self.colored_cells 
-                            if not (cell['matrix'] == matrix_name and cell['row'] == row and cell['col'] == col)]
-            
-            # 色が "none" でない場合、新しい色設定を追加
+            # 色が "none" でない場合、新しい色設定を追加（既存の設定は置き換え）
             if color.lower() != "none":
-                self.colored_cells.append({
-                    'matrix': matrix_name,
-                    'row': row,
-                    'col': col,
-                    'color': color
-                })
+                self.colored_cells.set(matrix_name, row, col, color)
                 
-                # リストを更新
+                # リストと表示を更新
                 self.update_colored_cells_listbox()
+                self.refresh_colored_cell(matrix_name, row, col)
                 
                 return f"要素 {matrix_name}[{row}][{col}] の色を '{color}' に設定しました"
             else:
-                # リストを更新
+                # 既存の色設定を削除
+                self.colored_cells.discard(matrix_name, row, col)
+                
+                # リストと表示を更新
                 self.update_colored_cells_listbox()
+                self.refresh_colored_cell(matrix_name, row, col)
                 
                 return f"要素 {matrix_name}[{row}][{col}] の色を削除しました"
                 
@@ -2907,8 +6513,8 @@ class MatrixVisualization:
                 raise ValueError(f"行列 '{matrix_name}' が定義されていません。")
             
             # インデックスの範囲チェック
-            matrix_rows = self.matrices[matrix_name]['rows']
-            matrix_cols = self.matrices[matrix_name]['cols']
+            matrix_rows = self.matrices[matrix_name].rows
+            matrix_cols = self.matrices[matrix_name].cols
             
             if row < 0 or row >= matrix_rows or col < 0 or col >= matrix_cols:
                 raise ValueError(f"要素の位置が範囲外です。行: 0-{matrix_rows-1}, 列: 0-{matrix_cols-1}")
@@ -2920,14 +6526,14 @@ class MatrixVisualization:
                     value = float(value_part)
                 else:
                     value = int(value_part)
-                
-                # 値を設定
-                self.matrices[matrix_name]['values'][row, col] = value
-                
-                return f"要素 {matrix_name}[{row}][{col}] の値を '{value}' に設定しました"
-                
             except ValueError:
                 raise ValueError(f"値 '{value_part}' は有効な数値ではありません。")
+            
+            # 値を設定（整数の型の方針の行列に整数でない値を書くと ValueError）
+            self.set_cell_value(matrix_name, row, col, value)
+            self.refresh_cell(matrix_name, row, col)
+            
+            return f"要素 {matrix_name}[{row}][{col}] の値を '{value}' に設定しました"
                 
         else:
             raise ValueError("認識できないコマンド形式です。例: A := [3, 3] @ (0, 0), A[0][0] -> B[1][1] : red, A[0][0] : blue")
@@ -2983,32 +6589,32 @@ class MatrixVisualization:
                 
                 self.status_var.set(f"矢印 {index+1} を選択しました")
                 
-                # 矢印を強調表示
-                self.visualize_matrices()  # 現在の表示をリセット
+                # 矢印を強調表示（前の選択の強調は消す）
+                self.clear_overlay('selection')
                 
                 # 選択された矢印を強調
                 source_name, source_row, source_col = arrow_data['source']
                 target_name, target_row, target_col = arrow_data['target']
                 
                 if source_name in self.matrices and target_name in self.matrices:
-                    source_pos = self.matrices[source_name]['position']
-                    target_pos = self.matrices[target_name]['position']
+                    source_pos = self.matrices[source_name].position
+                    target_pos = self.matrices[target_name].position
                     
                     # セルを強調
                     source_x = source_pos[0] + source_col
                     source_y = source_pos[1] + source_row
                     rect1 = patches.Rectangle((source_x, -source_y-1), 1, 1, 
-                                        linewidth=2, edgecolor='blue', facecolor='none')
-                    self.ax.add_patch(rect1)
+                                        linewidth=2, edgecolor='blue', facecolor='none', zorder=12)
+                    self.add_overlay('selection', self.ax.add_patch(rect1))
                     
                     target_x = target_pos[0] + target_col
                     target_y = target_pos[1] + target_row
                     rect2 = patches.Rectangle((target_x, -target_y-1), 1, 1, 
-                                        linewidth=2, edgecolor='red', facecolor='none')
-                    self.ax.add_patch(rect2)
-                    
-                    # キャンバスを更新
-                    self.canvas.draw()
+                                        linewidth=2, edgecolor='red', facecolor='none', zorder=12)
+                    self.add_overlay('selection', self.ax.add_patch(rect2))
+                
+                # キャンバスを更新
+                self.request_overlay_redraw()
 
     def on_colored_cell_select(self, event):
         """リストボックスで色付き要素を選択したときのイベントハンドラ"""
@@ -3033,7 +6639,7 @@ class MatrixVisualization:
                 
                 # 値も設定
                 if cell_data['matrix'] in self.matrices:
-                    value = self.matrices[cell_data['matrix']]['values'][cell_data['row'], cell_data['col']]
+                    value = self.matrices[cell_data['matrix']].values[cell_data['row'], cell_data['col']]
                     self.cell_value.delete(0, tk.END)
                     self.cell_value.insert(0, str(value))
                 
@@ -3055,12 +6661,12 @@ class MatrixVisualization:
                 
                 self.status_var.set(f"色付き要素 {index+1} を選択しました")
                 
-                # セルを強調表示
-                self.visualize_matrices()  # 現在の表示をリセット
+                # セルを強調表示（前の選択の強調は消す）
+                self.clear_overlay('selection')
                 
                 # 選択されたセルを強調
                 if cell_data['matrix'] in self.matrices:
-                    matrix_pos = self.matrices[cell_data['matrix']]['position']
+                    matrix_pos = self.matrices[cell_data['matrix']].position
                     row = cell_data['row']
                     col = cell_data['col']
                     
@@ -3068,11 +6674,11 @@ class MatrixVisualization:
                     y = matrix_pos[1] + row
                     
                     rect = patches.Rectangle((x, -y-1), 1, 1, 
-                                        linewidth=3, edgecolor='yellow', facecolor='none')
-                    self.ax.add_patch(rect)
-                    
-                    # キャンバスを更新
-                    self.canvas.draw()
+                                        linewidth=3, edgecolor='yellow', facecolor='none', zorder=12)
+                    self.add_overlay('selection', self.ax.add_patch(rect))
+                
+                # キャンバスを更新
+                self.request_overlay_redraw()
 
     def save_figure(self, format):
         """図を保存する"""
@@ -3097,6 +6703,8 @@ class MatrixVisualization:
         if not filename:
             return  # ユーザーがキャンセルした場合
         
+        # オーバーレイは通常の描画から除いてあるので、保存する間だけ図に含める
+        self.flatten_overlays(True)
         try:
             # グラフの境界を調整して保存（余白や切れないように）
             self.fig.tight_layout()
@@ -3132,6 +6740,19 @@ class MatrixVisualization:
             # デバッグ用にエラー詳細をコンソールに出力
             import traceback
             traceback.print_exc()
+        
+        finally:
+            self.flatten_overlays(False)
+            # tight_layout で配置が変わるので静的な層も描き直す
+            self.request_redraw()
+    
+    def flatten_overlays(self, flatten):
+        """オーバーレイを通常の描画に含めるかを切り替える（ホバー表示は常に除く）"""
+        for layer, artists in self.scene['overlays'].items():
+            if layer == 'hover':
+                continue
+            for artist in artists:
+                artist.set_animated(not flatten)
 
 def setup_logging():
     """ログ機能のセットアップ"""
@@ -3162,7 +6783,9 @@ def load_config(config_file):
             {"name": "B", "rows": 3, "cols": 3, "position": [5, 0]}
         ],
         "font_size": 12,
-        "auto_save": False
+        "auto_save": False,
+        "frame_budget_ms": 16,
+        "tile_cache_mb": 256
     }
     
     if not os.path.exists(config_file):
@@ -3194,13 +6817,30 @@ def parse_arguments():
     parser.add_argument('--debug', action='store_true', help='デバッグモードで実行')
     parser.add_argument('--file', type=str, help='読み込む行列データファイル')
     parser.add_argument('--fullscreen', action='store_true', help='フルスクリーンで起動')
-    return parser.parse_args()
+    parser.add_argument('--render', type=str, nargs='+', metavar='FILE',
+                        help='GUI を起動せずにシーンファイルを画像として書き出す')
+    parser.add_argument('--output-dir', type=str, help='書き出し先のディレクトリ（省略時は入力ファイルと同じ場所）')
+    parser.add_argument('--format', choices=['png', 'svg', 'pdf', 'gif', 'mp4'],
+                        help='書き出す形式（省略時は PNG、--animate のときは GIF）')
+    parser.add_argument('--dpi', type=int, help='書き出す画像の解像度（省略時は PNG が 300、それ以外は 150）')
+    parser.add_argument('--jobs', type=int, help='並列に書き出すプロセス数（省略時は CPU コア数）')
+    parser.add_argument('--animate', type=str, metavar='LEFT*RIGHT',
+                        help='--render で乗算のアニメーションを書き出す（例: A*B）')
+    args = parser.parse_args()
+    
+    # アニメーションは GIF / MP4、静止画は PNG / SVG / PDF で書き出す
+    animation_formats = ('gif', 'mp4')
+    if args.format is None:
+        args.format = 'gif' if args.animate else 'png'
+    elif bool(args.animate) != (args.format in animation_formats):
+        parser.error('--format gif / mp4 は --animate と組み合わせて指定してください')
+    return args
 
 def load_matrices_from_file(file_path):
     """ファイルから行列データを読み込む"""
     matrices = {}
-    arrows = []
-    colored_cells = []
+    arrows = ArrowTable()
+    colored_cells = ColoredCellIndex()
     
     try:
         with open(file_path, 'r', encoding='utf-8') as f:
@@ -3215,8 +6855,19 @@ def load_matrices_from_file(file_path):
                     pos_x = matrix_data.get('position', [0, 0])[0]
                     pos_y = matrix_data.get('position', [0, 0])[1]
                     
+                    # 'file' は .npy ファイルをメモリマップする（パスはシーンファイルからの相対パス）
+                    if 'file' in matrix_data:
+                        path = os.path.join(os.path.dirname(os.path.abspath(file_path)), matrix_data['file'])
+                        matrices[name] = Matrix.from_file(name, path, (pos_x, pos_y),
+                                                          matrix_data.get('dtype_policy', 'auto'),
+                                                          matrix_data.get('edits', ()))
+                        continue
+                    
                     # 値の配列が与えられていればそれを使用、なければデフォルト値
-                    if 'values' in matrix_data:
+                    # （'sparse' は非ゼロ要素だけの疎行列: COO の row/col/data か CSR の indptr/indices/data）
+                    if 'sparse' in matrix_data:
+                        values = sparse_from_entries(matrix_data['sparse'], (rows, cols))
+                    elif 'values' in matrix_data:
                         values = np.array(matrix_data['values'])
                     else:
                         values = np.zeros((rows, cols), dtype=int)
@@ -3226,46 +6877,103 @@ def load_matrices_from_file(file_path):
                                 values[i, j] = counter
                                 counter += 1
                     
-                    matrices[name] = {
-                        'values': values,
-                        'position': (pos_x, pos_y),
-                        'rows': rows,
-                        'cols': cols
-                    }
+                    matrices[name] = Matrix(name, values, (pos_x, pos_y),
+                                            matrix_data.get('dtype_policy', 'auto'))
         
         if 'arrows' in data:
-            for arrow_data in data['arrows']:
-                source = arrow_data.get('source')
-                target = arrow_data.get('target')
-                if source and target:
-                    arrows.append({
-                        'source': tuple(source),
-                        'target': tuple(target),
-                        'color': arrow_data.get('color', 'red'),
-                        'style': arrow_data.get('style', '-|>'),
-                        'width': arrow_data.get('width', 2.0),
-                        'label': arrow_data.get('label', '')
-                    })
+            arrows.extend({
+                'source': tuple(arrow_data['source']),
+                'target': tuple(arrow_data['target']),
+                'color': arrow_data.get('color', 'red'),
+                'style': arrow_data.get('style', '-|>'),
+                'width': arrow_data.get('width', 2.0),
+                'label': arrow_data.get('label', '')
+            } for arrow_data in data['arrows'] if arrow_data.get('source') and arrow_data.get('target'))
         
         if 'colored_cells' in data:
-            for cell_data in data['colored_cells']:
-                matrix = cell_data.get('matrix')
-                row = cell_data.get('row')
-                col = cell_data.get('col')
-                color = cell_data.get('color')
-                if matrix is not None and row is not None and col is not None and color:
-                    colored_cells.append({
-                        'matrix': matrix,
-                        'row': row,
-                        'col': col,
-                        'color': color
-                    })
+            # 重複するセルは後のものが優先される（1件ずつ set したときと同じ）
+            colored_cells = ColoredCellIndex(
+                cell_data for cell_data in data['colored_cells']
+                if cell_data.get('matrix') is not None and cell_data.get('row') is not None
+                and cell_data.get('col') is not None and cell_data.get('color'))
         
         return matrices, arrows, colored_cells
     
     except Exception as e:
         print(f"ファイルの読み込みエラー: {str(e)}")
-        return {}, [], []
+        return {}, ArrowTable(), ColoredCellIndex()
+
+def render_scene_file(file_path, output_path, format='png', dpi=None, theme='light', animate=None):
+    """シーンファイルを Tk を使わずに画像として書き出す（プロセスプールから呼ばれる）
+
+    animate に 'A*B' のような乗算を渡すと、その乗算のアニメーションを GIF / MP4 として書き出す。
+    """
+    matrices, arrows, colored_cells = load_matrices_from_file(file_path)
+    if not matrices:
+        raise ValueError(f"行列データを読み込めませんでした: {file_path}")
+    
+    # pyplot を通さずに Agg キャンバスへ直接描画する
+    fig = Figure(figsize=(8, 6))
+    FigureCanvasAgg(fig)
+    renderer = MatrixRenderer(fig, is_dark_mode=(theme == 'dark'))
+    renderer.matrices = matrices
+    renderer.arrows = arrows
+    renderer.colored_cells = colored_cells
+    renderer.render_scene()
+    renderer.apply_figure_theme()
+    
+    if animate:
+        left_name, _, right_name = (name.strip() for name in animate.partition('*'))
+        for name in (left_name, right_name):
+            if name not in matrices:
+                raise ValueError(f"行列 '{name}' が定義されていません")
+        animator = MultiplicationAnimator(renderer, left_name, right_name)
+        fig.tight_layout()
+        return animator.save(output_path, dpi=dpi or 100)
+    
+    # GUI の save_figure と同じ設定で保存
+    fig.tight_layout()
+    fig.savefig(
+        output_path,
+        format=format,
+        bbox_inches='tight',
+        dpi=dpi or (300 if format == 'png' else 150),
+        transparent=format in ['png', 'svg'],
+        pad_inches=0.1
+    )
+    return output_path
+
+def render_scene_files(file_paths, output_dir=None, format='png', dpi=None, theme='light', jobs=None,
+                       animate=None):
+    """複数のシーンファイルをプロセスプールで並列に書き出し、(入力, 出力, エラー) のリストを返す"""
+    tasks = []
+    for file_path in file_paths:
+        base_name = os.path.splitext(os.path.basename(file_path))[0]
+        directory = output_dir or os.path.dirname(file_path)
+        tasks.append((file_path, os.path.join(directory, f"{base_name}.{format}"), format, dpi, theme, animate))
+    
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    
+    results = []
+    # 1件だけ、または1プロセス指定ならプールを作らずにその場で描画
+    if len(tasks) <= 1 or jobs == 1:
+        for task in tasks:
+            try:
+                results.append((task[0], render_scene_file(*task), None))
+            except Exception as e:
+                results.append((task[0], None, str(e)))
+        return results
+    
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(render_scene_file, *task): task for task in tasks}
+        for future in as_completed(futures):
+            task = futures[future]
+            try:
+                results.append((task[0], future.result(), None))
+            except Exception as e:
+                results.append((task[0], None, str(e)))
+    return results
 
 def main():
     try:
@@ -3284,6 +6992,25 @@ def main():
         if args.theme:
             config['theme'] = args.theme
         
+        # ヘッドレスでの一括書き出し（Tk は作成しない）
+        if args.render:
+            logger.info(f"{len(args.render)} 件のシーンを書き出します...")
+            start = time.perf_counter()
+            results = render_scene_files(args.render, args.output_dir, args.format, args.dpi,
+                                         config['theme'], args.jobs, args.animate)
+            failures = 0
+            for file_path, output_path, error in results:
+                if error:
+                    failures += 1
+                    logger.error(f"'{file_path}' の書き出しに失敗しました: {error}")
+                else:
+                    logger.info(f"'{file_path}' を '{output_path}' に書き出しました")
+            logger.info(f"書き出し完了: 成功 {len(results) - failures} 件, 失敗 {failures} 件 "
+                        f"({time.perf_counter() - start:.1f} 秒)")
+            if failures:
+                sys.exit(1)
+            return
+        
         # ロケールの設定
         try:
             locale.setlocale(locale.LC_ALL, '')
@@ -3319,6 +7046,8 @@ def main():
         
         # アプリケーションの作成
         app = MatrixVisualization(root)
+        app.render_scheduler.frame_budget_ms = config['frame_budget_ms']
+        app.tile_cache.budget_bytes = config['tile_cache_mb'] * 1024 * 1024
         
         # テーマの設定
         if config['theme'] == 'dark':
@@ -3352,12 +7081,7 @@ def main():
                         values[i, j] = counter
                         counter += 1
                 
-                app.matrices[name] = {
-                    'values': values,
-                    'position': (pos_x, pos_y),
-                    'rows': rows,
-                    'cols': cols
-                }
+                app.matrices[name] = Matrix(name, values, (pos_x, pos_y))
             
             # デフォルトの矢印と色付きセルの例
             if len(app.matrices) >= 2:
@@ -3371,12 +7095,7 @@ def main():
                     'label': '例'
                 })
                 
-                app.colored_cells.append({
-                    'matrix': matrix_names[0],
-                    'row': 1,
-                    'col': 1,
-                    'color': "lightblue"
-                })
+                app.colored_cells.set(matrix_names[0], 1, 1, "lightblue")
             
             # リストと可視化を更新
             app.update_matrices_listbox()
@@ -3394,6 +7113,13 @@ def main():
                 save_config(config_file, config)
                 logger.info("設定を保存しました")
             
+            logger.info(f"描画の統計: {app.render_scheduler.stats()}")
+            logger.info(f"レイヤー合成: {app.compositor.stats()}")
+            logger.info(f"タイルキャッシュ: {app.tile_cache.stats()}")
+            logger.info(f"ラベルキャッシュ: {app.cell_labels.stats()}")
+            logger.info(f"色のキャッシュ: {color_registry.stats()}")
+            logger.info(f"式の構文木: {expression_parser.stats()}")
+            logger.info(f"式の評価: {app.expression_evaluator.stats()}")
             logger.info("アプリケーションを終了します")
             root.destroy()
         